@@ -0,0 +1,190 @@
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from fastapi.responses import JSONResponse
+
+# 기본 설정 (환경 변수로 변경 가능)
+ADMISSION_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "32"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10"))
+ADMISSION_IMAGE_WEIGHT = int(os.getenv("ADMISSION_IMAGE_WEIGHT", "4"))
+ADMISSION_IMAGE_BYTES = int(os.getenv("ADMISSION_IMAGE_BYTES", str(32 * 1024)))
+
+# 대기 시간 통계에 사용할 최근 요청 수
+_WAIT_SAMPLES = 1000
+
+
+class AdmissionRejected(Exception):
+    """대기열이 가득 찼거나 대기 시간이 지나 요청을 거절"""
+
+    def __init__(self, status_code, detail, retry_after):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """가중치 기반 동시 실행 제한 + 길이 제한이 있는 FIFO 대기열
+
+    실행 중인 요청의 가중치 합이 max_concurrency를 넘지 않도록 하고,
+    나머지는 도착 순서대로 최대 queue_timeout초까지 기다리게 합니다.
+    대기열이 가득 차면 429, 대기 시간을 넘기면 503으로 바로 거절합니다.
+    이미지 요청은 image_weight만큼 자리를 차지합니다.
+    """
+
+    def __init__(self, max_concurrency=ADMISSION_MAX_CONCURRENCY, max_queue=ADMISSION_MAX_QUEUE,
+                 queue_timeout=ADMISSION_QUEUE_TIMEOUT, image_weight=ADMISSION_IMAGE_WEIGHT,
+                 image_bytes=ADMISSION_IMAGE_BYTES):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.image_weight = image_weight
+        self.image_bytes = image_bytes
+        self._in_use = 0
+        self._waiters = deque()  # [weight, future]
+        self._service_time = 5.0  # 요청 하나의 처리 시간 이동 평균 (초)
+        self._waits = deque(maxlen=_WAIT_SAMPLES)
+        self.stats = {"admitted": 0, "queued": 0, "rejected_queue_full": 0, "rejected_timeout": 0}
+
+    def weight_for(self, content_length):
+        """요청 본문 크기로 가중치 결정 (크기를 모르거나 크면 이미지 요청으로 간주)"""
+        if content_length is None or content_length > self.image_bytes:
+            return self.image_weight
+        return 1
+
+    def retry_after(self, weight):
+        """지금 대기열에 있는 요청이 빠질 때까지의 대략적인 시간 (초)"""
+        queued = sum(entry[0] for entry in self._waiters) + weight
+        return max(1, math.ceil(self._service_time * queued / self.max_concurrency))
+
+    async def acquire(self, weight):
+        """자리가 날 때까지 기다린 뒤 실제로 차지한 가중치를 반환 (거절되면 AdmissionRejected)"""
+        # 한도보다 무거운 요청도 혼자서는 실행될 수 있도록
+        weight = min(weight, self.max_concurrency)
+        if not self._waiters and self._in_use + weight <= self.max_concurrency:
+            self._in_use += weight
+            self._admit(0.0)
+            return weight
+        if len(self._waiters) >= self.max_queue:
+            self.stats["rejected_queue_full"] += 1
+            raise AdmissionRejected(
+                429, "요청이 많아 대기열이 가득 찼습니다. 잠시 후 다시 시도해주세요.",
+                self.retry_after(weight)
+            )
+
+        future = asyncio.get_running_loop().create_future()
+        entry = [weight, future]
+        self._waiters.append(entry)
+        self.stats["queued"] += 1
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._remove(entry)
+            self.stats["rejected_timeout"] += 1
+            raise AdmissionRejected(
+                503, "요청이 많아 처리하지 못했습니다. 잠시 후 다시 시도해주세요.",
+                self.retry_after(weight)
+            )
+        except asyncio.CancelledError:
+            # 자리를 받은 직후 취소되었으면 반납
+            if future.done() and not future.cancelled():
+                self.release(weight)
+            else:
+                self._remove(entry)
+            raise
+        self._admit(time.monotonic() - started)
+        return weight
+
+    def release(self, weight, service_time=None):
+        """차지한 자리를 반납하고 대기 중인 요청을 깨움"""
+        self._in_use -= weight
+        if service_time is not None:
+            self._service_time = 0.9 * self._service_time + 0.1 * service_time
+        self._wake()
+
+    def snapshot(self):
+        """실행 중 가중치, 대기열 길이, 대기 시간 통계"""
+        waits = sorted(self._waits)
+        return {
+            **self.stats,
+            "in_flight_weight": self._in_use,
+            "max_concurrency": self.max_concurrency,
+            "queue_depth": len(self._waiters),
+            "queued_weight": sum(entry[0] for entry in self._waiters),
+            "wait_ms_avg": round(sum(waits) / len(waits) * 1000, 1) if waits else 0.0,
+            "wait_ms_p95": round(waits[int(len(waits) * 0.95)] * 1000, 1) if waits else 0.0,
+            "service_time_avg_s": round(self._service_time, 2),
+        }
+
+    def _admit(self, waited):
+        self.stats["admitted"] += 1
+        self._waits.append(waited)
+
+    def _remove(self, entry):
+        try:
+            self._waiters.remove(entry)
+        except ValueError:
+            pass
+        # 맨 앞의 무거운 요청이 빠지면 뒤의 요청이 들어갈 수 있음
+        self._wake()
+
+    def _wake(self):
+        while self._waiters:
+            weight, future = self._waiters[0]
+            if future.done():
+                self._waiters.popleft()
+                continue
+            if self._in_use + weight > self.max_concurrency:
+                break
+            self._waiters.popleft()
+            self._in_use += weight
+            future.set_result(None)
+
+
+class AdmissionMiddleware:
+    """match(scope)에 해당하는 요청을 본문을 읽기 전에 AdmissionController로 제한하는 ASGI 미들웨어
+
+    거절된 요청은 본문을 메모리에 올리지 않고 Retry-After와 함께 바로 응답합니다.
+    스트리밍 응답은 마지막 청크를 보낼 때까지 자리를 차지합니다.
+    """
+
+    def __init__(self, app, controller, match):
+        self.app = app
+        self.controller = controller
+        self.match = match
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.match(scope):
+            await self.app(scope, receive, send)
+            return
+
+        content_length = None
+        for name, value in scope["headers"]:
+            if name == b"content-length":
+                content_length = int(value) if value.isdigit() else -1
+                break
+        if content_length == -1:
+            # 잘못된 Content-Length는 본문 크기를 알 수 없으므로 자리를 잡기 전에 거절
+            response = JSONResponse({"detail": "잘못된 Content-Length 헤더입니다."}, status_code=400)
+            await response(scope, receive, send)
+            return
+        try:
+            weight = await self.controller.acquire(self.controller.weight_for(content_length))
+        except AdmissionRejected as e:
+            response = JSONResponse(
+                {"detail": e.detail},
+                status_code=e.status_code,
+                headers={"Retry-After": str(e.retry_after)}
+            )
+            await response(scope, receive, send)
+            return
+
+        started = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(weight, time.monotonic() - started)
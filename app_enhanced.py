@@ -1,16 +1,136 @@
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from fastapi import Body, Depends, FastAPI, Header, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
-from pydantic import BaseModel
-from openai import OpenAI
+from fastapi.responses import HTMLResponse, PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel, ValidationError
+from openai import AsyncOpenAI
+import asyncio
+import httpx
+import json
 import os
 import re
+import time
 from dotenv import load_dotenv
+from text_format import clean_text, to_html, IncrementalHtmlFormatter
+from response_cache import get_response_cache, has_image, is_cacheable, make_cache_key
+from singleflight import SingleFlight
+from image_pipeline import INVALID_IMAGE_ERRORS, prepare_data_url, prepare_image
+from image_store import get_image_store
+from image_upload import ImageUploads, UploadError, receive_image
+from conversation_store import get_conversation_store
+from context_window import ContextWindow
+from summarizer import Summarizer, message_text
+from resilience import CircuitOpenError, RetryPolicy, get_circuit_breaker
+from admission import AdmissionController, AdmissionMiddleware
+from rate_limit import estimate_request_tokens, get_rate_limiter, request_cost
+from fair_queue import FairScheduler
+from metrics import CONTENT_TYPE, MetricsMiddleware, Stopwatch, get_chat_metrics, render as render_metrics
+from tracing import TracingMiddleware, current_span, new_request_id, use_span
+from profiler import (
+    DEBUG_TOKEN, PROFILE_INTERVAL_MS, PROFILE_MAX_SECONDS, ProfileMiddleware, capture, check_debug_token,
+    get_request_profile,
+)
 
 # 환경 변수 로드
 load_dotenv(override=False)
 
-app = FastAPI(title="GPT Text Service", version="2.0.0")
+# 업스트림 커넥션 풀 설정 (워커 하나가 동시에 처리할 수 있는 요청 수)
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "200"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", "50"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "120"))
+
+# 동시에 들어온 동일 요청을 하나의 업스트림 호출로 합칠지 여부
+COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "1") != "0"
+
+# 일괄 요청 (/api/chat/batch) 최대 항목 수와 항목 동시 실행 수
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "100"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+
+# OpenAI 비동기 클라이언트 (startup에서 생성, shutdown에서 종료)
+client = None
+
+# 동일 요청 합치기 (요청 키는 응답 캐시와 같은 정규화 해시)
+coalescer = SingleFlight(enabled=COALESCE_REQUESTS)
+
+# 업스트림 호출 재시도/서킷 브레이커 정책 (세 프론트엔드 공용)
+retry_policy = RetryPolicy()
+
+# 서버 측 대화: 입력 토큰 예산 관리와 오래된 턴의 백그라운드 요약
+context_window = ContextWindow()
+summarizer = Summarizer(retry_policy=retry_policy, frontend="fastapi")
+background_tasks = set()
+
+# 채팅 요청 동시 실행 제한과 대기열 (이미지 요청은 더 큰 가중치)
+admission = AdmissionController()
+
+# 업스트림 호출 앞의 세션별 공정 큐 (예상 토큰 수 기준 deficit round-robin)
+scheduler = FairScheduler()
+
+# 요청 수/단계별 지연 시간/토큰 수 메트릭 (/metrics)
+chat_metrics = get_chat_metrics("fastapi")
+
+# POST /api/images로 올린 이미지 (원본 SHA-256 -> 처리된 이미지, 채팅 요청에서 image_id로 참조)
+image_uploads = ImageUploads(get_image_store())
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """풀링된 비동기 OpenAI 클라이언트의 생성과 종료를 관리"""
+    global client
+    api_key = os.getenv("OPENAI_API_KEY")
+    if api_key:
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+            ),
+            timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=10.0),
+            # x-ratelimit 헤더로 한도를 파악해 보내기 전에 속도 조절
+            event_hooks=get_rate_limiter(api_key).async_event_hooks(),
+        )
+        # 재시도는 retry_policy가 담당하므로 클라이언트 자체 재시도는 끔
+        client = AsyncOpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+    try:
+        yield
+    finally:
+        if client is not None:
+            await client.close()
+            client = None
+
+
+app = FastAPI(title="GPT Text Service", version="2.0.0", lifespan=lifespan)
+
+
+def is_chat_request(scope):
+    """업스트림을 호출하는 채팅 요청 또는 이미지 업로드인지 확인 (입장 제어 대상)"""
+    path = scope["path"]
+    if scope["method"] != "POST":
+        return False
+    return path.startswith("/api/chat") or path == "/api/images" or (
+        path.startswith("/api/conversations/") and "/messages" in path
+    )
+
+
+def metrics_route(scope):
+    """메트릭에 기록할 채팅 요청의 경로 이름 (대화 ID는 {conversation_id}로 묶음)"""
+    if not is_chat_request(scope):
+        return None
+    return re.sub(r"^/api/conversations/[^/]+", "/api/conversations/{conversation_id}", scope["path"])
+
+
+def profile_id(scope):
+    """요청별 프로파일을 보관할 ID (트레이스의 요청 ID, 채팅 요청이 아니면 새로 생성)"""
+    return current_span().request_id or new_request_id()
+
+
+# X-Profile 헤더로 요청한 요청별 프로파일 (가장 안쪽: 본문 수신부터 응답 전송까지)
+app.add_middleware(ProfileMiddleware, request_id=profile_id)
+
+# 메트릭 (입장 제어 안쪽: 대기열에서 기다린 요청은 진행 중으로 세지 않음)
+app.add_middleware(MetricsMiddleware, metrics=chat_metrics, route_label=metrics_route)
+
+# 입장 제어 (CORS보다 안쪽에 두어 거절 응답에도 CORS 헤더가 붙도록 먼저 등록)
+app.add_middleware(AdmissionMiddleware, controller=admission, match=is_chat_request)
 
 # CORS 설정
 app.add_middleware(
@@ -21,8 +141,8 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# OpenAI 클라이언트 초기화
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# 요청별 트레이스와 X-Request-ID (가장 바깥에 두어 입장 제어 대기 시간도 포함)
+app.add_middleware(TracingMiddleware, route_label=metrics_route, frontend="fastapi")
 
 # 시스템 프롬프트
 SYSTEM_PROMPT = """당신은 친절하고 도움이 되는 AI 어시스턴트입니다. 
@@ -41,11 +161,36 @@ class ChatRequest(BaseModel):
     temperature: float = 0.7
     max_completion_tokens: int = 1000
     image_base64: str = None  # base64 인코딩된 이미지
+    image_id: str = None  # POST /api/images로 업로드한 이미지 (image_base64 대신 사용)
+    cache: bool = False  # temperature > 0 등 비결정적 요청도 캐시 사용 (opt-in)
 
 
 class ChatResponse(BaseModel):
     response: str
     model: str
+    cached: bool = False
+
+
+class BatchItemResult(BaseModel):
+    index: int
+    response: str = None
+    model: str = None
+    cached: bool = False
+    error: str = None  # 실패한 항목만 (다른 항목에는 영향 없음)
+    status_code: int = 200
+
+
+class ConversationCreate(BaseModel):
+    model: str = "gpt-5-mini"
+    temperature: float = 0.7
+    max_completion_tokens: int = 1000
+    summarize: bool = False  # 오래된 턴을 백그라운드에서 요약해 요약문만 전송
+
+
+class ConversationMessage(BaseModel):
+    message: str
+    image_base64: str = None  # base64 인코딩된 이미지 (이번 턴에만 첨부)
+    image_id: str = None  # POST /api/images로 업로드한 이미지 (image_base64 대신 사용)
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -223,7 +368,11 @@ async def read_root():
         </div>
         
         <script>
-            let currentImageBase64 = null;
+            // 붙여넣은 이미지 (미리보기 URL과 업로드 결과를 기다리는 Promise)
+            let currentImage = null;
+            
+            // 서버 측 대화 ID (첫 메시지를 보낼 때 생성, 이후에는 새 메시지만 전송)
+            let conversationId = null;
             
             // 텍스트 영역 자동 크기 조절
             function autoResize(textarea) {
@@ -248,28 +397,43 @@ async def read_root():
                 
                 event.preventDefault();
                 
+                // base64로 바꾸지 않고 원본 바이트를 바로 업로드 (메시지를 입력하는 동안 진행)
                 const file = imageItem.getAsFile();
-                const reader = new FileReader();
-                
-                reader.onload = function(e) {
-                    currentImageBase64 = e.target.result;
-                    showImagePreview(currentImageBase64);
+                currentImage = {
+                    url: URL.createObjectURL(file),
+                    upload: uploadImage(file)
                 };
-                
-                reader.readAsDataURL(file);
+                currentImage.upload.catch(() => {});
+                showImagePreview(currentImage.url);
+            }
+            
+            // 이미지 업로드 후 image_id 반환
+            async function uploadImage(file) {
+                const response = await fetch('/api/images', {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': file.type || 'application/octet-stream',
+                    },
+                    body: file
+                });
+                const data = await response.json();
+                if (!response.ok) {
+                    throw new Error(data.detail || '이미지 업로드 오류');
+                }
+                return data.image_id;
             }
             
             // 이미지 미리보기 표시
-            function showImagePreview(base64Image) {
+            function showImagePreview(imageUrl) {
                 const preview = document.getElementById('imagePreview');
                 const img = document.getElementById('previewImage');
-                img.src = base64Image;
+                img.src = imageUrl;
                 preview.style.display = 'block';
             }
             
             // 이미지 제거
             function removeImage() {
-                currentImageBase64 = null;
+                currentImage = null;
                 document.getElementById('imagePreview').style.display = 'none';
             }
             
@@ -281,7 +445,7 @@ async def read_root():
                 const sendButton = document.getElementById('sendButton');
                 const loading = document.getElementById('loading');
                 
-                if (!message && !currentImageBase64) return;
+                if (!message && !currentImage) return;
                 
                 // 사용자 메시지 표시
                 const userMessageDiv = document.createElement('div');
@@ -292,9 +456,9 @@ async def read_root():
                 }
                 
                 // 이미지가 있으면 표시
-                if (currentImageBase64) {
+                if (currentImage) {
                     const img = document.createElement('img');
-                    img.src = currentImageBase64;
+                    img.src = currentImage.url;
                     img.className = 'message-image';
                     img.style.display = 'block';
                     userMessageDiv.appendChild(img);
@@ -302,6 +466,9 @@ async def read_root():
                 
                 chatContainer.appendChild(userMessageDiv);
                 
+                // 전송할 이미지는 미리보기를 지우기 전에 보관
+                const image = currentImage;
+                
                 // 입력 필드 비우기 및 비활성화
                 input.value = '';
                 input.style.height = 'auto';
@@ -313,17 +480,9 @@ async def read_root():
                 scrollToBottom();
                 
                 try {
-                    const response = await fetch('/api/chat', {
-                        method: 'POST',
-                        headers: {
-                            'Content-Type': 'application/json',
-                        },
-                        body: JSON.stringify({
-                            message: message || (currentImageBase64 ? '이 이미지를 분석해주세요.' : ''),
-                            model: 'gpt-5-mini',
-                            temperature: 0.7,
-                            image_base64: currentImageBase64
-                        })
+                    const response = await postConversationMessage({
+                        message: message || (image ? '이 이미지를 분석해주세요.' : ''),
+                        image_id: image ? await image.upload : null
                     });
                     
                     if (!response.ok) {
@@ -331,13 +490,35 @@ async def read_root():
                         throw new Error(errorData.detail || '응답 오류');
                     }
                     
-                    const data = await response.json();
-                    
-                    // 봇 응답 표시
+                    // 봇 응답을 스트림으로 받아 점진적으로 표시
                     const botMessageDiv = document.createElement('div');
                     botMessageDiv.className = 'message bot-message';
-                    botMessageDiv.innerHTML = data.response;
-                    chatContainer.appendChild(botMessageDiv);
+                    let html = '';
+                    let renderScheduled = false;
+                    
+                    function render() {
+                        renderScheduled = false;
+                        botMessageDiv.innerHTML = html;
+                        chatContainer.scrollTop = chatContainer.scrollHeight;
+                    }
+                    
+                    await readEventStream(response, (event, data) => {
+                        if (event === 'error') {
+                            throw new Error(data.detail || '응답 오류');
+                        }
+                        if (event !== 'message' || !data.delta) return;
+                        if (!botMessageDiv.parentNode) {
+                            loading.style.display = 'none';
+                            chatContainer.appendChild(botMessageDiv);
+                        }
+                        html += data.delta;
+                        // 화면 갱신은 프레임당 한 번만
+                        if (!renderScheduled) {
+                            renderScheduled = true;
+                            requestAnimationFrame(render);
+                        }
+                    });
+                    render();
                     
                 } catch (error) {
                     const errorDiv = document.createElement('div');
@@ -354,6 +535,72 @@ async def read_root():
                 }
             }
             
+            // 새 서버 측 대화 생성
+            async function createConversation() {
+                const response = await fetch('/api/conversations', {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json',
+                    },
+                    body: JSON.stringify({
+                        model: 'gpt-5-mini',
+                        temperature: 0.7
+                    })
+                });
+                if (!response.ok) {
+                    throw new Error('대화를 만들 수 없습니다.');
+                }
+                conversationId = (await response.json()).conversation_id;
+            }
+            
+            // 대화에 새 메시지만 전송 (대화가 만료되었으면 새 대화로 한 번 다시 시도)
+            async function postConversationMessage(body) {
+                const send = () => fetch(`/api/conversations/${conversationId}/messages/stream`, {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json',
+                    },
+                    body: JSON.stringify(body)
+                });
+                
+                if (!conversationId) {
+                    await createConversation();
+                }
+                let response = await send();
+                if (response.status === 404) {
+                    await createConversation();
+                    response = await send();
+                }
+                return response;
+            }
+            
+            // SSE 응답 본문을 읽어 이벤트마다 콜백 호출
+            async function readEventStream(response, onEvent) {
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
+                
+                while (true) {
+                    const { value, done } = await reader.read();
+                    if (done) break;
+                    buffer += decoder.decode(value, { stream: true });
+                    
+                    let boundary;
+                    while ((boundary = buffer.indexOf('\\n\\n')) !== -1) {
+                        const block = buffer.slice(0, boundary);
+                        buffer = buffer.slice(boundary + 2);
+                        
+                        let event = 'message';
+                        let data = '';
+                        for (const line of block.split('\\n')) {
+                            if (line.startsWith('event: ')) event = line.slice(7);
+                            else if (line.startsWith('data: ')) data += line.slice(6);
+                        }
+                        if (data) onEvent(event, JSON.parse(data));
+                    }
+                }
+            }
+            
             // 스크롤을 맨 아래로
             function scrollToBottom() {
                 const chatContainer = document.getElementById('chatContainer');
@@ -370,59 +617,637 @@ async def read_root():
     """
 
 
-@app.post("/api/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
-    """GPT API를 사용한 채팅 엔드포인트 (이미지 지원)"""
+async def prepare_request_image(request):
+    """요청 이미지를 API 전송용 data URL로 변환 (규격에 맞으면 원본 그대로)"""
+    if request.image_id:
+        # 업로드할 때 이미 처리된 이미지
+        ref = image_uploads.get(request.image_id)
+        try:
+            if ref is None:
+                raise KeyError(request.image_id)
+            return get_image_store().data_url(ref)
+        except KeyError:
+            # 찾은 뒤 data URL을 만들기 전에 만료되어 삭제된 경우 포함
+            raise HTTPException(status_code=410, detail="업로드한 이미지가 만료되었거나 없습니다. 다시 업로드해 주세요.")
+    if not request.image_base64:
+        return None
     try:
-        if not os.getenv("OPENAI_API_KEY"):
+        # 헤더만 검사하는 빠른 경로가 대부분이지만, 재인코딩은 CPU 작업이므로 스레드에서 실행
+        span = current_span().child("image", input_bytes=len(request.image_base64))
+        with chat_metrics.stage("image"), span, use_span(span):
+            image_url, processed = await asyncio.to_thread(prepare_data_url, request.image_base64)
+            span.set_attribute("passthrough", processed.passthrough)
+    except INVALID_IMAGE_ERRORS as e:
+        raise HTTPException(status_code=400, detail=f"이미지 처리 오류: {str(e)}")
+    return image_url
+
+
+def build_user_content(message, image_url=None):
+    """사용자 메시지 콘텐츠 구성 (이미지가 있으면 멀티모달 형식)"""
+    if not image_url:
+        return message
+    return [
+        {"type": "text", "text": message if message else "이 이미지를 분석해주세요."},
+        {"type": "image_url", "image_url": {"url": image_url}}
+    ]
+
+
+def make_api_params(model, messages, temperature, max_completion_tokens):
+    """Chat Completions 파라미터 구성 (gpt-5-mini는 temperature를 지원하지 않으므로 조건부로 전달)"""
+    api_params = {
+        "model": model,
+        "messages": messages,
+        "max_completion_tokens": max_completion_tokens
+    }
+    # gpt-5-mini가 아닌 경우에만 temperature 전달
+    if model != "gpt-5-mini":
+        api_params["temperature"] = temperature
+    return api_params
+
+
+def build_api_params(request: ChatRequest, image_url=None):
+    """ChatRequest로부터 Chat Completions 파라미터와 사용할 모델을 구성"""
+    # 이미지가 있으면 Vision API 사용 (gpt-4o)
+    model_to_use = "gpt-4o" if image_url else request.model
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": build_user_content(request.message, image_url)}
+    ]
+    api_params = make_api_params(
+        model_to_use, messages, request.temperature, request.max_completion_tokens
+    )
+    return api_params, model_to_use
+
+
+def lookup_cache(request: ChatRequest, api_params, request_key):
+    """캐시 사용 여부와 캐시된 응답 텍스트를 반환"""
+    if not is_cacheable(api_params, api_params["messages"], opt_in=request.cache):
+        return False, None
+    return True, get_response_cache().get(request_key)
+
+
+async def upstream_deltas(api_params, stream=False, session=None):
+    """업스트림 응답 텍스트를 delta 단위로 yield (비스트리밍이면 전체 한 번)
+
+    세션별 공정 큐에서 차례를 기다린 뒤 호출하며, 일시적인 오류는
+    retry_policy에 따라 재시도합니다 (스트림은 첫 청크 전까지만).
+    대기/첫 토큰/전체 호출 시간과 토큰 사용량은 메트릭과 트레이스에 기록하고,
+    요청 ID는 업스트림 호출 헤더로 전달합니다.
+    """
+    model = api_params["model"]
+    trace = current_span()
+    cost = estimate_request_tokens(api_params)
+    async with scheduler.slot(session, cost) as waited:
+        chat_metrics.observe("queue", waited)
+        trace.record("queue", waited)
+        started = time.perf_counter()
+        # 속도 조절기에는 이미 계산한 비용을 넘김 (이미지가 담긴 본문을 다시 해석하지 않도록)
+        with request_cost(model, cost), trace.child("upstream", **{"gen_ai.request.model": model, "stream": stream}) as span:
+            if not stream:
+                response = await retry_policy.call_async(
+                    client.chat.completions.create, **api_params, extra_headers=span.headers()
+                )
+                # 비스트리밍 호출은 첫 토큰과 전체 응답이 함께 도착
+                chat_metrics.observe_since("ttft", started)
+                chat_metrics.observe_since("upstream", started)
+                chat_metrics.record_usage(model, response.usage)
+                span.set_usage(response.usage)
+                span.set_attribute("gen_ai.response.id", response.id)
+                span.set_attribute("openai.request_id", response._request_id)
+                yield response.choices[0].message.content or ""
+                return
+            
+            first_token = True
+            async for chunk in retry_policy.stream_async(
+                client.chat.completions.create, **api_params, stream=True,
+                stream_options={"include_usage": True}, extra_headers=span.headers()
+            ):
+                # 마지막 청크는 choices 없이 usage만 담김
+                if chunk.usage is not None:
+                    chat_metrics.record_usage(model, chunk.usage)
+                    span.set_usage(chunk.usage)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if first_token:
+                        chat_metrics.observe_since("ttft", started)
+                        span.add_event("first_token")
+                        span.set_attribute("gen_ai.response.id", chunk.id)
+                        first_token = False
+                    yield chunk.choices[0].delta.content
+            chat_metrics.observe_since("upstream", started)
+
+
+def upstream_unavailable(error):
+    """서킷이 열려 호출하지 않은 경우 503과 Retry-After로 응답"""
+    return HTTPException(
+        status_code=503,
+        detail=str(error),
+        headers={"Retry-After": str(max(1, round(error.retry_after)))}
+    )
+
+
+async def subscribe_upstream(api_params, request_key, use_cache, stream=False, session=None):
+    """업스트림 호출을 시작하거나, 같은 요청이 진행 중이면 합류해 delta를 구독
+
+    스트리밍 여부와 세션까지 같은 요청끼리만 합칩니다 (스트리밍 요청이 비스트리밍 호출에
+    합류해 첫 토큰을 늦게 받거나, 다른 세션의 공정 큐 차례에 묶이지 않도록).
+    응답 캐시 저장은 먼저 시작한 요청이 아니라 각 요청의 use_cache에 따라 결정합니다.
+    """
+    deltas = []
+    flight_key = (request_key, stream, session)
+    async for delta in coalescer.subscribe(flight_key, lambda: upstream_deltas(api_params, stream, session)):
+        deltas.append(delta)
+        yield delta
+    if use_cache:
+        get_response_cache().set(request_key, clean_text("".join(deltas)))
+
+
+def session_key(http_request):
+    """공정 큐에서 사용할 세션 (X-Session-Id 헤더, 없으면 클라이언트 주소)"""
+    session = http_request.headers.get("x-session-id")
+    if session:
+        return session
+    return http_request.client.host if http_request.client else "anonymous"
+
+
+def observe_parse(http_request):
+    """요청을 받은 뒤 핸들러에 도착하기까지(본문 수신, JSON 파싱, 검증) 걸린 시간 기록"""
+    started = getattr(http_request.state, "request_started", None)
+    chat_metrics.observe_since("parse", started)
+    current_span().record_since("parse", started)
+
+
+def sse_event(data, event=None):
+    """Server-Sent Events 형식의 메시지 한 건을 생성"""
+    payload = json.dumps(data, ensure_ascii=False)
+    if event:
+        return f"event: {event}\ndata: {payload}\n\n"
+    return f"data: {payload}\n\n"
+
+
+async def run_chat(request: ChatRequest, session):
+    """ChatRequest 하나를 처리해 ChatResponse 반환 (실패하면 HTTPException)"""
+    try:
+        if not os.getenv("OPENAI_API_KEY") or client is None:
             raise HTTPException(status_code=500, detail="OPENAI_API_KEY가 설정되지 않았습니다.")
         
-        # 메시지 구성 (이미지가 있으면 멀티모달 형식)
-        user_content = []
-        if request.image_base64:
-            # 이미지가 있으면 Vision API 사용 (gpt-4o)
-            user_content = [
-                {"type": "text", "text": request.message if request.message else "이 이미지를 분석해주세요."},
-                {"type": "image_url", "image_url": {"url": request.image_base64}}
-            ]
-            model_to_use = "gpt-4o"  # Vision API 지원 모델
-        else:
-            user_content = request.message
-            model_to_use = request.model
+        image_url = await prepare_request_image(request)
+        api_params, model_to_use = build_api_params(request, image_url)
+        request_key = make_cache_key(api_params)
         
-        # gpt-5-mini는 temperature를 지원하지 않으므로 조건부로 전달
-        api_params = {
-            "model": model_to_use,
-            "messages": [
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": user_content}
-            ],
-            "max_completion_tokens": request.max_completion_tokens
-        }
-        # gpt-5-mini가 아닌 경우에만 temperature 전달
-        if model_to_use != "gpt-5-mini":
-            api_params["temperature"] = request.temperature
+        # 동일한 요청의 캐시된 응답이 있으면 바로 반환
+        use_cache, cached_text = lookup_cache(request, api_params, request_key)
+        if cached_text is not None:
+            return ChatResponse(response=to_html(cached_text), model=model_to_use, cached=True)
         
-        response = client.chat.completions.create(**api_params)
+        # 같은 요청이 이미 진행 중이면 그 결과를 함께 기다림
+        deltas = [
+            delta async for delta in subscribe_upstream(
+                api_params, request_key, use_cache, session=session
+            )
+        ]
         
-        # 응답 텍스트 가져오기
-        response_text = response.choices[0].message.content
-        
-        # 연속된 줄바꿈을 최대 2개로 제한하고, 불필요한 공백 제거
-        response_text = re.sub(r'\n{3,}', '\n\n', response_text)
-        response_text = response_text.strip()
-        # 줄바꿈을 HTML로 변환
-        html_content = response_text.replace('\n\n', '</p><p>').replace('\n', ' ')
-        html_content = f'<p>{html_content}</p>'
+        # 응답 텍스트 정리 후 HTML 문단으로 변환
+        with chat_metrics.stage("postprocess"), current_span().child("postprocess"):
+            html_content = to_html("".join(deltas))
         
         return ChatResponse(
             response=html_content,
             model=model_to_use
         )
+    except HTTPException:
+        raise
+    except CircuitOpenError as e:
+        raise upstream_unavailable(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"API 오류: {str(e)}")
 
 
+@app.post("/api/chat", response_model=ChatResponse)
+async def chat(request: ChatRequest, http_request: Request):
+    """GPT API를 사용한 채팅 엔드포인트 (이미지 지원)"""
+    observe_parse(http_request)
+    return await run_chat(request, session_key(http_request))
+
+
+def validation_detail(error):
+    """pydantic 검증 오류를 한 줄 메시지로 변환"""
+    return "; ".join(
+        f"{'.'.join(map(str, e['loc']))}: {e['msg']}" if e["loc"] else e["msg"]
+        for e in error.errors()
+    )
+
+
+async def run_batch_item(index, item, session, semaphore):
+    """일괄 요청의 항목 하나 처리 (검증 오류를 포함한 오류는 결과에 담아 반환)"""
+    try:
+        request = ChatRequest.model_validate(item)
+    except ValidationError as e:
+        return BatchItemResult(index=index, error=validation_detail(e), status_code=422)
+    span = current_span().child("batch.item", index=index)
+    async with semaphore:
+        try:
+            with span, use_span(span):
+                result = await run_chat(request, session)
+        except HTTPException as e:
+            return BatchItemResult(index=index, error=e.detail, status_code=e.status_code)
+    return BatchItemResult(index=index, **result.model_dump())
+
+
+@app.post("/api/chat/batch")
+async def chat_batch(http_request: Request, requests: list = Body(), stream: bool = False):
+    """여러 ChatRequest를 동시 실행 수 제한 안에서 함께 처리
+
+    기본은 요청 순서대로 모든 결과를 반환하고, stream=true이면 끝나는 순서대로
+    결과를 한 줄씩 NDJSON으로 보냅니다. 실패한 항목은 error와 status_code로 표시됩니다.
+    항목은 하나씩 검증하므로 형식이 잘못된 항목은 422 결과가 되고 나머지는 그대로 처리됩니다.
+    """
+    observe_parse(http_request)
+    if len(requests) > BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=413, detail=f"한 번에 최대 {BATCH_MAX_ITEMS}개까지 요청할 수 있습니다."
+        )
+    session = session_key(http_request)
+    semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+    
+    if not stream:
+        results = await asyncio.gather(*[
+            run_batch_item(index, request, session, semaphore)
+            for index, request in enumerate(requests)
+        ])
+        return {"results": results}
+    
+    async def ndjson_stream():
+        tasks = [
+            asyncio.create_task(run_batch_item(index, request, session, semaphore))
+            for index, request in enumerate(requests)
+        ]
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                result = await next_result
+                yield result.model_dump_json() + "\n"
+        finally:
+            # 클라이언트가 연결을 끊으면 남은 항목 취소
+            for task in tasks:
+                task.cancel()
+    
+    return StreamingResponse(ndjson_stream(), media_type="application/x-ndjson")
+
+
+@app.post("/api/chat/stream")
+async def chat_stream(request: ChatRequest, http_request: Request):
+    """토큰이 도착하는 대로 HTML 조각을 SSE로 전달하는 스트리밍 채팅 엔드포인트"""
+    observe_parse(http_request)
+    if not os.getenv("OPENAI_API_KEY") or client is None:
+        raise HTTPException(status_code=500, detail="OPENAI_API_KEY가 설정되지 않았습니다.")
+    
+    image_url = await prepare_request_image(request)
+    api_params, model_to_use = build_api_params(request, image_url)
+    request_key = make_cache_key(api_params)
+    use_cache, cached_text = lookup_cache(request, api_params, request_key)
+    session = session_key(http_request)
+    
+    async def event_stream():
+        if cached_text is not None:
+            yield sse_event({"delta": to_html(cached_text)})
+            yield sse_event({"model": model_to_use, "cached": True}, event="done")
+            return
+        
+        formatter = IncrementalHtmlFormatter()
+        postprocess = Stopwatch()
+        try:
+            # 같은 요청이 진행 중이면 지금까지의 delta부터 재생받아 합류
+            async for delta in subscribe_upstream(
+                api_params, request_key, use_cache, stream=True, session=session
+            ):
+                with postprocess:
+                    fragment = formatter.feed(delta)
+                if fragment:
+                    yield sse_event({"delta": fragment})
+            with postprocess:
+                fragment = formatter.finish()
+            chat_metrics.observe("postprocess", postprocess.elapsed)
+            current_span().record("postprocess", postprocess.elapsed)
+            yield sse_event({"delta": fragment})
+            yield sse_event({"model": model_to_use}, event="done")
+        except CircuitOpenError as e:
+            yield sse_event({"detail": str(e), "retry_after": round(e.retry_after, 1)}, event="error")
+        except Exception as e:
+            yield sse_event({"detail": f"API 오류: {str(e)}"}, event="error")
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+def get_conversation_or_404(conversation_id):
+    """저장된 대화 반환 (없거나 만료되었으면 404)"""
+    conversation = get_conversation_store().get(conversation_id)
+    if conversation is None:
+        raise HTTPException(status_code=404, detail="대화를 찾을 수 없습니다. 새 대화를 만들어주세요.")
+    return conversation
+
+
+@asynccontextmanager
+async def conversation_turn(conversation):
+    """대화 잠금을 잡고 턴을 진행할 대화 객체를 반환
+
+    잠금을 기다리는 사이 대화가 메모리에서 밀려나 다른 요청이 디스크에서 다시 읽었으면
+    저장소의 현재 객체를 잠급니다. 잠긴 대화는 메모리에서 내려가지 않으므로 같은 대화의
+    턴은 항상 같은 객체에서 순서대로 진행되고, 서로의 기록을 덮어쓰지 않습니다.
+    """
+    while True:
+        await conversation.lock.acquire()
+        current = get_conversation_store().current(conversation)
+        if current is conversation:
+            break
+        conversation.lock.release()
+        conversation = current
+    try:
+        yield conversation
+    finally:
+        conversation.lock.release()
+
+
+def build_conversation_params(conversation, user_message):
+    """저장된 대화에 새 메시지를 더해 API 파라미터 구성 (요약과 입력 토큰 예산 적용)"""
+    settings = conversation.settings
+    system_prompt = SYSTEM_PROMPT
+    history = conversation.messages + [user_message]
+    if settings["summarize"]:
+        system_prompt, history = conversation.summary.apply(SYSTEM_PROMPT, history)
+    context_messages, _ = context_window.fit(system_prompt, history)
+    messages = [{"role": "system", "content": system_prompt}] + context_messages
+    
+    # 이미지가 포함되어 있으면 Vision API 사용 (gpt-4o)
+    model_to_use = "gpt-4o" if has_image(context_messages) else settings["model"]
+    api_params = make_api_params(
+        model_to_use, messages, settings["temperature"], settings["max_completion_tokens"]
+    )
+    # 같은 대화의 요청은 같은 프롬프트 캐시로 보내 이전 턴(공통 앞부분)을 재사용
+    api_params["prompt_cache_key"] = conversation.id
+    return api_params, model_to_use
+
+
+async def finish_turn(conversation, user_message, response_text):
+    """성공한 턴만 대화에 기록하고, 필요하면 오래된 턴 요약을 백그라운드에서 시작"""
+    conversation.append(user_message, {"role": "assistant", "content": clean_text(response_text)})
+    await asyncio.to_thread(get_conversation_store().save, conversation)
+    if conversation.settings["summarize"]:
+        task = asyncio.create_task(summarize_conversation(conversation))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+
+async def summarize_conversation(conversation):
+    """응답 전달 후 오래된 턴을 요약하고 대화에 기록"""
+    report = await summarizer.summarize_async(
+        client, conversation.summary, list(conversation.messages)
+    )
+    if report is not None:
+        async with conversation.lock:
+            # 요약하는 사이 메모리에서 밀려나 다시 읽힌 대화이면 저장하지 않음 (새 턴을 덮어쓰지 않도록)
+            if get_conversation_store().current(conversation) is conversation:
+                await asyncio.to_thread(get_conversation_store().save, conversation)
+
+
+@app.post("/api/images")
+async def upload_image(http_request: Request):
+    """이미지를 base64 없이 업로드 (본문이 이미지 바이트 그대로이거나 multipart의 image 필드)
+
+    받는 동안 SHA-256을 계산하고 크기 한도를 넘으면 바로 중단합니다. 처리된 이미지는
+    반환된 image_id로 채팅 요청에서 참조하며, 같은 이미지를 다시 올리면 처리를 건너뜁니다.
+    """
+    try:
+        spool = await receive_image(http_request)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    observe_parse(http_request)
+    try:
+        image_id = spool.digest
+        if image_uploads.touch(image_id):
+            return {"image_id": image_id, "deduplicated": True, "expires_in": image_uploads.ttl}
+        data = spool.getvalue()
+    finally:
+        spool.close()
+    
+    span = current_span().child("image", input_bytes=len(data))
+    try:
+        with chat_metrics.stage("image"), span, use_span(span):
+            processed = await asyncio.to_thread(prepare_image, data)
+            span.set_attribute("passthrough", processed.passthrough)
+    except INVALID_IMAGE_ERRORS as e:
+        raise HTTPException(status_code=400, detail=f"이미지 처리 오류: {str(e)}")
+    image_uploads.add(image_id, processed.data, processed.mime)
+    return {
+        "image_id": image_id,
+        "mime": processed.mime,
+        "width": processed.width,
+        "height": processed.height,
+        "bytes": processed.output_bytes,
+        "deduplicated": False,
+        "expires_in": image_uploads.ttl,
+    }
+
+
+@app.get("/api/images/stats")
+async def image_upload_stats():
+    """업로드 이미지 통계"""
+    return image_uploads.snapshot()
+
+
+@app.post("/api/conversations")
+async def create_conversation(request: ConversationCreate):
+    """서버에 이력이 보관되는 새 대화 생성"""
+    conversation = await asyncio.to_thread(get_conversation_store().create, request.model_dump())
+    return {"conversation_id": conversation.id, **conversation.settings}
+
+
+@app.get("/api/conversations/stats")
+async def conversation_stats():
+    """대화 저장소 통계 (메모리에 있는 대화 수, 디스크 로드/축출 횟수)"""
+    return get_conversation_store().snapshot()
+
+
+@app.get("/api/conversations/{conversation_id}")
+async def get_conversation(conversation_id: str):
+    """대화 이력 조회 (이미지는 자리표시자로 표시)"""
+    conversation = get_conversation_or_404(conversation_id)
+    return {
+        "conversation_id": conversation.id,
+        **conversation.settings,
+        "messages": [
+            {"role": m["role"], "content": message_text(m)} for m in conversation.messages
+        ],
+        "summary": conversation.summary.to_dict(),
+        "summary_report": conversation.summary.last_report,
+    }
+
+
+@app.delete("/api/conversations/{conversation_id}")
+async def delete_conversation(conversation_id: str):
+    """대화 삭제"""
+    if not await asyncio.to_thread(get_conversation_store().delete, conversation_id):
+        raise HTTPException(status_code=404, detail="대화를 찾을 수 없습니다.")
+    return {"deleted": True}
+
+
+@app.post("/api/conversations/{conversation_id}/messages", response_model=ChatResponse)
+async def send_conversation_message(conversation_id: str, request: ConversationMessage, http_request: Request):
+    """대화에 새 메시지만 보내고 응답 받기 (이전 이력은 서버에 보관)"""
+    observe_parse(http_request)
+    if not os.getenv("OPENAI_API_KEY") or client is None:
+        raise HTTPException(status_code=500, detail="OPENAI_API_KEY가 설정되지 않았습니다.")
+    
+    conversation = get_conversation_or_404(conversation_id)
+    image_url = await prepare_request_image(request)
+    user_message = {"role": "user", "content": build_user_content(request.message, image_url)}
+    try:
+        # 같은 대화의 턴은 순서대로 처리
+        async with conversation_turn(conversation) as conversation:
+            api_params, model_to_use = build_conversation_params(conversation, user_message)
+            response_text = "".join([
+                delta async for delta in upstream_deltas(api_params, session=conversation.id)
+            ])
+            await finish_turn(conversation, user_message, response_text)
+    except CircuitOpenError as e:
+        raise upstream_unavailable(e)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"API 오류: {str(e)}")
+    
+    with chat_metrics.stage("postprocess"), current_span().child("postprocess"):
+        html_content = to_html(response_text)
+    return ChatResponse(response=html_content, model=model_to_use)
+
+
+@app.post("/api/conversations/{conversation_id}/messages/stream")
+async def stream_conversation_message(conversation_id: str, request: ConversationMessage, http_request: Request):
+    """대화에 새 메시지만 보내고 응답을 SSE로 받기 (이벤트 형식은 /api/chat/stream과 동일)"""
+    observe_parse(http_request)
+    if not os.getenv("OPENAI_API_KEY") or client is None:
+        raise HTTPException(status_code=500, detail="OPENAI_API_KEY가 설정되지 않았습니다.")
+    
+    conversation = get_conversation_or_404(conversation_id)
+    image_url = await prepare_request_image(request)
+    user_message = {"role": "user", "content": build_user_content(request.message, image_url)}
+    
+    async def event_stream():
+        formatter = IncrementalHtmlFormatter()
+        postprocess = Stopwatch()
+        deltas = []
+        try:
+            # 같은 대화의 턴은 순서대로 처리 (중간에 연결이 끊기면 이력에 남기지 않음)
+            async with conversation_turn(conversation) as current:
+                api_params, model_to_use = build_conversation_params(current, user_message)
+                async for delta in upstream_deltas(api_params, stream=True, session=current.id):
+                    deltas.append(delta)
+                    with postprocess:
+                        fragment = formatter.feed(delta)
+                    if fragment:
+                        yield sse_event({"delta": fragment})
+                with postprocess:
+                    fragment = formatter.finish()
+                chat_metrics.observe("postprocess", postprocess.elapsed)
+                current_span().record("postprocess", postprocess.elapsed)
+                yield sse_event({"delta": fragment})
+                await finish_turn(current, user_message, "".join(deltas))
+            yield sse_event({"model": model_to_use, "conversation_id": current.id}, event="done")
+        except CircuitOpenError as e:
+            yield sse_event({"detail": str(e), "retry_after": round(e.retry_after, 1)}, event="error")
+        except Exception as e:
+            yield sse_event({"detail": f"API 오류: {str(e)}"}, event="error")
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.get("/api/cache/stats")
+async def cache_stats():
+    """응답 캐시 적중/미스 통계"""
+    return get_response_cache().snapshot()
+
+
+@app.get("/api/coalesce/stats")
+async def coalesce_stats():
+    """동일 요청 합치기 통계 (coalesced = 절약한 업스트림 호출 수)"""
+    return coalescer.snapshot()
+
+
+@app.get("/api/admission/stats")
+async def admission_stats():
+    """입장 제어 통계 (실행 중 가중치, 대기열 길이, 대기 시간, 거절 횟수)"""
+    return admission.snapshot()
+
+
+@app.get("/api/scheduler/stats")
+async def scheduler_stats():
+    """세션별 공정 큐 상태와 세션별 대기 시간"""
+    return scheduler.snapshot()
+
+
+@app.get("/api/ratelimit/stats")
+async def ratelimit_stats():
+    """업스트림 속도 조절 상태 (모델별 분당 한도와 남은 양, 미리 기다린 횟수)"""
+    return get_rate_limiter(os.getenv("OPENAI_API_KEY")).snapshot()
+
+
+@app.get("/api/upstream/stats")
+async def upstream_stats():
+    """업스트림 서킷 브레이커 상태 (closed/open/half_open)"""
+    return get_circuit_breaker().snapshot()
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus 형식 메트릭 (요청 수, 단계별 지연 시간 히스토그램, 모델별 토큰 수, 진행 중 요청 수)"""
+    return Response(render_metrics(), headers={"Content-Type": CONTENT_TYPE})
+
+
+def require_debug_token(x_debug_token: str = Header(None)):
+    """디버그 엔드포인트 보호 (DEBUG_TOKEN이 없으면 존재하지 않는 것처럼 404)"""
+    if not DEBUG_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not check_debug_token(x_debug_token):
+        raise HTTPException(status_code=403, detail="디버그 토큰이 올바르지 않습니다.")
+
+
+def profile_response(profile, fmt):
+    """collapsed stack 텍스트 또는 요약과 함께 JSON으로 반환"""
+    if fmt == "json":
+        return {**profile.summary(), "collapsed": profile.collapsed()}
+    return PlainTextResponse(profile.collapsed())
+
+
+@app.get("/debug/profile", dependencies=[Depends(require_debug_token)])
+async def debug_profile(
+    seconds: float = Query(10, gt=0, le=PROFILE_MAX_SECONDS),
+    interval_ms: float = Query(PROFILE_INTERVAL_MS, ge=1, le=1000),
+    idle: bool = False,
+    fmt: str = Query("collapsed", alias="format", pattern="^(collapsed|json)$"),
+):
+    """실행 중인 워커를 seconds초 동안 샘플링해 collapsed stack으로 반환 (이벤트 루프 멈춤 포함)"""
+    profile = await capture(seconds, interval_ms, include_idle=idle)
+    if profile is None:
+        raise HTTPException(status_code=409, detail="이미 프로파일을 수집하는 중입니다.")
+    return profile_response(profile, fmt)
+
+
+@app.get("/debug/profile/{request_id}", dependencies=[Depends(require_debug_token)])
+async def debug_request_profile(
+    request_id: str,
+    fmt: str = Query("collapsed", alias="format", pattern="^(collapsed|json)$"),
+):
+    """X-Profile 헤더로 프로파일한 요청의 결과 조회"""
+    profile = get_request_profile(request_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="프로파일을 찾을 수 없습니다.")
+    return profile_response(profile, fmt)
+
+
 @app.get("/health")
 async def health_check():
     """헬스 체크 엔드포인트"""
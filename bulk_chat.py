@@ -0,0 +1,246 @@
+"""JSONL 대량 처리 CLI
+
+입력 파일의 각 줄은 ChatRequest 형식의 JSON 객체입니다 (선택적으로 "id" 포함).
+/api/chat과 같은 경로(시스템 프롬프트, 캐시, 재시도, 응답 정리)로 처리한 결과를
+출력 파일에 한 줄씩 추가합니다. 중간에 멈춰도 같은 명령을 다시 실행하면 이미
+성공한 줄은 건너뛰고 이어서 처리합니다.
+
+    python bulk_chat.py prompts.jsonl results.jsonl --workers 8 --rpm 300
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from fastapi import HTTPException
+from pydantic import ValidationError
+import app_enhanced
+from app_enhanced import ChatRequest, run_chat
+
+# 진행 상황 출력 간격 (초)
+PROGRESS_INTERVAL = 5.0
+
+# 체크포인트 저장 간격 (처리한 줄 수)
+CHECKPOINT_EVERY = 50
+
+# 입력 id로 쓸 수 있는 타입 (이미 처리한 id를 집합으로 비교하므로 리스트/객체는 안 됨)
+ID_TYPES = (str, int, float)
+
+
+def count_lines(path):
+    """파일을 메모리에 올리지 않고 줄 수 세기"""
+    lines = 0
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            lines += chunk.count(b"\n")
+    return lines
+
+
+def load_done_ids(output_path):
+    """출력 파일에서 이미 성공한 id 목록 (중간에 잘린 마지막 줄은 잘라냄)"""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "rb+") as f:
+        valid_end = 0
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                break
+            valid_end += len(line)
+            if row.get("error") is None and isinstance(row.get("id"), ID_TYPES):
+                done.add(row["id"])
+        f.truncate(valid_end)
+    return done
+
+
+def load_checkpoint(path):
+    """체크포인트 (이 위치 앞의 입력은 모두 처리됨)"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {"line": 0, "offset": 0}
+
+
+def save_checkpoint(path, line, offset):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"line": line, "offset": offset}, f)
+    os.replace(tmp_path, path)
+
+
+def read_rows(input_path, start_line, start_offset):
+    """(줄 번호, 다음 줄의 바이트 위치, 원문) 순회 (체크포인트 위치부터)"""
+    with open(input_path, "rb") as f:
+        f.seek(start_offset)
+        line_no = start_line
+        offset = start_offset
+        for raw in f:
+            offset += len(raw)
+            yield line_no, offset, raw
+            line_no += 1
+
+
+class Pacer:
+    """분당 요청 수 제한 (요청 시작 간격을 일정하게 유지)"""
+
+    def __init__(self, rpm):
+        self.interval = 60.0 / rpm if rpm else 0.0
+        self._next = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class Progress:
+    """처리량과 남은 시간 출력"""
+
+    def __init__(self, total, skipped):
+        self.total = total
+        self.skipped = skipped
+        self.succeeded = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self._last_print = 0.0
+
+    def update(self, ok, force=False):
+        if ok is not None:
+            if ok:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+        now = time.monotonic()
+        if not force and now - self._last_print < PROGRESS_INTERVAL:
+            return
+        self._last_print = now
+        processed = self.succeeded + self.failed
+        elapsed = now - self.started
+        rate = processed / elapsed if elapsed > 0 else 0.0
+        remaining = max(0, self.total - self.skipped - processed)
+        eta = f"{remaining / rate:,.0f}초" if rate > 0 else "-"
+        print(
+            f"[bulk] {self.skipped + processed:,}/{self.total:,} "
+            f"(성공 {self.succeeded:,}, 실패 {self.failed:,}, 건너뜀 {self.skipped:,}) "
+            f"{rate:.2f}건/초, 남은 시간 {eta}",
+            file=sys.stderr,
+            flush=True,
+        )
+
+
+async def process_row(line_no, raw):
+    """입력 한 줄을 처리해 출력 행 반환"""
+    row_id = line_no
+    try:
+        data = json.loads(raw)
+        row_id = data.pop("id", line_no)
+        if not isinstance(row_id, ID_TYPES):
+            raise ValueError("id는 문자열이나 숫자여야 합니다.")
+        request = ChatRequest(**data)
+    except (ValueError, TypeError, AttributeError, ValidationError) as e:
+        return {"id": row_id, "error": f"입력 오류: {e}", "status_code": 400}
+    try:
+        result = await run_chat(request, session="bulk")
+    except HTTPException as e:
+        return {"id": row_id, "error": e.detail, "status_code": e.status_code}
+    return {"id": row_id, "response": result.response, "model": result.model, "cached": result.cached, "error": None}
+
+
+async def run(args):
+    checkpoint_path = args.checkpoint or f"{args.output}.ckpt"
+    checkpoint = load_checkpoint(checkpoint_path)
+    done_ids = load_done_ids(args.output)
+    total = count_lines(args.input)
+    progress = Progress(total, skipped=checkpoint["line"])
+    pacer = Pacer(args.rpm)
+    queue = asyncio.Queue(maxsize=args.workers * 2)
+
+    # 순서와 관계없이 끝나는 대로 기록하고, 앞에서부터 연속으로 끝난 위치까지만 체크포인트
+    pending = {}  # line_no -> offset (처리 중이거나 끝났지만 앞줄이 남은 행)
+    finished = set()
+    frontier = {"line": checkpoint["line"], "offset": checkpoint["offset"], "since_save": 0}
+
+    def mark_finished(line_no):
+        finished.add(line_no)
+        while frontier["line"] in finished:
+            finished.discard(frontier["line"])
+            frontier["offset"] = pending.pop(frontier["line"])
+            frontier["line"] += 1
+            frontier["since_save"] += 1
+        if frontier["since_save"] >= CHECKPOINT_EVERY:
+            frontier["since_save"] = 0
+            output.flush()
+            os.fsync(output.fileno())
+            save_checkpoint(checkpoint_path, frontier["line"], frontier["offset"])
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            line_no, raw = item
+            await pacer.wait()
+            result = await process_row(line_no, raw)
+            output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            # 줄마다 OS로 넘겨 프로세스가 죽어도 결과가 남도록 함 (fsync는 체크포인트마다)
+            output.flush()
+            mark_finished(line_no)
+            progress.update(result["error"] is None)
+
+    with open(args.output, "a", encoding="utf-8") as output:
+        async with app_enhanced.lifespan(app_enhanced.app):
+            if app_enhanced.client is None:
+                raise SystemExit("OPENAI_API_KEY가 설정되지 않았습니다.")
+            # 이 프로세스의 유일한 사용자이므로 업스트림 동시 호출 수를 워커 수에 맞춤
+            app_enhanced.scheduler.max_concurrency = args.workers
+            workers = [asyncio.create_task(worker()) for _ in range(args.workers)]
+            for line_no, offset, raw in read_rows(args.input, checkpoint["line"], checkpoint["offset"]):
+                pending[line_no] = offset
+                row_id = line_no
+                if raw.strip():
+                    try:
+                        row_id = json.loads(raw).get("id", line_no)
+                    except (ValueError, AttributeError):
+                        pass
+                if not raw.strip() or (isinstance(row_id, ID_TYPES) and row_id in done_ids):
+                    # 빈 줄이나 이미 성공한 줄은 다시 요청하지 않음
+                    progress.skipped += 1
+                    mark_finished(line_no)
+                    continue
+                await queue.put((line_no, raw))
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+
+        output.flush()
+        os.fsync(output.fileno())
+        save_checkpoint(checkpoint_path, frontier["line"], frontier["offset"])
+    progress.update(None, force=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSONL 프롬프트를 /api/chat과 같은 방식으로 대량 처리")
+    parser.add_argument("input", help="입력 JSONL (한 줄에 ChatRequest 하나, 선택적으로 id)")
+    parser.add_argument("output", help="결과 JSONL (이어서 추가, 같은 id는 마지막 줄이 우선)")
+    parser.add_argument("--workers", type=int, default=8, help="동시 처리 수 (기본 8)")
+    parser.add_argument("--rpm", type=float, default=0, help="분당 최대 요청 수 (기본 제한 없음)")
+    parser.add_argument("--checkpoint", help="체크포인트 파일 경로 (기본 <output>.ckpt)")
+    args = parser.parse_args()
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        print("[bulk] 중단됨 - 같은 명령으로 다시 실행하면 이어서 처리합니다.", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import os
+from collections import namedtuple
+
+# 기본 설정 (환경 변수로 변경 가능)
+CONTEXT_MAX_INPUT_TOKENS = int(os.getenv("CONTEXT_MAX_INPUT_TOKENS", "16000"))
+CONTEXT_KEEP_RECENT_IMAGES = int(os.getenv("CONTEXT_KEEP_RECENT_IMAGES", "1"))
+
+# 메시지 하나당 역할/구분자 오버헤드, 이미지 한 장의 대략적인 토큰 수 (high detail 기준)
+MESSAGE_OVERHEAD_TOKENS = 4
+IMAGE_TOKENS = 765
+
+# 오래된 이미지를 대신할 텍스트
+IMAGE_PLACEHOLDER = "[이전 대화에서 첨부된 이미지]"
+
+_IMAGE_PART_TYPES = ("image_url", "input_image", "image_ref")
+
+ContextReport = namedtuple(
+    "ContextReport",
+    ["tokens_before", "tokens_after", "tokens_saved", "dropped_messages", "images_replaced"],
+)
+
+
+def estimate_tokens(text):
+    """텍스트 토큰 수를 빠르게 추정 (ASCII 약 4자당 1토큰, 한글 등은 글자당 1토큰)
+
+    UTF-8 길이와 문자 수의 차이로 멀티바이트 문자 수를 구하므로 문자를 하나씩 보지 않습니다.
+    """
+    if not text:
+        return 0
+    chars = len(text)
+    multibyte = (len(text.encode("utf-8")) - chars) // 2
+    return (chars - multibyte + 3) // 4 + multibyte
+
+
+def _is_image_part(part):
+    return part.get("type") in _IMAGE_PART_TYPES
+
+
+def _has_image(message):
+    content = message.get("content")
+    return isinstance(content, list) and any(_is_image_part(part) for part in content)
+
+
+def estimate_message_tokens(message):
+    """메시지 하나의 토큰 수 추정 (이미지는 장당 IMAGE_TOKENS)"""
+    content = message.get("content")
+    if isinstance(content, list):
+        tokens = 0
+        for part in content:
+            if _is_image_part(part):
+                tokens += IMAGE_TOKENS
+            else:
+                tokens += estimate_tokens(part.get("text", ""))
+    else:
+        tokens = estimate_tokens(content)
+    return tokens + MESSAGE_OVERHEAD_TOKENS
+
+
+def _replace_images(message):
+    """이미지 파트를 텍스트 자리표시자로 바꾼 메시지 사본"""
+    parts = []
+    for part in message["content"]:
+        if _is_image_part(part):
+            parts.append({"type": "text", "text": IMAGE_PLACEHOLDER})
+        else:
+            parts.append(part)
+    return {**message, "content": parts}
+
+
+class ContextWindow:
+    """시스템 프롬프트와 최근 대화만 입력 토큰 예산 안에 남기는 컨텍스트 관리자"""
+
+    def __init__(self, max_input_tokens=CONTEXT_MAX_INPUT_TOKENS,
+                 keep_recent_images=CONTEXT_KEEP_RECENT_IMAGES):
+        self.max_input_tokens = max_input_tokens
+        self.keep_recent_images = keep_recent_images
+
+    def fit(self, system_prompt, messages):
+        """예산에 맞춘 메시지 목록과 ContextReport를 반환
+
+        최근 keep_recent_images개의 이미지 메시지를 제외한 이미지는 자리표시자로
+        바뀌고, 예산을 넘는 오래된 메시지는 버립니다. 마지막 메시지는 항상 남깁니다.
+        """
+        system_tokens = estimate_tokens(system_prompt) + MESSAGE_OVERHEAD_TOKENS
+        tokens_before = system_tokens + sum(estimate_message_tokens(m) for m in messages)
+
+        budget = self.max_input_tokens - system_tokens
+        kept = []
+        images_seen = 0
+        images_replaced = 0
+        for index in range(len(messages) - 1, -1, -1):
+            message = messages[index]
+            replaced = False
+            if _has_image(message):
+                images_seen += 1
+                if images_seen > self.keep_recent_images:
+                    message = _replace_images(message)
+                    replaced = True
+            tokens = estimate_message_tokens(message)
+            if kept and tokens > budget:
+                break
+            budget -= tokens
+            kept.append(message)
+            images_replaced += replaced
+        kept.reverse()
+
+        # 버린 메시지 이후가 assistant 응답으로 시작하지 않도록 정리
+        while len(kept) > 1 and len(kept) < len(messages) and kept[0]["role"] == "assistant":
+            budget += estimate_message_tokens(kept.pop(0))
+
+        tokens_after = self.max_input_tokens - budget
+        report = ContextReport(
+            tokens_before=tokens_before,
+            tokens_after=tokens_after,
+            tokens_saved=tokens_before - tokens_after,
+            dropped_messages=len(messages) - len(kept),
+            images_replaced=images_replaced,
+        )
+        return kept, report
@@ -0,0 +1,247 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from summarizer import RollingSummary
+
+# 기본 설정 (환경 변수로 변경 가능)
+CONVERSATION_STORE_PATH = os.getenv("CONVERSATION_STORE_PATH", ".cache/conversations.sqlite3")
+CONVERSATION_TTL = float(os.getenv("CONVERSATION_TTL", str(7 * 24 * 3600)))
+CONVERSATION_MAX_ACTIVE = int(os.getenv("CONVERSATION_MAX_ACTIVE", "256"))
+CONVERSATION_MAX_BYTES = int(os.getenv("CONVERSATION_MAX_BYTES", str(64 * 1024 * 1024)))
+CONVERSATION_MAX_MESSAGES = int(os.getenv("CONVERSATION_MAX_MESSAGES", "200"))
+CONVERSATION_DISK_MAX_ENTRIES = int(os.getenv("CONVERSATION_DISK_MAX_ENTRIES", "10000"))
+
+
+class Conversation:
+    """서버에 보관되는 대화 하나
+
+    messages에는 API 형식의 메시지(이미지는 전처리된 data URL)가 순서대로 쌓이고,
+    lock으로 같은 대화의 턴이 동시에 진행되지 않도록 합니다.
+    """
+
+    def __init__(self, conversation_id, settings, messages=None, summary=None,
+                 created_at=None, updated_at=None):
+        now = time.time()
+        self.id = conversation_id
+        self.settings = settings
+        self.messages = messages or []
+        self.summary = summary or RollingSummary()
+        self.created_at = created_at or now
+        self.updated_at = updated_at or now
+        self.lock = asyncio.Lock()
+
+    def append(self, *messages, max_messages=CONVERSATION_MAX_MESSAGES):
+        """메시지를 추가하고, 최대 개수를 넘으면 오래된 메시지부터 삭제"""
+        self.messages.extend(messages)
+        excess = len(self.messages) - max_messages
+        if excess > 0 and self.summary.shift(excess):
+            del self.messages[:excess]
+        self.updated_at = time.time()
+
+    def to_json(self):
+        return json.dumps({
+            "settings": self.settings,
+            "messages": self.messages,
+            "summary": self.summary.to_dict(),
+            "created_at": self.created_at,
+        }, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, conversation_id, value, updated_at):
+        data = json.loads(value)
+        return cls(
+            conversation_id,
+            data["settings"],
+            messages=data["messages"],
+            summary=RollingSummary.from_dict(data["summary"]),
+            created_at=data["created_at"],
+            updated_at=updated_at,
+        )
+
+
+class ConversationStore:
+    """메모리 LRU + SQLite 2단계 대화 저장소
+
+    최근에 쓴 대화만 개수와 바이트 크기 한도 안에서 메모리에 두고,
+    모든 변경은 SQLite에 기록되므로 메모리에서 밀려나거나 재시작해도 이어갈 수 있습니다.
+    마지막 사용 후 TTL이 지난 대화는 삭제됩니다.
+    """
+
+    def __init__(self, path=None, ttl=CONVERSATION_TTL,
+                 max_active=CONVERSATION_MAX_ACTIVE,
+                 max_bytes=CONVERSATION_MAX_BYTES,
+                 disk_max_entries=CONVERSATION_DISK_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_active = max_active
+        self.max_bytes = max_bytes
+        self.disk_max_entries = disk_max_entries
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # id -> (conversation, size)
+        self._memory_bytes = 0
+        self._writes_since_prune = 0
+        self.stats = {
+            "created": 0,
+            "memory_hits": 0,
+            "disk_loads": 0,
+            "misses": 0,
+            "saves": 0,
+            "evictions": 0,
+            "expired": 0,
+        }
+        self._db = None
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                "id TEXT PRIMARY KEY, value TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS conversations_updated_at ON conversations (updated_at)"
+            )
+
+    def create(self, settings):
+        """새 대화를 만들어 저장"""
+        conversation = Conversation(uuid.uuid4().hex, settings)
+        self.save(conversation)
+        with self._lock:
+            self.stats["created"] += 1
+        return conversation
+
+    def get(self, conversation_id):
+        """대화 반환 (없거나 만료되면 None)"""
+        expired_before = time.time() - self.ttl
+        with self._lock:
+            entry = self._memory.get(conversation_id)
+            if entry is not None:
+                if entry[0].updated_at > expired_before:
+                    self._memory.move_to_end(conversation_id)
+                    self.stats["memory_hits"] += 1
+                    return entry[0]
+                self._evict_memory(conversation_id)
+                self._delete_disk(conversation_id)
+                self.stats["expired"] += 1
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, updated_at FROM conversations WHERE id = ?", (conversation_id,)
+                ).fetchone()
+                if row is not None:
+                    value, updated_at = row
+                    if updated_at > expired_before:
+                        conversation = Conversation.from_json(conversation_id, value, updated_at)
+                        self._store_memory(conversation, len(value.encode("utf-8")))
+                        self.stats["disk_loads"] += 1
+                        return conversation
+                    self._delete_disk(conversation_id)
+                    self.stats["expired"] += 1
+
+            self.stats["misses"] += 1
+            return None
+
+    def current(self, conversation):
+        """메모리에 있는 같은 id의 대화 객체 반환
+
+        메모리에서 밀려난 뒤 아무도 다시 읽지 않았으면 conversation을 다시 올리고 그대로 반환합니다.
+        반환값이 conversation과 다르면 다른 요청이 디스크에서 다시 읽은 객체가 최신입니다.
+        """
+        with self._lock:
+            entry = self._memory.get(conversation.id)
+            if entry is not None:
+                return entry[0]
+            self._store_memory(conversation, len(conversation.to_json().encode("utf-8")))
+            return conversation
+
+    def save(self, conversation):
+        """대화의 현재 상태를 기록 (턴이 끝날 때마다 호출)"""
+        value = conversation.to_json()
+        with self._lock:
+            self._store_memory(conversation, len(value.encode("utf-8")))
+            self.stats["saves"] += 1
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO conversations (id, value, updated_at) VALUES (?, ?, ?)",
+                    (conversation.id, value, conversation.updated_at),
+                )
+                self._writes_since_prune += 1
+                if self._writes_since_prune >= 256:
+                    self._prune_disk()
+
+    def delete(self, conversation_id):
+        """대화 삭제 (존재했으면 True)"""
+        with self._lock:
+            found = conversation_id in self._memory
+            if found:
+                self._evict_memory(conversation_id)
+            if self._db is not None:
+                found = self._delete_disk(conversation_id) or found
+            return found
+
+    def snapshot(self):
+        """메모리에 있는 대화 수와 크기, 적중/로드 카운터"""
+        with self._lock:
+            return {
+                **self.stats,
+                "active": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+            }
+
+    def _store_memory(self, conversation, size):
+        if conversation.id in self._memory:
+            self._evict_memory(conversation.id)
+        if size > self.max_bytes:
+            return
+        self._memory[conversation.id] = (conversation, size)
+        self._memory_bytes += size
+        while len(self._memory) > self.max_active or self._memory_bytes > self.max_bytes:
+            # 턴이 진행 중인 대화는 내리지 않음 (다시 읽으면 다른 객체가 되므로)
+            victim = next((key for key, (c, _) in self._memory.items() if not c.lock.locked()), None)
+            if victim is None:
+                break
+            self._evict_memory(victim)
+            self.stats["evictions"] += 1
+
+    def _evict_memory(self, conversation_id):
+        _, size = self._memory.pop(conversation_id)
+        self._memory_bytes -= size
+
+    def _delete_disk(self, conversation_id):
+        if self._db is None:
+            return False
+        cursor = self._db.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+        return cursor.rowcount > 0
+
+    def _prune_disk(self):
+        """만료된 대화와 용량을 넘는 오래된 대화를 디스크에서 삭제"""
+        self._writes_since_prune = 0
+        self._db.execute(
+            "DELETE FROM conversations WHERE updated_at <= ?", (time.time() - self.ttl,)
+        )
+        self._db.execute(
+            "DELETE FROM conversations WHERE id IN ("
+            "SELECT id FROM conversations ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+            (self.disk_max_entries,),
+        )
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_conversation_store():
+    """프로세스 전체에서 공유하는 대화 저장소 반환"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = ConversationStore(path=CONVERSATION_STORE_PATH)
+    return _store
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+# 기본 설정 (환경 변수로 변경 가능)
+FAIR_MAX_CONCURRENCY = int(os.getenv("FAIR_MAX_CONCURRENCY", "16"))
+FAIR_QUANTUM = int(os.getenv("FAIR_QUANTUM", "2000"))
+
+# 대기 시간 통계를 보관할 최대 세션 수 (오래 쓰지 않은 세션부터 삭제)
+_MAX_TRACKED_SESSIONS = 1000
+
+
+class _Waiter:
+    __slots__ = ("cost", "future")
+
+    def __init__(self, cost, future):
+        self.cost = cost
+        self.future = future
+
+
+class FairScheduler:
+    """세션별 가중 공정 큐 (예상 토큰 수 기준 deficit round-robin)
+
+    업스트림 동시 호출 수를 max_concurrency로 제한하고, 자리가 나면 세션을
+    돌아가며 quantum만큼 적립한 몫 안에서 요청을 내보냅니다. 큰 이미지나 긴 대화를
+    보내는 세션이 대기열을 채워도 짧은 텍스트 요청을 보내는 다른 세션은 자기 차례에
+    바로 나갈 수 있습니다. 한 이벤트 루프 안에서만 사용합니다.
+    """
+
+    def __init__(self, max_concurrency=FAIR_MAX_CONCURRENCY, quantum=FAIR_QUANTUM):
+        self.max_concurrency = max_concurrency
+        self.quantum = quantum
+        self._active = 0
+        self._queues = {}  # session -> deque[_Waiter]
+        self._deficit = {}
+        self._ring = deque()  # 대기 중인 세션의 순회 순서
+        self._sessions = OrderedDict()  # session -> 대기 시간 통계
+
+    @asynccontextmanager
+    async def slot(self, session, cost):
+        """차례가 올 때까지 기다린 뒤 업스트림 호출 자리 하나를 차지 (대기한 초를 반환)"""
+        started = time.monotonic()
+        await self._acquire(session, max(1, cost))
+        waited = time.monotonic() - started
+        self._record(session, waited)
+        try:
+            yield waited
+        finally:
+            self._active -= 1
+            self._dispatch()
+
+    async def _acquire(self, session, cost):
+        if self._active < self.max_concurrency and not self._ring:
+            self._active += 1
+            return
+        waiter = _Waiter(cost, asyncio.get_running_loop().create_future())
+        if session not in self._queues:
+            self._queues[session] = deque()
+            self._deficit[session] = 0
+            self._ring.append(session)
+        self._queues[session].append(waiter)
+        self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            # 자리를 받은 직후 취소되었으면 반납 (아직 대기 중이면 dispatch가 건너뜀)
+            if waiter.future.done() and not waiter.future.cancelled():
+                self._active -= 1
+                self._dispatch()
+            raise
+
+    def _dispatch(self):
+        while self._active < self.max_concurrency and self._ring:
+            session = self._ring[0]
+            queue = self._queues[session]
+            while queue and queue[0].future.done():
+                queue.popleft()
+            if not queue:
+                self._ring.popleft()
+                del self._queues[session]
+                del self._deficit[session]
+                continue
+            waiter = queue[0]
+            if self._deficit[session] < waiter.cost:
+                # 이번 차례의 몫으로 부족하면 적립만 하고 다음 세션으로
+                self._deficit[session] += self.quantum
+                self._ring.rotate(-1)
+                continue
+            queue.popleft()
+            self._deficit[session] -= waiter.cost
+            self._active += 1
+            waiter.future.set_result(None)
+
+    def _record(self, session, waited):
+        stats = self._sessions.pop(session, None) or {"requests": 0, "wait_total": 0.0, "wait_max": 0.0}
+        stats["requests"] += 1
+        stats["wait_total"] += waited
+        stats["wait_max"] = max(stats["wait_max"], waited)
+        stats["last_wait"] = waited
+        self._sessions[session] = stats
+        while len(self._sessions) > _MAX_TRACKED_SESSIONS:
+            self._sessions.popitem(last=False)
+        if waited >= 0.01:
+            logger.info("fair queue: session=%s waited %.0fms", session, waited * 1000)
+
+    def snapshot(self):
+        """진행/대기 중인 호출 수와 세션별 대기 시간 (최근에 요청한 세션부터)"""
+        sessions = {}
+        for session in reversed(self._sessions):
+            stats = self._sessions[session]
+            sessions[session] = {
+                "requests": stats["requests"],
+                "queued": len(self._queues.get(session, ())),
+                "wait_ms_avg": round(stats["wait_total"] / stats["requests"] * 1000, 1),
+                "wait_ms_max": round(stats["wait_max"] * 1000, 1),
+                "wait_ms_last": round(stats["last_wait"] * 1000, 1),
+            }
+        return {
+            "active": self._active,
+            "max_concurrency": self.max_concurrency,
+            "queued": sum(len(queue) for queue in self._queues.values()),
+            "sessions": sessions,
+        }
@@ -1,17 +1,57 @@
 import gradio as gr
+import asyncio
 import os
-import re
-import base64
-from io import BytesIO
-from PIL import Image
-from openai import OpenAI
+import time
+import httpx
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
+from text_format import IncrementalCleaner
+from image_pipeline import prepare_image_file, to_data_url
+from response_cache import get_response_cache, is_cacheable, make_cache_key
+from resilience import RetryPolicy
+from rate_limit import estimate_request_tokens, get_rate_limiter, request_cost
+from fair_queue import FairScheduler
+from metrics import Stopwatch, get_chat_metrics, start_metrics_server
+from tracing import start_trace, use_span
 
 # 환경 변수 로드
 load_dotenv(override=False)
 
-# OpenAI 클라이언트 초기화
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# 동시 처리 설정 (이벤트당 동시 실행 수, 대기열 최대 길이, 업스트림 커넥션 수)
+CONCURRENCY_LIMIT = int(os.getenv("GRADIO_CONCURRENCY_LIMIT", "32"))
+QUEUE_MAX_SIZE = int(os.getenv("GRADIO_QUEUE_MAX_SIZE", "256"))
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "200"))
+
+# OpenAI 비동기 클라이언트 (첫 요청 시 Gradio 이벤트 루프 안에서 생성)
+_client = None
+
+# 업스트림 호출 재시도/서킷 브레이커 정책 (세 프론트엔드 공용)
+retry_policy = RetryPolicy()
+
+# 업스트림 호출 앞의 세션별 공정 큐 (예상 토큰 수 기준 deficit round-robin)
+scheduler = FairScheduler()
+
+# 요청 수/단계별 지연 시간/토큰 수 메트릭 (METRICS_PORT가 설정되면 그 포트의 /metrics로 노출)
+chat_metrics = get_chat_metrics("gradio")
+
+
+def get_client():
+    """풀링된 비동기 OpenAI 클라이언트 반환"""
+    global _client
+    if _client is None:
+        api_key = os.getenv("OPENAI_API_KEY")
+        _client = AsyncOpenAI(
+            api_key=api_key,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS),
+                timeout=httpx.Timeout(120.0, connect=10.0),
+                # x-ratelimit 헤더로 한도를 파악해 보내기 전에 속도 조절
+                event_hooks=get_rate_limiter(api_key).async_event_hooks(),
+            ),
+            # 재시도는 retry_policy가 담당하므로 클라이언트 자체 재시도는 끔
+            max_retries=0,
+        )
+    return _client
 
 # 시스템 프롬프트
 SYSTEM_PROMPT = """당신은 친절하고 도움이 되는 AI 어시스턴트입니다. 
@@ -24,71 +64,133 @@ SYSTEM_PROMPT = """당신은 친절하고 도움이 되는 AI 어시스턴트입
 5. 내용을 간결하고 흐름 있게 작성해주세요"""
 
 
-def encode_image(image_file):
-    """이미지를 base64로 인코딩"""
-    if image_file is None:
-        return None
-    with open(image_file, "rb") as image_file_obj:
-        return base64.b64encode(image_file_obj.read()).decode('utf-8')
-
-
-def chat_with_gpt(message, history, image):
-    """GPT와 채팅 (이미지 지원)"""
-    if not os.getenv("OPENAI_API_KEY"):
-        return "오류: API 키가 설정되지 않았습니다."
-    
-    # 이미지가 있으면 base64로 변환
-    image_base64 = None
-    if image is not None:
+async def chat_with_gpt(message, history, image, use_cache=False, session=None):
+    """GPT와 채팅 (이미지 지원) - 응답이 도착하는 대로 누적된 텍스트를 yield"""
+    trace = start_trace("gradio.chat", frontend="gradio", session=session)
+    with chat_metrics.request("chat") as timer, trace:
+        if not os.getenv("OPENAI_API_KEY"):
+            timer.status = "error"
+            trace.end("OPENAI_API_KEY not set")
+            yield "오류: API 키가 설정되지 않았습니다."
+            return
+        
+        # 이미지가 있으면 (규격을 벗어난 경우만 축소/재인코딩 후) base64로 변환
+        # CPU 작업이므로 이벤트 루프 밖에서 실행
+        image_base64 = None
+        if image is not None:
+            try:
+                span = trace.child("image")
+                with chat_metrics.stage("image"), span, use_span(span):
+                    processed = await asyncio.to_thread(prepare_image_file, image)
+                    image_base64 = to_data_url(processed)
+            except Exception as e:
+                timer.status = "error"
+                trace.end(f"{type(e).__name__}: {e}")
+                yield f"이미지 처리 중 오류: {str(e)}"
+                return
+        
+        # 메시지 구성 (이미지가 있으면 멀티모달 형식)
+        user_content = []
+        if image_base64:
+            # 이미지가 있으면 Vision API 사용 (gpt-4o)
+            user_content = [
+                {"type": "text", "text": message if message else "이 이미지를 분석해주세요."},
+                {"type": "image_url", "image_url": {"url": image_base64}}
+            ]
+            model_to_use = "gpt-4o"  # Vision API 지원 모델
+        else:
+            user_content = message
+            model_to_use = "gpt-5-mini"
+        
+        response_text = ""
         try:
-            # PIL Image를 base64로 변환
-            buffered = BytesIO()
-            image.save(buffered, format="PNG")
-            image_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-            image_base64 = f"data:image/png;base64,{image_base64}"
+            # API 파라미터 구성
+            api_params = {
+                "model": model_to_use,
+                "messages": [
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": user_content}
+                ],
+                "max_completion_tokens": 1000,
+                "stream": True,
+                "stream_options": {"include_usage": True}
+            }
+            # gpt-5-mini가 아닌 경우에만 temperature 전달
+            if model_to_use != "gpt-5-mini":
+                api_params["temperature"] = 0.7
+            
+            # 동일한 질문의 캐시된 응답이 있으면 바로 반환
+            cache_key = None
+            if is_cacheable(api_params, api_params["messages"], opt_in=use_cache):
+                cache_key = make_cache_key(api_params)
+                cached_text = get_response_cache().get(cache_key)
+                if cached_text is not None:
+                    yield cached_text
+                    return
+            
+            # 연속된 줄바꿈을 최대 2개로 제한하고, 불필요한 공백 제거 (청크 단위로 점진 적용)
+            # 세션별 공정 큐에서 차례를 기다린 뒤 호출하며,
+            # 첫 청크를 받기 전의 일시적인 오류는 retry_policy에 따라 재시도
+            cleaner = IncrementalCleaner()
+            postprocess = Stopwatch()
+            # 요청 ID는 업스트림 호출 헤더로 전달
+            cost = estimate_request_tokens(api_params)
+            async with scheduler.slot(session, cost) as waited:
+                chat_metrics.observe("queue", waited)
+                trace.record("queue", waited)
+                started = time.perf_counter()
+                with request_cost(model_to_use, cost), trace.child("upstream", **{"gen_ai.request.model": model_to_use, "stream": True}) as span:
+                    async for chunk in retry_policy.stream_async(
+                        get_client().chat.completions.create, **api_params, extra_headers=span.headers()
+                    ):
+                        # 마지막 청크는 choices 없이 usage만 담김
+                        if chunk.usage is not None:
+                            chat_metrics.record_usage(model_to_use, chunk.usage)
+                            span.set_usage(chunk.usage)
+                        if not chunk.choices or not chunk.choices[0].delta.content:
+                            continue
+                        if not postprocess.laps:
+                            chat_metrics.observe_since("ttft", started)
+                            span.add_event("first_token")
+                            span.set_attribute("gen_ai.response.id", chunk.id)
+                        with postprocess:
+                            fragment = cleaner.feed(chunk.choices[0].delta.content)
+                        if fragment:
+                            response_text += fragment
+                            yield response_text
+                    chat_metrics.observe_since("upstream", started)
+            
+            with postprocess:
+                response_text += cleaner.finish()
+            chat_metrics.observe("postprocess", postprocess.elapsed)
+            trace.record("postprocess", postprocess.elapsed)
+            if cache_key:
+                get_response_cache().set(cache_key, response_text)
+            yield response_text
+            
         except Exception as e:
-            return f"이미지 처리 중 오류: {str(e)}"
+            timer.status = "error"
+            trace.end(f"{type(e).__name__}: {e}")
+            yield f"오류가 발생했습니다: {str(e)}"
+
+
+# 전송 이벤트 핸들러
+# request는 Gradio가 주입 (세션별 공정 큐에 session_hash 사용)
+async def respond(message, history, image, use_cache=False, request: gr.Request = None):
+    if not message and image is None:
+        yield history, "", None
+        return
     
-    # 메시지 구성 (이미지가 있으면 멀티모달 형식)
-    user_content = []
-    if image_base64:
-        # 이미지가 있으면 Vision API 사용 (gpt-4o)
-        user_content = [
-            {"type": "text", "text": message if message else "이 이미지를 분석해주세요."},
-            {"type": "image_url", "image_url": {"url": image_base64}}
-        ]
-        model_to_use = "gpt-4o"  # Vision API 지원 모델
-    else:
-        user_content = message
-        model_to_use = "gpt-5-mini"
+    # 사용자 메시지 추가 후 바로 표시
+    user_msg = message if message else "이 이미지를 분석해주세요."
+    history = history + [[user_msg, None]]
+    yield history, "", None
     
-    try:
-        # API 파라미터 구성
-        api_params = {
-            "model": model_to_use,
-            "messages": [
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": user_content}
-            ],
-            "max_completion_tokens": 1000
-        }
-        # gpt-5-mini가 아닌 경우에만 temperature 전달
-        if model_to_use != "gpt-5-mini":
-            api_params["temperature"] = 0.7
-        
-        response = client.chat.completions.create(**api_params)
-        
-        # 응답 텍스트 가져오기
-        response_text = response.choices[0].message.content
-        
-        # 연속된 줄바꿈을 최대 2개로 제한하고, 불필요한 공백 제거
-        response_text = re.sub(r'\n{3,}', '\n\n', response_text)
-        response_text = response_text.strip()
-        
-        return response_text
-        
-    except Exception as e:
-        return f"오류가 발생했습니다: {str(e)}"
+    # 봇 응답을 스트리밍으로 생성
+    session = request.session_hash if request else None
+    async for partial in chat_with_gpt(user_msg, history[:-1], image, use_cache, session):
+        history[-1][1] = partial
+        yield history, "", None
 
 
 # Gradio 인터페이스 생성
@@ -122,36 +224,38 @@ with gr.Blocks(title="GPT Text Service", theme=gr.themes.Soft()) as demo:
     with gr.Row():
         image_input = gr.Image(
             label="이미지 첨부 (선택사항)",
-            type="pil",
+            type="filepath",
             sources=["upload", "clipboard"],
             height=200
         )
     
-    clear_btn = gr.Button("🗑️ 대화 기록 지우기", variant="secondary")
+    with gr.Row():
+        use_cache = gr.Checkbox(
+            label="동일한 질문에는 저장된 응답 사용 (캐시)",
+            value=False
+        )
+        clear_btn = gr.Button("🗑️ 대화 기록 지우기", variant="secondary")
     
     # 이벤트 핸들러
-    def respond(message, history, image):
-        if not message and image is None:
-            return history, "", None
-        
-        # 사용자 메시지 추가
-        user_msg = message if message else "이 이미지를 분석해주세요."
-        history = history + [[user_msg, None]]
-        
-        # 봇 응답 생성
-        response = chat_with_gpt(user_msg, history[:-1], image)
-        history[-1][1] = response
-        
-        return history, "", None
-    
-    msg.submit(respond, [msg, chatbot, image_input], [chatbot, msg, image_input])
-    submit_btn.click(respond, [msg, chatbot, image_input], [chatbot, msg, image_input])
+    # 전송 이벤트는 같은 동시 실행 한도를 공유
+    msg.submit(
+        respond, [msg, chatbot, image_input, use_cache], [chatbot, msg, image_input],
+        concurrency_limit=CONCURRENCY_LIMIT, concurrency_id="chat"
+    )
+    submit_btn.click(
+        respond, [msg, chatbot, image_input, use_cache], [chatbot, msg, image_input],
+        concurrency_limit=CONCURRENCY_LIMIT, concurrency_id="chat"
+    )
     
-    clear_btn.click(lambda: ([], None), None, [chatbot, image_input])
+    clear_btn.click(lambda: ([], None), None, [chatbot, image_input], queue=False)
+
+# 이벤트 대기열 설정 (가득 차면 새 요청은 즉시 거절)
+demo.queue(max_size=QUEUE_MAX_SIZE, default_concurrency_limit=CONCURRENCY_LIMIT)
 
 
 if __name__ == "__main__":
     import os
     port = int(os.environ.get("PORT", 7860))
+    start_metrics_server()
     demo.launch(server_name="0.0.0.0", server_port=port, share=False)
 
@@ -0,0 +1,201 @@
+import os
+import threading
+import time
+from image_store import IMAGE_REF_TYPE, materialize_content
+from tracing import current_span
+
+# 이미지를 업스트림 Files API에 한 번만 올리고 이후 요청에서는 file_id로 참조할지 여부
+# (Streamlit 앱 전용: Responses API는 input_image 파트로 file_id를 받지만 Chat Completions는 URL만 받음)
+IMAGE_FILE_REFS = os.getenv("IMAGE_FILE_REFS", "1") != "0"
+
+# 올린 파일의 보관 시간 (초, 업스트림은 이 시간이 지나면 파일을 삭제, 3600~2592000)
+IMAGE_FILE_TTL = int(os.getenv("IMAGE_FILE_TTL", str(24 * 3600)))
+
+# 만료까지 이 시간(초)보다 적게 남은 파일은 쓰지 않고 새로 올림 (요청 도중 만료되지 않도록)
+_EXPIRY_MARGIN = 300
+
+_EXTENSIONS = {"image/png": "png", "image/jpeg": "jpg", "image/webp": "webp", "image/gif": "gif"}
+
+
+class ImageFiles:
+    """이미지 SHA-256 -> 업스트림 file_id (같은 이미지는 한 번만 올리고 만료 전까지 재사용)
+
+    만료 시각은 업로드 시점 기준으로 로컬에서 추적해 만료가 가까우면 다시 올리고,
+    업스트림이 파일을 찾지 못하면 invalidate()로 지워 다음 요청에서 다시 올립니다.
+    Responses API를 쓰는 Streamlit 앱에서 사용합니다.
+    """
+
+    def __init__(self, ttl=IMAGE_FILE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._files = {}  # digest -> (file_id, 만료 시각)
+        self._uploading = {}  # digest -> 업로드 중인 threading.Lock
+        self.stats = {"uploads": 0, "reused": 0, "expired": 0, "invalidated": 0, "upload_errors": 0}
+
+    def _lookup(self, digest):
+        with self._lock:
+            entry = self._files.get(digest)
+            if entry is None:
+                return None
+            if entry[1] - _EXPIRY_MARGIN <= time.time():
+                del self._files[digest]
+                self.stats["expired"] += 1
+                return None
+            self.stats["reused"] += 1
+            return entry[0]
+
+    def _upload_params(self, digest, data, mime):
+        return {
+            "file": (f"{digest[:16]}.{_EXTENSIONS.get(mime, 'png')}", data, mime),
+            "purpose": "vision",
+            "expires_after": {"anchor": "created_at", "seconds": self.ttl},
+        }
+
+    def _remember(self, digest, file_id, expires_at, started, size):
+        with self._lock:
+            self._files[digest] = (file_id, expires_at)
+            self.stats["uploads"] += 1
+        current_span().record_since("image.file_upload", started, bytes=size)
+
+    def _failed(self):
+        with self._lock:
+            self.stats["upload_errors"] += 1
+
+    def file_id(self, client, digest, load, mime):
+        """digest 이미지의 file_id (없거나 만료가 가까우면 load()로 읽은 바이트를 올림)"""
+        file_id = self._lookup(digest)
+        if file_id:
+            return file_id
+        with self._lock:
+            uploading = self._uploading.setdefault(digest, threading.Lock())
+        # 같은 이미지를 여러 세션이 동시에 보내도 한 번만 올림
+        with uploading:
+            file_id = self._lookup(digest)
+            if file_id:
+                return file_id
+            started = time.perf_counter()
+            expires_at = time.time() + self.ttl
+            data = load()
+            try:
+                uploaded = client.files.create(**self._upload_params(digest, data, mime))
+                self._remember(digest, uploaded.id, expires_at, started, len(data))
+            except Exception:
+                self._failed()
+                raise
+            finally:
+                with self._lock:
+                    self._uploading.pop(digest, None)
+            return uploaded.id
+
+    def invalidate(self, file_ids):
+        """업스트림에서 찾을 수 없는 file_id를 지움 (다음 요청에서 다시 올림)"""
+        file_ids = set(file_ids)
+        with self._lock:
+            for digest in [d for d, (file_id, _) in self._files.items() if file_id in file_ids]:
+                del self._files[digest]
+                self.stats["invalidated"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.stats, "files": len(self._files)}
+
+
+def input_image_part(file_id):
+    """Responses API 요청용 file_id 이미지 파트"""
+    return {"type": "input_image", "file_id": file_id, "detail": "auto"}
+
+
+def responses_content(content):
+    """Chat Completions 형식의 콘텐츠 파트를 Responses API 형식으로 변환
+
+    text는 input_text로, image_url(data URL)은 image_url 문자열을 담은 input_image로 바꿉니다.
+    """
+    if not isinstance(content, list):
+        return content
+    converted = []
+    for part in content:
+        if part.get("type") == "text":
+            converted.append({"type": "input_text", "text": part["text"]})
+        elif part.get("type") == "image_url":
+            converted.append({"type": "input_image", "image_url": part["image_url"]["url"], "detail": "auto"})
+        else:
+            converted.append(part)
+    return converted
+
+
+def iter_file_ids(messages):
+    """메시지 목록이 참조하는 file_id를 순회"""
+    for message in messages:
+        content = message.get("content")
+        if not isinstance(content, list):
+            continue
+        for part in content:
+            if part.get("type") == "input_image" and part.get("file_id"):
+                yield part["file_id"]
+
+
+def is_missing_file_error(error, file_ids):
+    """업스트림이 참조한 파일을 찾지 못해 거절한 오류인지 (만료 전에 삭제된 경우 등)
+
+    다른 이유의 400/404까지 data URL로 다시 보내지 않도록, 오류 코드가 file_not_found이거나
+    메시지가 참조한 file_id를 언급하는 경우만 해당합니다.
+    """
+    if getattr(error, "status_code", None) not in (400, 404):
+        return False
+    message = str(error)
+    return getattr(error, "code", None) == "file_not_found" or any(file_id in message for file_id in file_ids)
+
+
+def reference_content(content, store, client, files=None):
+    """이미지 참조를 업로드한 파일의 file_id 파트로 변환한 Responses API 형식 콘텐츠
+
+    처음 보는 이미지만 올리며, 업로드에 실패한 이미지는 data URL로 보냅니다.
+    """
+    if not isinstance(content, list):
+        return content
+    files = files or get_image_files()
+    referenced = []
+    for part in content:
+        if part.get("type") != IMAGE_REF_TYPE:
+            referenced.append(part)
+            continue
+        ref = part[IMAGE_REF_TYPE]
+        try:
+            file_id = files.file_id(client, ref, lambda: store.get(ref), store.mime(ref))
+        except Exception:
+            referenced.extend(materialize_content([part], store))
+            continue
+        referenced.append(input_image_part(file_id))
+    return responses_content(referenced)
+
+
+def file_ref_fallback(key, original, files=None):
+    """업스트림이 파일을 찾지 못해 거절하면 참조한 file_id를 지우고 {key: original()}로 다시 보내게 하는 fallback
+
+    Streamlit 스트림 재시도(stream_openai_with_retry)에 사용합니다.
+    """
+    files = files or get_image_files()
+
+    def fallback(error, params):
+        file_ids = list(iter_file_ids(params[key]))
+        if not file_ids or not is_missing_file_error(error, file_ids):
+            return None
+        files.invalidate(file_ids)
+        current_span().add_event("image.file_missing", files=len(file_ids))
+        return {key: original()}
+
+    return fallback
+
+
+_files = None
+_files_lock = threading.Lock()
+
+
+def get_image_files():
+    """프로세스 전체에서 공유하는 업로드 파일 목록 반환"""
+    global _files
+    if _files is None:
+        with _files_lock:
+            if _files is None:
+                _files = ImageFiles()
+    return _files
@@ -0,0 +1,372 @@
+import base64
+import logging
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+from io import BytesIO
+from PIL import Image, ImageOps
+from tracing import current_span
+
+logger = logging.getLogger(__name__)
+
+# Vision 모델 타일 기준 크기 (긴 변 2048px, 짧은 변 768px 이하로 축소)
+IMAGE_MAX_LONG_SIDE = int(os.getenv("IMAGE_MAX_LONG_SIDE", "2048"))
+IMAGE_MAX_SHORT_SIDE = int(os.getenv("IMAGE_MAX_SHORT_SIDE", "768"))
+
+# 사진류 이미지의 인코딩 형식 (JPEG 또는 WEBP)과 품질
+IMAGE_PHOTO_FORMAT = os.getenv("IMAGE_PHOTO_FORMAT", "JPEG").upper()
+IMAGE_PHOTO_QUALITY = int(os.getenv("IMAGE_PHOTO_QUALITY", "85"))
+
+# 축소 샘플의 색상 수가 이 값 이하이면 선화/스크린샷으로 보고 PNG 유지
+LINE_ART_MAX_COLORS = 1024
+_SAMPLE_SIZE = (128, 128)
+
+# 타일 기준 크기 이하이고 이 크기 이하인 JPEG/PNG/WebP는 디코딩 없이 그대로 전송
+IMAGE_PASSTHROUGH_MAX_BYTES = int(os.getenv("IMAGE_PASSTHROUGH_MAX_BYTES", str(4 * 1024 * 1024)))
+
+_MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png", "GIF": "image/gif"}
+
+# 헤더 검사에 사용할 앞부분 크기 (JPEG EXIF가 길면 SOF가 뒤에 있을 수 있음)
+_HEADER_BYTES = 64 * 1024
+_HEADER_B64_CHARS = (_HEADER_BYTES + 2) // 3 * 4
+
+ProcessedImage = namedtuple(
+    "ProcessedImage",
+    ["data", "mime", "width", "height", "input_bytes", "output_bytes", "elapsed_ms", "passthrough"],
+    defaults=(False,),
+)
+
+# 잘못된 이미지 입력으로 생기는 오류 (base64 오류, 해석할 수 없는 형식, 픽셀 수 한도 초과)
+INVALID_IMAGE_ERRORS = (ValueError, OSError, Image.DecompressionBombError)
+
+# 헤더에서 읽은 이미지 정보 (compliant: 그대로 전송 가능한 형식인지)
+ImageHeader = namedtuple("ImageHeader", ["format", "width", "height", "compliant"])
+
+
+class PipelineStats:
+    """처리한 이미지 수, 입출력 바이트, 소요 시간 누계"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.images = 0
+        self.passthrough = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.elapsed_ms = 0.0
+
+    def record(self, processed):
+        with self._lock:
+            self.images += 1
+            self.passthrough += processed.passthrough
+            self.input_bytes += processed.input_bytes
+            self.output_bytes += processed.output_bytes
+            self.elapsed_ms += processed.elapsed_ms
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "images": self.images,
+                "passthrough": self.passthrough,
+                "input_bytes": self.input_bytes,
+                "output_bytes": self.output_bytes,
+                "elapsed_ms": round(self.elapsed_ms, 1),
+            }
+
+
+pipeline_stats = PipelineStats()
+
+
+def target_size(width, height):
+    """타일 기준에 맞춘 축소 크기 (확대하지 않음)"""
+    scale = min(
+        1.0,
+        IMAGE_MAX_LONG_SIDE / max(width, height),
+        IMAGE_MAX_SHORT_SIDE / min(width, height),
+    )
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _exif_orientation(tiff):
+    """TIFF 형식 EXIF의 첫 IFD에서 Orientation 값을 읽음 (없거나 읽을 수 없으면 1)"""
+    order = {b"II": "<", b"MM": ">"}.get(tiff[:2])
+    if order is None or len(tiff) < 8:
+        return 1
+    offset = struct.unpack(order + "I", tiff[4:8])[0]
+    if offset + 2 > len(tiff):
+        return 1
+    count = struct.unpack(order + "H", tiff[offset:offset + 2])[0]
+    for entry in range(offset + 2, min(offset + 2 + count * 12, len(tiff) - 11), 12):
+        tag = struct.unpack(order + "H", tiff[entry:entry + 2])[0]
+        if tag == 0x0112:
+            return struct.unpack(order + "H", tiff[entry + 8:entry + 10])[0]
+    return 1
+
+
+def _jpeg_header(head):
+    """JPEG 마커를 따라가며 SOF 세그먼트에서 크기와 채널 수, APP1에서 EXIF 회전 정보를 읽음"""
+    orientation = 1
+    i = 2
+    while i + 4 <= len(head):
+        if head[i] != 0xFF:
+            return None
+        marker = head[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            i += 2
+            continue
+        length = int.from_bytes(head[i + 2:i + 4], "big")
+        if marker == 0xE1 and head[i + 4:i + 10] == b"Exif\0\0":
+            orientation = _exif_orientation(head[i + 10:i + 2 + length])
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            if i + 10 > len(head):
+                return None
+            height, width = struct.unpack(">HH", head[i + 5:i + 9])
+            components = head[i + 9]
+            # CMYK 등은 API가 그대로 받지 못하고, 회전 정보가 있으면 바로 세워야 하므로 재인코딩 대상
+            return ImageHeader("JPEG", width, height, components in (1, 3) and orientation == 1)
+        i += 2 + length
+    return None
+
+
+def _png_needs_decode(head):
+    """IDAT 이전에 acTL(APNG) 또는 eXIf(회전 정보 가능) 청크가 있으면 재인코딩 대상"""
+    i = 8
+    while i + 8 <= len(head):
+        length, chunk = struct.unpack(">I4s", head[i:i + 8])
+        if chunk in (b"acTL", b"eXIf"):
+            return True
+        if chunk == b"IDAT":
+            return False
+        i += 12 + length
+    return False
+
+
+def inspect_image_header(head):
+    """이미지 앞부분 바이트만으로 형식과 크기를 읽음 (픽셀은 디코딩하지 않음)
+
+    알 수 없는 형식이거나 헤더가 잘려 있으면 None을 반환합니다.
+    """
+    if head[:8] == b"\x89PNG\r\n\x1a\n" and head[12:16] == b"IHDR" and len(head) >= 24:
+        width, height = struct.unpack(">II", head[16:24])
+        return ImageHeader("PNG", width, height, not _png_needs_decode(head))
+    if head[:2] == b"\xff\xd8":
+        return _jpeg_header(head)
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP" and len(head) >= 30:
+        chunk = head[12:16]
+        if chunk == b"VP8 ":
+            width, height = struct.unpack("<HH", head[26:30])
+            return ImageHeader("WEBP", width & 0x3FFF, height & 0x3FFF, True)
+        if chunk == b"VP8L" and head[20] == 0x2F:
+            bits = int.from_bytes(head[21:25], "little")
+            return ImageHeader("WEBP", (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1, True)
+        if chunk == b"VP8X":
+            # 애니메이션(0x02)이나 EXIF(0x08)가 있으면 재인코딩
+            needs_decode = bool(head[20] & 0x0A)
+            width = int.from_bytes(head[24:27], "little") + 1
+            height = int.from_bytes(head[27:30], "little") + 1
+            return ImageHeader("WEBP", width, height, not needs_decode)
+        return None
+    if head[:6] in (b"GIF87a", b"GIF89a") and len(head) >= 10:
+        # 애니메이션 여부를 헤더만으로 알 수 없으므로 항상 재인코딩
+        width, height = struct.unpack("<HH", head[6:10])
+        return ImageHeader("GIF", width, height, False)
+    return None
+
+
+def can_passthrough(header, size):
+    """디코딩 없이 원본 그대로 보내도 되는 이미지인지 판단 (축소가 필요 없는 크기인 경우만)"""
+    return (
+        header is not None
+        and header.compliant
+        and size <= IMAGE_PASSTHROUGH_MAX_BYTES
+        and min(header.width, header.height) > 0
+        and target_size(header.width, header.height) == (header.width, header.height)
+    )
+
+
+def _has_alpha(image):
+    if image.mode in ("RGBA", "LA"):
+        return image.getchannel("A").getextrema()[0] < 255
+    return image.mode == "P" and "transparency" in image.info
+
+
+def _is_line_art(image):
+    """색상 수가 적으면 선화/스크린샷/도표로 판단"""
+    sample = image.convert("RGB")
+    sample.thumbnail(_SAMPLE_SIZE, Image.Resampling.NEAREST)
+    return sample.getcolors(maxcolors=LINE_ART_MAX_COLORS) is not None
+
+
+def preprocess_image(data):
+    """업로드된 이미지 바이트를 Vision API 전송용으로 축소/재인코딩
+
+    사진은 IMAGE_PHOTO_FORMAT(JPEG/WebP)으로 손실 압축하고,
+    선화나 스크린샷은 PNG를 유지합니다.
+    """
+    started = time.perf_counter()
+    span = current_span()
+    image = Image.open(BytesIO(data))
+    size = target_size(*image.size)
+    # JPEG는 디코딩 단계에서 바로 축소 (전체 해상도 디코딩 생략)
+    if image.format == "JPEG":
+        image.draft("RGB", size)
+    image = ImageOps.exif_transpose(image)
+    # 축소하면 색이 섞이므로 판정은 원본 기준으로
+    line_art = _is_line_art(image)
+    size = target_size(*image.size)
+    if image.size != size:
+        image = image.resize(size, Image.Resampling.LANCZOS)
+    span.record_since("image.decode", started, input_bytes=len(data), width=image.width, height=image.height)
+
+    alpha = _has_alpha(image)
+    if line_art:
+        output_format = "PNG"
+    elif alpha and IMAGE_PHOTO_FORMAT == "JPEG":
+        # JPEG는 투명도를 지원하지 않으므로 WebP 사용
+        output_format = "WEBP"
+    else:
+        output_format = IMAGE_PHOTO_FORMAT
+
+    encode_started = time.perf_counter()
+    buffered = BytesIO()
+    if output_format == "PNG":
+        if image.mode not in ("RGB", "RGBA", "L", "LA", "P"):
+            image = image.convert("RGBA" if alpha else "RGB")
+        if image.mode in ("RGB", "RGBA"):
+            # 축소로 생긴 중간색을 팔레트로 줄여 PNG 크기를 억제
+            image = image.quantize(colors=256, method=Image.Quantize.FASTOCTREE)
+        image.save(buffered, format="PNG", optimize=True)
+    else:
+        image = image.convert("RGBA" if alpha and output_format == "WEBP" else "RGB")
+        image.save(buffered, format=output_format, quality=IMAGE_PHOTO_QUALITY)
+
+    output = buffered.getvalue()
+    span.record_since("image.encode", encode_started, format=output_format, output_bytes=len(output))
+    processed = ProcessedImage(
+        data=output,
+        mime=_MIME_TYPES[output_format],
+        width=image.width,
+        height=image.height,
+        input_bytes=len(data),
+        output_bytes=len(output),
+        elapsed_ms=(time.perf_counter() - started) * 1000,
+    )
+    pipeline_stats.record(processed)
+    logger.info(
+        "image preprocessed: %d -> %d bytes (%s %dx%d, %.1f ms)",
+        processed.input_bytes, processed.output_bytes, processed.mime,
+        processed.width, processed.height, processed.elapsed_ms,
+    )
+    return processed
+
+
+def _passthrough(header, data, size, started):
+    processed = ProcessedImage(
+        data=data,
+        mime=_MIME_TYPES[header.format],
+        width=header.width,
+        height=header.height,
+        input_bytes=size,
+        output_bytes=size,
+        elapsed_ms=(time.perf_counter() - started) * 1000,
+        passthrough=True,
+    )
+    pipeline_stats.record(processed)
+    return processed
+
+
+def prepare_image(data):
+    """헤더만 검사해 규격에 맞으면 원본 그대로, 아니면 preprocess_image()로 처리"""
+    started = time.perf_counter()
+    header = inspect_image_header(data[:_HEADER_BYTES])
+    if can_passthrough(header, len(data)):
+        return _passthrough(header, data, len(data), started)
+    return preprocess_image(data)
+
+
+def prepare_image_file(path):
+    """파일 경로의 이미지를 prepare_image()로 처리"""
+    with open(path, "rb") as f:
+        return prepare_image(f.read())
+
+
+def split_data_url(url):
+    """data URL을 (MIME 타입, base64 문자열)로 분리 (순수 base64 문자열도 허용)"""
+    if url.startswith("data:"):
+        header, _, encoded = url.partition(",")
+        return header[5:].split(";", 1)[0], encoded
+    return None, url
+
+
+def prepare_data_url(url):
+    """base64 data URL 이미지를 API 전송용 data URL로 변환
+
+    규격에 맞는 이미지는 앞부분만 디코딩해 헤더를 확인한 뒤 원본 문자열을
+    그대로 돌려줍니다 (이때 ProcessedImage.data는 None).
+    이미지가 아니면 ValueError를 발생시킵니다.
+    """
+    started = time.perf_counter()
+    mime, encoded = split_data_url(url)
+    size = len(encoded) * 3 // 4 - encoded[-2:].count("=")
+    header = inspect_image_header(base64.b64decode(encoded[:_HEADER_B64_CHARS]))
+    if can_passthrough(header, size):
+        processed = _passthrough(header, None, size, started)
+        if mime != processed.mime:
+            url = f"data:{processed.mime};base64,{encoded}"
+        return url, processed
+    try:
+        decode_started = time.perf_counter()
+        data = base64.b64decode(encoded)
+        current_span().record_since("image.base64_decode", decode_started, bytes=len(data))
+        processed = preprocess_image(data)
+    except (OSError, ValueError) as e:
+        raise ValueError(f"지원하지 않는 이미지 형식입니다: {e}")
+    return to_data_url(processed), processed
+
+
+def to_data_url(processed):
+    """처리된 이미지를 base64 data URL로 변환"""
+    started = time.perf_counter()
+    encoded = base64.b64encode(processed.data).decode("utf-8")
+    current_span().record_since("image.base64_encode", started, bytes=len(processed.data))
+    return f"data:{processed.mime};base64,{encoded}"
+
+
+def make_thumbnail(data, width):
+    """화면 표시용 썸네일 (너비 width 이하, 투명도가 있으면 PNG, 없으면 JPEG)
+
+    Streamlit은 표시 너비 이하이고 형식이 맞는 이미지 바이트는 다시
+    인코딩하지 않으므로, 이 결과를 st.image(..., width=width)에 그대로 넘깁니다.
+    """
+    image = Image.open(BytesIO(data))
+    if image.format == "JPEG":
+        image.draft("RGB", (width, max(1, round(image.height * width / image.width))))
+    image = ImageOps.exif_transpose(image)
+    if image.width > width:
+        height = max(1, round(image.height * width / image.width))
+        image = image.resize((width, height), Image.Resampling.LANCZOS)
+
+    buffered = BytesIO()
+    if _has_alpha(image):
+        image.convert("RGBA").save(buffered, format="PNG")
+    else:
+        image.convert("RGB").save(buffered, format="JPEG", quality=85)
+    return buffered.getvalue()
+
+
+def describe(processed):
+    """처리 결과 요약 문자열 (화면 표시용)"""
+    if processed.passthrough:
+        return (
+            f"{processed.input_bytes / 1024:.0f} KB 원본 그대로 전송 "
+            f"({processed.mime.split('/')[1].upper()} {processed.width}×{processed.height})"
+        )
+    return (
+        f"{processed.input_bytes / 1024:.0f} KB → {processed.output_bytes / 1024:.0f} KB "
+        f"({processed.mime.split('/')[1].upper()} {processed.width}×{processed.height}, "
+        f"{processed.elapsed_ms:.0f} ms)"
+    )
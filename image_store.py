@@ -0,0 +1,277 @@
+import base64
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from tracing import current_span
+
+# 기본 설정 (환경 변수로 변경 가능)
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", ".cache/images")
+IMAGE_STORE_MAX_MEMORY_BYTES = int(os.getenv("IMAGE_STORE_MAX_MEMORY_BYTES", str(64 * 1024 * 1024)))
+IMAGE_STORE_MAX_DISK_BYTES = int(os.getenv("IMAGE_STORE_MAX_DISK_BYTES", str(1024 * 1024 * 1024)))
+
+# 이 시간(초) 동안 쓰이지 않은 이미지는 참조가 남아 있어도 삭제 (종료된 세션이 놓지 못한 참조 정리)
+IMAGE_STORE_TTL = float(os.getenv("IMAGE_STORE_TTL", str(24 * 3600)))
+
+# 메시지 안에서 이미지를 가리키는 콘텐츠 파트 타입
+IMAGE_REF_TYPE = "image_ref"
+
+# 만료되어 삭제된 이미지를 대신할 텍스트
+EXPIRED_IMAGE_TEXT = "[보관 기간이 지나 삭제된 이미지]"
+
+# 만료 검사 간격 (초)
+_EVICT_INTERVAL = 60
+
+
+class _Blob:
+    __slots__ = ("mime", "size", "refs", "data", "on_disk", "used")
+
+    def __init__(self, mime, size):
+        self.mime = mime
+        self.size = size
+        self.refs = 0
+        self.data = None  # None이면 디스크에만 있음
+        self.on_disk = False
+        self.used = time.monotonic()
+
+
+class ImageStore:
+    """SHA-256으로 주소가 정해지는 프로세스 공용 이미지 저장소
+
+    같은 이미지는 한 번만 저장되고 참조 횟수로 수명이 관리됩니다.
+    메모리 사용량이 한도를 넘으면 가장 오래 쓰지 않은 이미지부터 디스크로 내립니다.
+    ttl초 동안 쓰이지 않은 이미지는 참조가 남아 있어도 삭제하고(Streamlit 세션은 끝날 때
+    참조를 놓지 못함), 디스크 사용량이 한도를 넘으면 가장 오래 쓰지 않은 이미지부터 지웁니다.
+    """
+
+    def __init__(self, directory=IMAGE_STORE_DIR, max_memory_bytes=IMAGE_STORE_MAX_MEMORY_BYTES,
+                 max_disk_bytes=IMAGE_STORE_MAX_DISK_BYTES, ttl=IMAGE_STORE_TTL):
+        self.directory = directory
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._blobs = {}
+        self._resident = OrderedDict()  # 메모리에 있는 이미지 (LRU 순서)
+        self._memory_bytes = 0
+        self._disk_bytes = 0
+        self._last_evict = time.monotonic()
+        self.stats = {"puts": 0, "deduplicated": 0, "spills": 0, "loads": 0, "expired": 0, "disk_evictions": 0}
+        self._remove_stale_files()
+
+    def put(self, data, mime="image/png"):
+        """이미지를 저장하고 참조를 하나 늘린 뒤 참조 ID(SHA-256)를 반환"""
+        ref = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            self.stats["puts"] += 1
+            self._evict_expired()
+            blob = self._blobs.get(ref)
+            if blob is None:
+                blob = self._blobs[ref] = _Blob(mime, len(data))
+                self._make_resident(ref, blob, data)
+            else:
+                self.stats["deduplicated"] += 1
+                blob.used = time.monotonic()
+            blob.refs += 1
+        return ref
+
+    def retain(self, ref):
+        """기존 이미지의 참조를 하나 늘림 (만료되어 삭제되었으면 KeyError)"""
+        with self._lock:
+            blob = self._blobs[ref]
+            blob.refs += 1
+            blob.used = time.monotonic()
+
+    def release(self, ref):
+        """참조를 하나 줄이고, 더 이상 참조가 없으면 메모리와 디스크에서 삭제"""
+        with self._lock:
+            blob = self._blobs.get(ref)
+            if blob is None:
+                return
+            blob.refs -= 1
+            if blob.refs <= 0:
+                self._remove(ref, blob)
+
+    def get(self, ref):
+        """이미지 바이트 반환 (디스크로 내려간 경우 다시 읽어옴, 만료되어 삭제되었으면 KeyError)"""
+        with self._lock:
+            return self._read(ref)[0]
+
+    def mime(self, ref):
+        """이미지 MIME 타입 (만료되어 삭제되었으면 KeyError)"""
+        with self._lock:
+            blob = self._blobs[ref]
+            blob.used = time.monotonic()
+            return blob.mime
+
+    def data_url(self, ref):
+        """API 요청용 base64 data URL (요청을 만들 때만 생성, 만료되어 삭제되었으면 KeyError)"""
+        # 바이트와 MIME을 한 번에 읽어 그 사이에 이미지가 삭제되지 않도록 함
+        with self._lock:
+            data, mime = self._read(ref)
+        started = time.perf_counter()
+        encoded = base64.b64encode(data).decode("utf-8")
+        current_span().record_since("image.base64_encode", started, bytes=len(data))
+        return f"data:{mime};base64,{encoded}"
+
+    def snapshot(self):
+        """저장된 이미지 수와 메모리/디스크 사용량"""
+        with self._lock:
+            return {
+                **self.stats,
+                "images": len(self._blobs),
+                "resident": len(self._resident),
+                "memory_bytes": self._memory_bytes,
+                "disk_bytes": self._disk_bytes,
+            }
+
+    def _path(self, ref):
+        return os.path.join(self.directory, ref)
+
+    def _make_resident(self, ref, blob, data):
+        blob.data = data
+        self._resident[ref] = blob
+        self._memory_bytes += blob.size
+        while self._memory_bytes > self.max_memory_bytes and len(self._resident) > 1:
+            oldest, victim = next(iter(self._resident.items()))
+            self._spill(oldest, victim)
+
+    def _spill(self, ref, blob):
+        """메모리의 이미지를 디스크로 내림"""
+        if not blob.on_disk:
+            path = self._path(ref)
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(blob.data)
+            os.replace(tmp_path, path)
+            blob.on_disk = True
+            self._disk_bytes += blob.size
+        del self._resident[ref]
+        self._memory_bytes -= blob.size
+        blob.data = None
+        self.stats["spills"] += 1
+        self._evict_disk()
+
+    def _read(self, ref):
+        """이미지 바이트와 MIME 타입 (self._lock을 잡은 상태에서 호출)"""
+        blob = self._blobs[ref]
+        blob.used = time.monotonic()
+        if blob.data is not None:
+            self._resident.move_to_end(ref)
+            return blob.data, blob.mime
+        try:
+            with open(self._path(ref), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            # 같은 디렉터리를 쓰는 다른 프로세스가 오래된 파일로 보고 지운 경우
+            blob.on_disk = False
+            self._disk_bytes -= blob.size
+            del self._blobs[ref]
+            raise KeyError(ref)
+        self.stats["loads"] += 1
+        self._make_resident(ref, blob, data)
+        return data, blob.mime
+
+    def _remove(self, ref, blob):
+        """이미지를 메모리와 디스크에서 삭제"""
+        del self._blobs[ref]
+        if blob.data is not None:
+            del self._resident[ref]
+            self._memory_bytes -= blob.size
+        if blob.on_disk:
+            self._disk_bytes -= blob.size
+            try:
+                os.remove(self._path(ref))
+            except FileNotFoundError:
+                pass
+
+    def _evict_expired(self):
+        """ttl초 동안 쓰이지 않은 이미지 삭제 (_EVICT_INTERVAL마다 한 번만 검사)"""
+        now = time.monotonic()
+        if now - self._last_evict < _EVICT_INTERVAL:
+            return
+        self._last_evict = now
+        for ref, blob in [(r, b) for r, b in self._blobs.items() if now - b.used > self.ttl]:
+            self._remove(ref, blob)
+            self.stats["expired"] += 1
+
+    def _evict_disk(self):
+        """디스크 사용량이 한도를 넘으면 가장 오래 쓰지 않은 이미지부터 삭제 (메모리에도 있으면 파일만)"""
+        if self._disk_bytes <= self.max_disk_bytes:
+            return
+        for _, ref in sorted((b.used, r) for r, b in self._blobs.items() if b.on_disk):
+            if self._disk_bytes <= self.max_disk_bytes:
+                break
+            blob = self._blobs[ref]
+            if blob.data is None:
+                self._remove(ref, blob)
+            else:
+                blob.on_disk = False
+                self._disk_bytes -= blob.size
+                try:
+                    os.remove(self._path(ref))
+                except FileNotFoundError:
+                    pass
+            self.stats["disk_evictions"] += 1
+
+    def _remove_stale_files(self):
+        """이전 실행이 남긴 파일 중 ttl보다 오래된 것 삭제 (색인은 메모리에만 있어 다시 쓸 수 없음)"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        cutoff = time.time() - self.ttl
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+def image_ref_part(ref):
+    """메시지에 저장할 이미지 참조 콘텐츠 파트"""
+    return {"type": IMAGE_REF_TYPE, IMAGE_REF_TYPE: ref}
+
+
+def iter_image_refs(content):
+    """메시지 콘텐츠에 포함된 이미지 참조 ID를 순회"""
+    if isinstance(content, list):
+        for part in content:
+            if part.get("type") == IMAGE_REF_TYPE:
+                yield part[IMAGE_REF_TYPE]
+
+
+def materialize_content(content, store):
+    """이미지 참조를 API 요청용 image_url(data URL) 파트로 변환 (만료되어 삭제된 이미지는 안내 텍스트)"""
+    if not isinstance(content, list):
+        return content
+    materialized = []
+    for part in content:
+        if part.get("type") == IMAGE_REF_TYPE:
+            try:
+                url = store.data_url(part[IMAGE_REF_TYPE])
+            except KeyError:
+                materialized.append({"type": "text", "text": EXPIRED_IMAGE_TEXT})
+                continue
+            materialized.append({"type": "image_url", "image_url": {"url": url}})
+        else:
+            materialized.append(part)
+    return materialized
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_image_store():
+    """프로세스 전체에서 공유하는 이미지 저장소 반환"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = ImageStore()
+    return _store
@@ -0,0 +1,192 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from python_multipart import MultipartParser
+from python_multipart.multipart import parse_options_header
+
+# 업로드할 수 있는 이미지 최대 크기 (바이트)
+IMAGE_UPLOAD_MAX_BYTES = int(os.getenv("IMAGE_UPLOAD_MAX_BYTES", str(20 * 1024 * 1024)))
+
+# 업로드 본문을 메모리에 둘 최대 크기 (넘으면 임시 파일로 내림)
+IMAGE_UPLOAD_SPOOL_BYTES = int(os.getenv("IMAGE_UPLOAD_SPOOL_BYTES", str(1024 * 1024)))
+
+# 업로드한 이미지를 채팅 요청에서 참조할 수 있는 시간 (초)
+IMAGE_UPLOAD_TTL = float(os.getenv("IMAGE_UPLOAD_TTL", "3600"))
+
+# multipart 본문에서 이미지 외의 부분(경계, 헤더, 다른 필드)에 허용하는 크기
+_MULTIPART_OVERHEAD = 64 * 1024
+
+# multipart 요청에서 이미지를 담는 필드 이름
+IMAGE_FIELD = "image"
+
+
+class UploadError(Exception):
+    """업로드를 받을 수 없음 (status_code로 응답)"""
+
+    def __init__(self, status_code, detail):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class HashingSpool:
+    """받는 대로 SHA-256을 계산하며 쌓는 버퍼 (작으면 메모리, 크면 임시 파일)
+
+    max_bytes를 넘는 순간 UploadError(413)를 발생시키므로 나머지 본문은 읽지 않습니다.
+    """
+
+    def __init__(self, max_bytes=IMAGE_UPLOAD_MAX_BYTES, spool_bytes=IMAGE_UPLOAD_SPOOL_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._file = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise UploadError(413, f"이미지는 최대 {self.max_bytes / (1024 * 1024):.0f}MB까지 업로드할 수 있습니다.")
+        self._hash.update(chunk)
+        self._file.write(chunk)
+
+    @property
+    def digest(self):
+        return self._hash.hexdigest()
+
+    def getvalue(self):
+        self._file.seek(0)
+        return self._file.read()
+
+    def close(self):
+        self._file.close()
+
+
+async def _receive_multipart(request, spool, boundary):
+    """multipart 본문을 흘려 읽으며 image 필드의 내용만 spool에 기록"""
+    state = {"header": b"", "headers": {}, "image": False, "found": False, "error": None}
+
+    def on_part_begin():
+        state["headers"] = {}
+
+    def on_header_field(data, start, end):
+        state["header"] = data[start:end].lower()
+
+    def on_header_value(data, start, end):
+        state["headers"][state["header"]] = state["headers"].get(state["header"], b"") + data[start:end]
+
+    def on_headers_finished():
+        _, options = parse_options_header(state["headers"].get(b"content-disposition", b""))
+        state["image"] = options.get(b"name") == IMAGE_FIELD.encode()
+        state["found"] = state["found"] or state["image"]
+
+    def on_part_data(data, start, end):
+        if state["image"] and state["error"] is None:
+            try:
+                spool.write(data[start:end])
+            except UploadError as e:
+                state["error"] = e
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+    }, max_size=spool.max_bytes + _MULTIPART_OVERHEAD)
+    async for chunk in request.stream():
+        try:
+            parser.write(chunk)
+        except Exception as e:
+            raise UploadError(400, f"multipart 본문을 해석할 수 없습니다: {e}")
+        if state["error"] is not None:
+            raise state["error"]
+    parser.finalize()
+    if not state["found"]:
+        raise UploadError(400, f"multipart 요청에는 '{IMAGE_FIELD}' 파일 필드가 필요합니다.")
+
+
+async def receive_image(request, max_bytes=IMAGE_UPLOAD_MAX_BYTES):
+    """요청 본문(원본 바이트 또는 multipart의 image 필드)을 HashingSpool로 받음
+
+    Content-Length가 한도를 넘으면 본문을 읽지 않고 바로 거절하고,
+    길이를 모르는 본문도 한도를 넘는 순간 읽기를 멈춥니다.
+    """
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    multipart = content_type == b"multipart/form-data"
+    if not multipart and not (content_type.startswith(b"image/") or content_type == b"application/octet-stream"):
+        raise UploadError(415, "이미지 본문(image/*) 또는 multipart/form-data로 업로드해 주세요.")
+    if multipart and not options.get(b"boundary"):
+        raise UploadError(400, "multipart 경계(boundary)가 없습니다.")
+
+    limit = max_bytes + (_MULTIPART_OVERHEAD if multipart else 0)
+    content_length = request.headers.get("content-length")
+    if content_length is not None and content_length.isdigit() and int(content_length) > limit:
+        raise UploadError(413, f"이미지는 최대 {max_bytes / (1024 * 1024):.0f}MB까지 업로드할 수 있습니다.")
+
+    spool = HashingSpool(max_bytes)
+    try:
+        if multipart:
+            await _receive_multipart(request, spool, options[b"boundary"])
+        else:
+            async for chunk in request.stream():
+                spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    if spool.size == 0:
+        spool.close()
+        raise UploadError(400, "이미지 본문이 비어 있습니다.")
+    return spool
+
+
+class ImageUploads:
+    """업로드 원본의 SHA-256 -> 이미지 저장소 참조 (ttl초 동안 채팅 요청에서 image_id로 사용)
+
+    같은 이미지를 다시 올리면 이미지 처리를 건너뛰고 기존 참조의 만료 시간만 늘립니다.
+    """
+
+    def __init__(self, store, ttl=IMAGE_UPLOAD_TTL):
+        self.store = store
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._uploads = {}  # digest -> [참조, 만료 시각]
+        self.stats = {"uploads": 0, "deduplicated": 0, "expired": 0}
+
+    def touch(self, digest):
+        """이미 올라온 이미지면 만료 시간을 늘리고 True"""
+        with self._lock:
+            self._purge()
+            entry = self._uploads.get(digest)
+            if entry is None:
+                return False
+            entry[1] = time.monotonic() + self.ttl
+            self.stats["deduplicated"] += 1
+            return True
+
+    def add(self, digest, data, mime):
+        """처리된 이미지를 저장소에 넣고 digest로 등록"""
+        ref = self.store.put(data, mime)
+        with self._lock:
+            previous = self._uploads.get(digest)
+            self._uploads[digest] = [ref, time.monotonic() + self.ttl]
+            self.stats["uploads"] += 1
+        if previous is not None:
+            self.store.release(previous[0])
+
+    def get(self, digest):
+        """image_id에 해당하는 저장소 참조 (없거나 만료되었으면 None)"""
+        with self._lock:
+            self._purge()
+            entry = self._uploads.get(digest)
+            return entry[0] if entry else None
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.stats, "active": len(self._uploads)}
+
+    def _purge(self):
+        now = time.monotonic()
+        for digest in [d for d, (_, expires) in self._uploads.items() if expires <= now]:
+            self.store.release(self._uploads.pop(digest)[0])
+            self.stats["expired"] += 1
@@ -0,0 +1,456 @@
+"""부하 테스트 / 벤치마크
+
+로컬 OpenAI 대역 서버(mock_openai.py)를 띄우고 세 프론트엔드의 채팅 경로에 동시 요청을
+보내 동시성 단계별 처리량, 지연 시간 백분위(p50/p95/p99), 첫 토큰까지 시간(TTFT),
+최대 메모리(RSS)를 측정합니다. 실제 API는 호출하지 않습니다.
+
+    python loadtest.py api --concurrency 1,8,32 --requests 200
+    python loadtest.py api-stream --concurrency 1,8,32 --ttft-ms 500 --error-rate 0.02
+    python loadtest.py gradio --concurrency 1,16
+    python loadtest.py streamlit --concurrency 1,4 --requests 20
+
+대상:
+    api         app_enhanced.py의 POST /api/chat (별도 uvicorn 프로세스, TTFT는 전체 응답 시간)
+    api-stream  app_enhanced.py의 POST /api/chat/stream (별도 uvicorn 프로세스)
+    gradio      gradio_app.respond 핸들러 (이 프로세스 안에서 직접 호출, Gradio 대기열은 제외)
+    streamlit   streamlit_app.py 채팅 입력 (동시 세션마다 별도 프로세스에서 AppTest로 실행,
+                TTFT는 측정하지 않고 RSS는 가장 큰 작업자 프로세스 기준)
+
+loadtest.py가 모르는 옵션(--ttft-ms, --token-ms, --error-rate, --rpm-limit 등)은
+mock_openai.py에 그대로 전달됩니다.
+"""
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import queue
+import threading
+import time
+import types
+from collections import Counter
+import httpx
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 대역 서버/API 서버가 뜰 때까지 기다리는 최대 시간 (초)
+_STARTUP_TIMEOUT = 30.0
+
+# 메모리 측정 간격 (초)
+_MEMORY_SAMPLE_INTERVAL = 0.1
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_process(cmd, env, ready_url):
+    """하위 프로세스를 띄우고 ready_url이 응답할 때까지 기다림"""
+    process = subprocess.Popen(cmd, cwd=BASE_DIR, env=env)
+    deadline = time.monotonic() + _STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"프로세스가 시작되지 못했습니다: {' '.join(cmd)}")
+        try:
+            if httpx.get(ready_url, timeout=1.0).status_code == 200:
+                return process
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise SystemExit(f"{ready_url} 응답을 기다리다 시간이 초과되었습니다.")
+
+
+def rss_bytes(pid):
+    """프로세스의 현재 RSS (/proc이 없는 환경이면 None)"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+class MemorySampler(threading.Thread):
+    """측정 구간 동안 프로세스 RSS의 최댓값 기록 (여러 프로세스면 가장 큰 것)"""
+
+    def __init__(self, pids):
+        super().__init__(daemon=True)
+        self.pids = pids
+        self.peak = None
+        self._stop_event = threading.Event()
+        self._sample()
+
+    def _sample(self):
+        for pid in self.pids:
+            rss = rss_bytes(pid)
+            if rss is not None:
+                self.peak = max(self.peak or 0, rss)
+
+    def run(self):
+        while not self._stop_event.wait(_MEMORY_SAMPLE_INTERVAL):
+            self._sample()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        return self.peak
+
+
+def percentile(values, p):
+    """nearest-rank 백분위 (값이 없으면 None)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+class LevelStats:
+    """동시성 단계 하나의 측정 결과"""
+
+    def __init__(self, concurrency, total):
+        self.concurrency = concurrency
+        self.total = total
+        self.latencies = []
+        self.ttfts = []
+        self.errors = Counter()
+        self.elapsed = 0.0
+        self.peak_rss = None
+        self.upstream = {}
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def take(self):
+        """다음 요청 번호 (모두 보냈으면 None)"""
+        with self._lock:
+            if self._next >= self.total:
+                return None
+            self._next += 1
+            return self._next - 1
+
+    def record(self, started, error, first_token_at=None):
+        ttft = first_token_at - started if first_token_at is not None else None
+        self.add(time.monotonic() - started, error, ttft)
+
+    def add(self, latency, error, ttft=None):
+        with self._lock:
+            if error:
+                self.errors[error] += 1
+                return
+            self.latencies.append(latency)
+            if ttft is not None:
+                self.ttfts.append(ttft)
+
+    def summary(self):
+        def ms(value):
+            return round(value * 1000, 1) if value is not None else None
+
+        return {
+            "concurrency": self.concurrency,
+            "requests": self.total,
+            "succeeded": len(self.latencies),
+            "failed": sum(self.errors.values()),
+            "errors": dict(self.errors),
+            "throughput_rps": round(len(self.latencies) / self.elapsed, 2) if self.elapsed else 0.0,
+            "latency_ms_p50": ms(percentile(self.latencies, 50)),
+            "latency_ms_p95": ms(percentile(self.latencies, 95)),
+            "latency_ms_p99": ms(percentile(self.latencies, 99)),
+            "ttft_ms_p50": ms(percentile(self.ttfts, 50)),
+            "ttft_ms_p95": ms(percentile(self.ttfts, 95)),
+            "ttft_ms_p99": ms(percentile(self.ttfts, 99)),
+            "peak_rss_mb": round(self.peak_rss / 1024 / 1024, 1) if self.peak_rss else None,
+            "upstream": self.upstream,
+        }
+
+
+_message_ids = iter(range(1 << 62))
+
+
+def next_message(number=None):
+    """요청마다 다른 질문 (캐시/중복 요청 병합에 걸리지 않도록)"""
+    if number is None:
+        number = next(_message_ids)
+    return f"부하 테스트 질문 {number}: 간단히 설명해주세요."
+
+
+class ApiTarget:
+    """app_enhanced.py를 별도 uvicorn 프로세스로 띄워 HTTP로 호출"""
+
+    def __init__(self, env, stream):
+        self.stream = stream
+        port = free_port()
+        self.base_url = f"http://127.0.0.1:{port}"
+        self.process = start_process(
+            [sys.executable, "-m", "uvicorn", "app_enhanced:app", "--host", "127.0.0.1",
+             "--port", str(port), "--log-level", "warning"],
+            env, f"{self.base_url}/health"
+        )
+        self.pid = self.process.pid
+        self.http = None
+
+    async def call(self, stats, worker):
+        if self.http is None:
+            self.http = httpx.AsyncClient(base_url=self.base_url, timeout=300.0,
+                                          limits=httpx.Limits(max_connections=None))
+        started = time.monotonic()
+        body = {"message": next_message()}
+        try:
+            if not self.stream:
+                response = await self.http.post("/api/chat", json=body)
+                error = None if response.status_code == 200 else f"HTTP {response.status_code}"
+                stats.record(started, error, time.monotonic() if error is None else None)
+                return
+            first_token_at = None
+            error = "스트림이 끝나지 않음"
+            async with self.http.stream("POST", "/api/chat/stream", json=body) as response:
+                if response.status_code != 200:
+                    stats.record(started, f"HTTP {response.status_code}")
+                    return
+                event = None
+                async for line in response.aiter_lines():
+                    if line.startswith("event:"):
+                        event = line[6:].strip()
+                    elif line.startswith("data:"):
+                        data = json.loads(line[5:])
+                        if event is None and data.get("delta") and first_token_at is None:
+                            first_token_at = time.monotonic()
+                        elif event == "done":
+                            error = None
+                        elif event == "error":
+                            error = "SSE error"
+                    elif not line:
+                        event = None
+            stats.record(started, error, first_token_at)
+        except httpx.HTTPError as e:
+            stats.record(started, type(e).__name__)
+
+    async def close(self):
+        if self.http is not None:
+            await self.http.aclose()
+        self.process.terminate()
+        self.process.wait()
+
+
+class GradioTarget:
+    """gradio_app.respond를 이 프로세스 안에서 직접 호출 (작업자마다 다른 세션)"""
+
+    def __init__(self):
+        import gradio_app
+        self.respond = gradio_app.respond
+        self.pid = os.getpid()
+
+    async def call(self, stats, worker):
+        started = time.monotonic()
+        first_token_at = None
+        reply = None
+        request = types.SimpleNamespace(session_hash=f"loadtest-{worker}")
+        async for history, _, _ in self.respond(next_message(), [], None, False, request):
+            reply = history[-1][1]
+            if reply and first_token_at is None:
+                first_token_at = time.monotonic()
+        error = None
+        if not reply:
+            error = "빈 응답"
+        elif reply.startswith("오류가 발생했습니다"):
+            error = reply.split(":", 1)[-1].strip()[:60]
+        stats.record(started, error, first_token_at)
+
+    async def close(self):
+        pass
+
+
+def streamlit_worker(timeout, counter, total, ready, start, results):
+    """작업자 프로세스 하나: AppTest 세션으로 streamlit_app.py를 실행하며 채팅 입력을 반복
+
+    AppTest는 프로세스 전역 런타임을 쓰므로 한 프로세스에서 여러 세션을 동시에 실행할 수 없습니다.
+    """
+    from streamlit.testing.v1 import AppTest
+    at = AppTest.from_file(os.path.join(BASE_DIR, "streamlit_app.py"), default_timeout=timeout).run()
+    # 클라이언트 생성 등 첫 호출 비용은 측정에서 제외
+    at.chat_input[0].set_value(next_message(f"warmup-{os.getpid()}")).run()
+    ready.release()
+    start.wait()
+    while True:
+        with counter.get_lock():
+            if counter.value >= total:
+                break
+            counter.value += 1
+            number = counter.value
+        # 대화가 길어지며 측정값이 달라지지 않도록 매번 첫 인사 메시지만 남김
+        at.session_state["messages"] = at.session_state["messages"][:1]
+        started = time.monotonic()
+        error = None
+        try:
+            at.chat_input[0].set_value(next_message(number)).run()
+            if at.exception:
+                error = at.exception[0].message[:60]
+            elif at.error:
+                error = at.error[0].value[:60]
+        except RuntimeError as e:
+            error = str(e)[:60]
+        results.put((time.monotonic() - started, error))
+    results.put(None)
+
+
+def run_streamlit_level(stats, timeout, mock_url):
+    """동시성만큼 작업자 프로세스를 띄워 측정 (세션 준비 시간은 제외)"""
+    context = multiprocessing.get_context("spawn")
+    counter = context.Value("i", 0)
+    ready = context.Semaphore(0)
+    start = context.Event()
+    results = context.Queue()
+    workers = [
+        context.Process(target=streamlit_worker, args=(timeout, counter, stats.total, ready, start, results),
+                        daemon=True)
+        for _ in range(stats.concurrency)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        for _ in workers:
+            if not ready.acquire(timeout=_STARTUP_TIMEOUT + timeout):
+                raise SystemExit("Streamlit 작업자 프로세스가 준비되지 못했습니다.")
+        mock_stats(mock_url, reset=True)
+        sampler = MemorySampler([worker.pid for worker in workers])
+        sampler.start()
+        started = time.monotonic()
+        start.set()
+        running = len(workers)
+        while running:
+            try:
+                item = results.get(timeout=1.0)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    break
+                continue
+            if item is None:
+                running -= 1
+            else:
+                stats.add(*item)
+        stats.elapsed = time.monotonic() - started
+        stats.peak_rss = sampler.stop()
+    finally:
+        for worker in workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+
+
+async def run_async_level(target, stats):
+    async def worker(index):
+        while stats.take() is not None:
+            await target.call(stats, index)
+
+    await asyncio.gather(*(worker(i) for i in range(stats.concurrency)))
+
+
+def mock_stats(mock_url, reset=False):
+    """대역 서버가 받은 요청 수 (reset이면 읽은 뒤 0으로)"""
+    if reset:
+        return httpx.post(f"{mock_url}/mock/reset").json()
+    return httpx.get(f"{mock_url}/mock/stats").json()
+
+
+def print_report(target_name, results, mock_args):
+    print()
+    print(f"대상: {target_name}   대역 서버 옵션: {' '.join(mock_args) or '(기본값)'}")
+    columns = ["conc", "ok", "fail", "req/s", "p50ms", "p95ms", "p99ms", "ttft50", "ttft95", "ttft99", "rss_mb"]
+    keys = ["concurrency", "succeeded", "failed", "throughput_rps", "latency_ms_p50", "latency_ms_p95",
+            "latency_ms_p99", "ttft_ms_p50", "ttft_ms_p95", "ttft_ms_p99", "peak_rss_mb"]
+    print(" ".join(f"{column:>8}" for column in columns))
+    print("-" * 9 * len(columns))
+    for r in results:
+        print(" ".join(f"{'-' if r[key] is None else r[key]:>8}" for key in keys))
+    for r in results:
+        upstream = r["upstream"]
+        line = (f"  동시성 {r['concurrency']}: 업스트림 요청 {upstream.get('requests', 0)}, "
+                f"최대 동시 {upstream.get('max_in_flight', 0)}, "
+                f"429 {upstream.get('rate_limited', 0) + upstream.get('injected_rate_limits', 0)}, "
+                f"주입 오류 {upstream.get('injected_errors', 0) + upstream.get('stream_errors', 0)}")
+        if r["errors"]:
+            line += f" / 실패 원인: {dict(r['errors'])}"
+        print(line)
+
+
+async def run_async_target(args, levels, mock_url):
+    if args.target == "gradio":
+        target = GradioTarget()
+    else:
+        target = ApiTarget(dict(os.environ), stream=args.target == "api-stream")
+    results = []
+    try:
+        # 클라이언트 생성/연결 등 첫 호출 비용은 측정에서 제외
+        await target.call(LevelStats(1, 1), "warmup")
+        for concurrency in levels:
+            stats = LevelStats(concurrency, max(args.requests, concurrency))
+            mock_stats(mock_url, reset=True)
+            sampler = MemorySampler([target.pid])
+            sampler.start()
+            started = time.monotonic()
+            await run_async_level(target, stats)
+            stats.elapsed = time.monotonic() - started
+            stats.peak_rss = sampler.stop()
+            stats.upstream = mock_stats(mock_url)
+            results.append(stats.summary())
+            print(f"[loadtest] 동시성 {concurrency} 완료", file=sys.stderr, flush=True)
+    finally:
+        await target.close()
+    return results
+
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="로컬 대역 서버로 채팅 경로 부하 테스트 (모르는 옵션은 mock_openai.py로 전달)"
+    )
+    parser.add_argument("target", choices=["api", "api-stream", "gradio", "streamlit"])
+    parser.add_argument("--concurrency", default="1,8,32", help="쉼표로 구분한 동시성 단계 (기본 1,8,32)")
+    parser.add_argument("--requests", type=int, default=100, help="단계마다 보낼 요청 수 (기본 100)")
+    parser.add_argument("--timeout", type=float, default=120, help="streamlit 스크립트 실행 제한 시간 (초)")
+    parser.add_argument("--json", help="결과를 JSON으로 저장할 경로")
+    args, mock_args = parser.parse_known_args()
+    levels = [int(value) for value in args.concurrency.split(",") if value.strip()]
+
+    mock_port = free_port()
+    mock_url = f"http://127.0.0.1:{mock_port}"
+    mock = start_process(
+        [sys.executable, "mock_openai.py", "--port", str(mock_port), *mock_args],
+        dict(os.environ), f"{mock_url}/mock/stats"
+    )
+    # 대상은 항상 대역 서버를 호출 (실제 키가 설정되어 있어도 쓰지 않음)
+    os.environ["OPENAI_BASE_URL"] = f"{mock_url}/v1"
+    os.environ["OPENAI_API_KEY"] = "mock"
+    os.environ.setdefault("RESPONSE_CACHE_ENABLED", "0")
+
+    results = []
+    try:
+        if args.target == "streamlit":
+            for concurrency in levels:
+                stats = LevelStats(concurrency, max(args.requests, concurrency))
+                run_streamlit_level(stats, args.timeout, mock_url)
+                stats.upstream = mock_stats(mock_url)
+                results.append(stats.summary())
+                print(f"[loadtest] 동시성 {concurrency} 완료", file=sys.stderr, flush=True)
+        else:
+            results = asyncio.run(run_async_target(args, levels, mock_url))
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    print_report(args.target, results, mock_args)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"target": args.target, "mock_args": mock_args, "levels": results}, f,
+                      ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
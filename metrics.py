@@ -0,0 +1,351 @@
+import asyncio
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Gradio/Streamlit에서 /metrics를 노출할 포트 (비워 두면 노출하지 않음, FastAPI는 자체 경로 사용)
+METRICS_PORT = os.getenv("METRICS_PORT", "")
+
+# 지연 시간 히스토그램 구간 (초)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# Prometheus 텍스트 형식의 Content-Type
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_number(value)}"]
+
+
+class Counter(_Metric):
+    """계속 증가하는 값 (요청 수, 토큰 수)"""
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """현재 값 (진행 중인 요청 수)"""
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """구간별 누적 개수와 합계 (지연 시간 분포)"""
+    kind = "histogram"
+
+    def __init__(self, name, description, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def _render_value(self, key, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labelnames, key, f'le="{_format_number(bound)}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+        lines.append(f"{self.name}_bucket{labels} {count}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_number(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    """메트릭 모음 (Prometheus 텍스트 형식으로 출력)"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+_registry = Registry()
+
+_requests_total = _registry.register(Counter(
+    "chat_requests_total", "Chat requests handled, by route and status.", ("frontend", "route", "status")
+))
+_request_seconds = _registry.register(Histogram(
+    "chat_request_duration_seconds", "End-to-end chat request latency.", ("frontend", "route")
+))
+_in_flight = _registry.register(Gauge(
+    "chat_requests_in_flight", "Chat requests currently being handled.", ("frontend",)
+))
+_stage_seconds = _registry.register(Histogram(
+    "chat_stage_duration_seconds",
+    "Time spent per pipeline stage (parse, image, queue, ttft, upstream, postprocess, summary).",
+    ("frontend", "stage")
+))
+_tokens_total = _registry.register(Counter(
+    "chat_tokens_total", "Upstream tokens reported in usage, by model and kind (prompt, completion, cached).",
+    ("frontend", "model", "kind")
+))
+
+
+def render():
+    """모든 메트릭을 Prometheus 텍스트 형식으로 반환"""
+    return _registry.render()
+
+
+def usage_tokens(usage):
+    """Chat Completions 또는 Responses API의 usage에서 (프롬프트, 출력, 캐시된 프롬프트) 토큰 수"""
+    prompt = getattr(usage, "prompt_tokens", None)
+    if prompt is None:
+        prompt = getattr(usage, "input_tokens", 0)
+    completion = getattr(usage, "completion_tokens", None)
+    if completion is None:
+        completion = getattr(usage, "output_tokens", 0)
+    details = getattr(usage, "prompt_tokens_details", None) or getattr(usage, "input_tokens_details", None)
+    cached = getattr(details, "cached_tokens", 0) or 0
+    return prompt or 0, completion or 0, cached
+
+
+class Stopwatch:
+    """여러 구간의 시간을 합산 (with 블록마다 누적, 스트림 청크별 후처리 시간 등)"""
+
+    def __init__(self):
+        self.elapsed = 0.0
+        self.laps = 0
+        self._started = None
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed += time.perf_counter() - self._started
+        self.laps += 1
+
+
+class RequestTimer:
+    """요청 하나의 진행 중 표시와 처리 시간 (finish에서 상태와 함께 기록)"""
+
+    def __init__(self, metrics, route):
+        self.metrics = metrics
+        self.route = route
+        self.status = "ok"
+        self.started = time.perf_counter()
+        self._finished = False
+        _in_flight.inc(frontend=metrics.frontend)
+
+    def finish(self, status=None):
+        if self._finished:
+            return
+        self._finished = True
+        _in_flight.dec(frontend=self.metrics.frontend)
+        self.metrics.record_request(self.route, status or self.status, time.perf_counter() - self.started)
+
+
+class ChatMetrics:
+    """프론트엔드 하나(fastapi/gradio/streamlit)의 채팅 파이프라인 계측
+
+    단계(stage): parse(본문 파싱/검증), image(이미지 처리), queue(공정 큐 대기),
+    ttft(업스트림 호출부터 첫 토큰까지), upstream(업스트림 호출 전체), postprocess(정리/HTML 변환),
+    summary(대화 요약 호출, 응답 후 백그라운드)
+    """
+
+    def __init__(self, frontend):
+        self.frontend = frontend
+
+    def start_request(self, route):
+        """요청 처리 시작 (반환된 RequestTimer.finish(status)로 종료)"""
+        return RequestTimer(self, route)
+
+    @contextmanager
+    def request(self, route):
+        """with 블록을 요청 하나로 기록 (블록 안에서 timer.status로 상태 지정, 예외가 나면 "error")
+
+        비동기 제너레이터 안에서 써도 되며, 클라이언트가 중간에 끊어 닫히면 "cancelled"로 기록합니다.
+        """
+        timer = self.start_request(route)
+        try:
+            yield timer
+        except (GeneratorExit, asyncio.CancelledError):
+            timer.finish("cancelled")
+            raise
+        except BaseException:
+            timer.finish("error")
+            raise
+        timer.finish()
+
+    def record_request(self, route, status, seconds):
+        _requests_total.inc(frontend=self.frontend, route=route, status=status)
+        _request_seconds.observe(seconds, frontend=self.frontend, route=route)
+
+    def observe(self, stage, seconds):
+        _stage_seconds.observe(seconds, frontend=self.frontend, stage=stage)
+
+    def observe_since(self, stage, started):
+        """perf_counter 시각 started부터 지금까지를 단계 시간으로 기록"""
+        if started is not None:
+            self.observe(stage, time.perf_counter() - started)
+
+    @contextmanager
+    def stage(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def record_usage(self, model, usage):
+        """Chat Completions 또는 Responses API의 usage를 모델별 토큰 수에 반영"""
+        if usage is None:
+            return
+        prompt, completion, cached = usage_tokens(usage)
+        for kind, amount in (("prompt", prompt), ("completion", completion), ("cached", cached)):
+            _tokens_total.inc(amount, frontend=self.frontend, model=model, kind=kind)
+
+
+_chat_metrics = {}
+_chat_metrics_lock = threading.Lock()
+
+
+def get_chat_metrics(frontend):
+    """프론트엔드별 계측 객체 반환 (메트릭은 프로세스 전체에서 공유)"""
+    with _chat_metrics_lock:
+        if frontend not in _chat_metrics:
+            _chat_metrics[frontend] = ChatMetrics(frontend)
+        return _chat_metrics[frontend]
+
+
+class MetricsMiddleware:
+    """route_label(scope)가 이름을 돌려주는 요청의 수, 상태 코드, 처리 시간, 진행 중 수를 기록하는 ASGI 미들웨어
+
+    요청 시작 시각을 request.state.request_started(perf_counter)에 남기므로 핸들러에서
+    본문 파싱/검증에 걸린 시간(parse 단계)을 기록할 수 있습니다.
+    """
+
+    def __init__(self, app, metrics, route_label):
+        self.app = app
+        self.metrics = metrics
+        self.route_label = route_label
+
+    async def __call__(self, scope, receive, send):
+        route = self.route_label(scope) if scope["type"] == "http" else None
+        if route is None:
+            await self.app(scope, receive, send)
+            return
+
+        timer = self.metrics.start_request(route)
+        scope.setdefault("state", {})["request_started"] = timer.started
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            timer.finish(str(status))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port=METRICS_PORT, host="0.0.0.0"):
+    """별도 스레드에서 GET /metrics를 제공 (port가 비어 있으면 아무것도 하지 않음, 여러 번 호출해도 한 번만 시작)"""
+    global _server
+    if not port:
+        return None
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, int(port)), _MetricsHandler)
+            threading.Thread(target=_server.serve_forever, daemon=True).start()
+        return _server
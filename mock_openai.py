@@ -0,0 +1,514 @@
+"""로컬 OpenAI API 대역 서버 (벤치마크/부하 테스트용)
+
+Chat Completions, Responses, Images, Files 엔드포인트를 흉내 내며 응답 지연 분포,
+스트리밍, 오류/429 주입, x-ratelimit-* 헤더를 설정할 수 있습니다.
+실제 API를 호출하지 않으므로 비용이 들지 않고 네트워크 없이 동작합니다.
+
+    python mock_openai.py --port 8100 --ttft-ms 400 --token-ms 15 --error-rate 0.01
+    OPENAI_BASE_URL=http://127.0.0.1:8100/v1 OPENAI_API_KEY=mock python app_enhanced.py
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import math
+import os
+import random
+import time
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from context_window import estimate_message_tokens, estimate_tokens
+
+# 기본 설정 (환경 변수 또는 명령줄 옵션으로 변경 가능)
+MOCK_LATENCY_DIST = os.getenv("MOCK_LATENCY_DIST", "lognormal")
+MOCK_TTFT_MS = float(os.getenv("MOCK_TTFT_MS", "300"))
+MOCK_TOKEN_MS = float(os.getenv("MOCK_TOKEN_MS", "20"))
+MOCK_OUTPUT_TOKENS = int(os.getenv("MOCK_OUTPUT_TOKENS", "80"))
+MOCK_IMAGE_MS = float(os.getenv("MOCK_IMAGE_MS", "2000"))
+MOCK_ERROR_RATE = float(os.getenv("MOCK_ERROR_RATE", "0"))
+MOCK_RATE_LIMIT_RATE = float(os.getenv("MOCK_RATE_LIMIT_RATE", "0"))
+MOCK_STREAM_ERROR_RATE = float(os.getenv("MOCK_STREAM_ERROR_RATE", "0"))
+MOCK_RPM_LIMIT = int(os.getenv("MOCK_RPM_LIMIT", "0"))
+MOCK_TPM_LIMIT = int(os.getenv("MOCK_TPM_LIMIT", "0"))
+
+# 응답 본문으로 반복해서 내보낼 토큰 (대략 한 조각이 토큰 하나)
+_WORDS = ["모의", " 응답", "입니다", ".", " 부하", " 테스트", "를", " 위한", " 문장", "이", " 이어", "집니다", ". "]
+
+# 이 토큰 수마다 문단 구분 (응답 정리 경로도 함께 측정되도록)
+_PARAGRAPH_TOKENS = 40
+
+# lognormal 분포의 표준편차 (평균은 설정값으로 유지하고 꼬리만 길게)
+_LOGNORMAL_SIGMA = 0.6
+
+
+class MockConfig:
+    """대역 서버 동작 설정"""
+
+    def __init__(self, latency_dist=MOCK_LATENCY_DIST, ttft_ms=MOCK_TTFT_MS, token_ms=MOCK_TOKEN_MS,
+                 output_tokens=MOCK_OUTPUT_TOKENS, image_ms=MOCK_IMAGE_MS, error_rate=MOCK_ERROR_RATE,
+                 rate_limit_rate=MOCK_RATE_LIMIT_RATE, stream_error_rate=MOCK_STREAM_ERROR_RATE,
+                 rpm_limit=MOCK_RPM_LIMIT, tpm_limit=MOCK_TPM_LIMIT, seed=None):
+        self.latency_dist = latency_dist
+        self.ttft_ms = ttft_ms
+        self.token_ms = token_ms
+        self.output_tokens = output_tokens
+        self.image_ms = image_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.stream_error_rate = stream_error_rate
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.random = random.Random(seed)
+
+    def sample_ms(self, mean):
+        """설정한 분포에서 지연 시간(초) 하나를 뽑음 (평균 mean 밀리초)"""
+        if mean <= 0:
+            return 0.0
+        if self.latency_dist == "fixed":
+            value = mean
+        elif self.latency_dist == "uniform":
+            value = self.random.uniform(0.5 * mean, 1.5 * mean)
+        else:
+            mu = math.log(mean) - _LOGNORMAL_SIGMA ** 2 / 2
+            value = self.random.lognormvariate(mu, _LOGNORMAL_SIGMA)
+        return value / 1000
+
+    def sample_output_tokens(self, max_tokens):
+        count = max(1, round(self.random.uniform(0.5, 1.5) * self.output_tokens))
+        return min(count, max_tokens) if max_tokens else count
+
+
+class _Bucket:
+    """분당 한도 하나 (서버 쪽 한도를 흉내 내는 토큰 버킷)"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.level = float(limit)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.limit, self.level + self.limit / 60 * (now - self.updated))
+        self.updated = now
+
+    def reset_after(self):
+        """가득 찰 때까지 남은 시간 (초)"""
+        return (self.limit - self.level) / (self.limit / 60)
+
+
+def _format_duration(seconds):
+    """x-ratelimit-reset-* 형식 ("1.5s", "2m3s", "20ms")"""
+    if seconds < 1:
+        return f"{max(1, round(seconds * 1000))}ms"
+    minutes, seconds = divmod(seconds, 60)
+    return f"{int(minutes)}m{seconds:.0f}s" if minutes else f"{seconds:.1f}s"
+
+
+def _prompt_tokens(body):
+    messages = body.get("messages") or body.get("input") or []
+    if isinstance(messages, str):
+        return estimate_tokens(messages)
+    return sum(estimate_message_tokens(m) for m in messages)
+
+
+def _max_output_tokens(body):
+    return body.get("max_completion_tokens") or body.get("max_output_tokens") or body.get("max_tokens")
+
+
+def _text_pieces(count):
+    pieces = []
+    for i in range(count):
+        piece = _WORDS[i % len(_WORDS)]
+        if i and i % _PARAGRAPH_TOKENS == 0:
+            piece = "\n\n" + piece.lstrip()
+        pieces.append(piece)
+    return pieces
+
+
+# Responses API 메시지 content 배열에 올 수 있는 파트 형식
+_RESPONSE_PART_TYPES = ("input_text", "input_image", "input_file", "output_text", "refusal")
+
+
+def _error_body(message, error_type, code):
+    return {"error": {"message": message, "type": error_type, "param": None, "code": code}}
+
+
+def _sse(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def create_app(config=None):
+    """대역 서버 FastAPI 앱 생성"""
+    config = config or MockConfig()
+    app = FastAPI(title="Mock OpenAI API")
+    buckets = {}  # model -> (요청 버킷, 토큰 버킷)
+    stats = {"requests": 0, "in_flight": 0, "max_in_flight": 0, "injected_errors": 0,
+             "injected_rate_limits": 0, "rate_limited": 0, "stream_errors": 0,
+             "prompt_tokens": 0, "completion_tokens": 0, "client_request_ids": 0,
+             "files_uploaded": 0, "file_refs": 0, "missing_files": 0, "inline_image_bytes": 0}
+    image_cache = {}
+    files = {}  # file_id -> 파일 정보 (만료 시각 포함)
+    counter = iter(range(1, 1 << 62))
+
+    @app.middleware("http")
+    async def request_ids(request: Request, call_next):
+        """OpenAI처럼 응답마다 x-request-id를 붙이고, 클라이언트 요청 ID를 보낸 요청 수를 셈"""
+        if request.headers.get("x-client-request-id"):
+            stats["client_request_ids"] += 1
+        response = await call_next(request)
+        response.headers["x-request-id"] = f"req_mock_{next(counter)}"
+        return response
+
+    def admit(body):
+        """주입 오류와 분당 한도 확인 (거절하면 JSONResponse, 통과하면 응답 헤더 dict)"""
+        stats["requests"] += 1
+        if config.random.random() < config.error_rate:
+            stats["injected_errors"] += 1
+            return JSONResponse(_error_body("The server had an error processing your request.",
+                                            "server_error", "server_error"), status_code=500)
+        if config.random.random() < config.rate_limit_rate:
+            stats["injected_rate_limits"] += 1
+            return JSONResponse(_error_body("Rate limit reached (injected).", "requests", "rate_limit_exceeded"),
+                                status_code=429, headers={"retry-after-ms": "1000"})
+        if not config.rpm_limit and not config.tpm_limit:
+            return {}
+
+        model = body.get("model", "")
+        if model not in buckets:
+            buckets[model] = (_Bucket(config.rpm_limit or 1), _Bucket(config.tpm_limit or 1))
+        limits = (("requests", config.rpm_limit, buckets[model][0], 1),
+                  ("tokens", config.tpm_limit, buckets[model][1],
+                   _prompt_tokens(body) + (_max_output_tokens(body) or config.output_tokens)))
+        now = time.monotonic()
+        exceeded = False
+        for _, limit, bucket, cost in limits:
+            if limit:
+                bucket.refill(now)
+                exceeded = exceeded or bucket.level < cost
+        if not exceeded:
+            for _, limit, bucket, cost in limits:
+                if limit:
+                    bucket.level -= cost
+        headers = {}
+        for kind, limit, bucket, _ in limits:
+            if limit:
+                headers[f"x-ratelimit-limit-{kind}"] = str(limit)
+                headers[f"x-ratelimit-remaining-{kind}"] = str(max(0, math.floor(bucket.level)))
+                headers[f"x-ratelimit-reset-{kind}"] = _format_duration(bucket.reset_after())
+        if exceeded:
+            stats["rate_limited"] += 1
+            wait = max((cost - bucket.level) / (limit / 60)
+                       for _, limit, bucket, cost in limits if limit and bucket.level < cost)
+            return JSONResponse(_error_body("Rate limit reached.", "requests", "rate_limit_exceeded"),
+                                status_code=429, headers={**headers, "retry-after-ms": str(round(wait * 1000))})
+        return headers
+
+    def check_images(body):
+        """요청의 이미지 파트 집계 (없거나 만료된 file_id를 참조하면 404 JSONResponse)"""
+        messages = body.get("messages") or body.get("input") or []
+        for message in messages if isinstance(messages, list) else []:
+            content = message.get("content")
+            for part in content if isinstance(content, list) else []:
+                file_id = part.get("file_id") or (part.get("file") or {}).get("file_id")
+                image_url = part.get("image_url")
+                url = image_url.get("url", "") if isinstance(image_url, dict) else image_url or ""
+                if url.startswith("data:"):
+                    stats["inline_image_bytes"] += len(url)
+                if not file_id:
+                    continue
+                stats["file_refs"] += 1
+                info = files.get(file_id)
+                if info is None or (info["expires_at"] and info["expires_at"] <= time.time()):
+                    stats["missing_files"] += 1
+                    return JSONResponse(_error_body(f"No such File object: {file_id}", "invalid_request_error",
+                                                    "file_not_found"), status_code=404)
+        return None
+
+    def check_response_parts(body):
+        """Responses API 입력 파트 형식 검사 (Chat Completions 형식이 섞이면 400 JSONResponse)"""
+        messages = body.get("input")
+        for message in messages if isinstance(messages, list) else []:
+            content = message.get("content")
+            for part in content if isinstance(content, list) else []:
+                kind = part.get("type")
+                if kind not in _RESPONSE_PART_TYPES:
+                    return JSONResponse(_error_body(
+                        f"Invalid value: '{kind}'. Supported values are: {', '.join(_RESPONSE_PART_TYPES)}.",
+                        "invalid_request_error", "invalid_value"), status_code=400)
+                if kind == "input_image" and not (part.get("file_id") or isinstance(part.get("image_url"), str)):
+                    return JSONResponse(_error_body(
+                        "input_image requires file_id or an image_url string.",
+                        "invalid_request_error", "invalid_value"), status_code=400)
+        return None
+
+    @asynccontextmanager
+    async def in_flight():
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        try:
+            yield
+        finally:
+            stats["in_flight"] -= 1
+
+    async def tracked(gen):
+        async with in_flight():
+            async for part in gen:
+                yield part
+
+    async def generate(body, usage):
+        """첫 토큰 지연 후 토큰마다 간격을 두고 텍스트 조각 yield (None이면 스트림 오류 주입)"""
+        count = config.sample_output_tokens(_max_output_tokens(body))
+        usage["prompt_tokens"] = _prompt_tokens(body)
+        usage["completion_tokens"] = count
+        stats["prompt_tokens"] += usage["prompt_tokens"]
+        stats["completion_tokens"] += count
+        fail_at = count // 2 if config.random.random() < config.stream_error_rate else None
+        await asyncio.sleep(config.sample_ms(config.ttft_ms))
+        for i, piece in enumerate(_text_pieces(count)):
+            if i:
+                await asyncio.sleep(config.token_ms / 1000)
+            if i == fail_at:
+                stats["stream_errors"] += 1
+                yield None
+                return
+            yield piece
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        admitted = admit(body)
+        if isinstance(admitted, Response):
+            return admitted
+        missing = check_images(body)
+        if missing is not None:
+            return missing
+        completion_id = f"chatcmpl-mock-{next(counter)}"
+        created = int(time.time())
+        model = body.get("model", "mock")
+        usage = {}
+
+        def usage_body():
+            return {**usage, "total_tokens": usage["prompt_tokens"] + usage["completion_tokens"]}
+
+        if not body.get("stream"):
+            pieces = [piece async for piece in tracked(generate(body, usage))]
+            if None in pieces:
+                return JSONResponse(_error_body("The server had an error while processing your request.",
+                                                "server_error", "server_error"), status_code=500)
+            return JSONResponse({
+                "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(pieces)},
+                             "finish_reason": "stop"}],
+                "usage": usage_body(),
+            }, headers=admitted)
+
+        async def events():
+            def chunk(delta, finish_reason=None):
+                return {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+            yield _sse(chunk({"role": "assistant", "content": ""}))
+            async for piece in generate(body, usage):
+                if piece is None:
+                    yield _sse(_error_body("The server had an error while processing your request.",
+                                           "server_error", "server_error"))
+                    return
+                yield _sse(chunk({"content": piece}))
+            yield _sse(chunk({}, "stop"))
+            if (body.get("stream_options") or {}).get("include_usage"):
+                yield _sse({"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                            "model": model, "choices": [], "usage": usage_body()})
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(tracked(events()), media_type="text/event-stream", headers=admitted)
+
+    @app.post("/v1/responses")
+    async def responses(request: Request):
+        body = await request.json()
+        admitted = admit(body)
+        if isinstance(admitted, Response):
+            return admitted
+        invalid = check_response_parts(body)
+        if invalid is not None:
+            return invalid
+        missing = check_images(body)
+        if missing is not None:
+            return missing
+        response_id = f"resp_mock_{next(counter)}"
+        message_id = f"msg_mock_{next(counter)}"
+        model = body.get("model", "mock")
+        usage = {}
+
+        def response_body(status, text=None):
+            output = []
+            if text is not None:
+                output = [{"type": "message", "id": message_id, "status": "completed", "role": "assistant",
+                           "content": [{"type": "output_text", "text": text, "annotations": []}]}]
+            result = {"id": response_id, "object": "response", "created_at": int(time.time()), "status": status,
+                      "model": model, "output": output, "error": None, "incomplete_details": None,
+                      "parallel_tool_calls": True, "tool_choice": "auto", "tools": []}
+            if usage:
+                result["usage"] = {"input_tokens": usage["prompt_tokens"],
+                                   "output_tokens": usage["completion_tokens"],
+                                   "total_tokens": usage["prompt_tokens"] + usage["completion_tokens"]}
+            return result
+
+        if not body.get("stream"):
+            pieces = [piece async for piece in tracked(generate(body, usage))]
+            if None in pieces:
+                return JSONResponse(_error_body("The server had an error while processing your request.",
+                                                "server_error", "server_error"), status_code=500)
+            return JSONResponse(response_body("completed", "".join(pieces)), headers=admitted)
+
+        async def events():
+            sequence = iter(range(1 << 62))
+            yield _sse({"type": "response.created", "sequence_number": next(sequence),
+                        "response": response_body("in_progress")}, "response.created")
+            pieces = []
+            async for piece in generate(body, usage):
+                if piece is None:
+                    yield _sse({"type": "error", "sequence_number": next(sequence), "code": "server_error",
+                                "message": "The server had an error while processing your request.", "param": None},
+                               "error")
+                    return
+                pieces.append(piece)
+                yield _sse({"type": "response.output_text.delta", "sequence_number": next(sequence),
+                            "item_id": message_id, "output_index": 0, "content_index": 0, "delta": piece,
+                            "logprobs": []}, "response.output_text.delta")
+            yield _sse({"type": "response.completed", "sequence_number": next(sequence),
+                        "response": response_body("completed", "".join(pieces))}, "response.completed")
+
+        return StreamingResponse(tracked(events()), media_type="text/event-stream", headers=admitted)
+
+    @app.post("/v1/images/generations")
+    async def images_generations(request: Request):
+        body = await request.json()
+        admitted = admit(body)
+        if isinstance(admitted, Response):
+            return admitted
+        async with in_flight():
+            await asyncio.sleep(config.sample_ms(config.image_ms))
+        size = body.get("size") or "1024x1024"
+        image_id = next(counter)
+        if body.get("response_format") == "b64_json" or body.get("model", "").startswith("gpt-image"):
+            data = {"b64_json": base64.b64encode(_render_image(image_cache, size)).decode()}
+        else:
+            data = {"url": f"{str(request.base_url).rstrip('/')}/mock/images/{image_id}.png?size={size}"}
+        return JSONResponse({"created": int(time.time()), "data": [{**data, "revised_prompt": body.get("prompt")}]},
+                            headers=admitted)
+
+    @app.post("/v1/files")
+    async def upload_file(request: Request):
+        form = await request.form()
+        upload = form.get("file")
+        if upload is None or not hasattr(upload, "read"):
+            return JSONResponse(_error_body("Missing file.", "invalid_request_error", None), status_code=400)
+        data = await upload.read()
+        created = int(time.time())
+        seconds = form.get("expires_after[seconds]")
+        file_id = f"file-mock{next(counter)}"
+        files[file_id] = {
+            "id": file_id, "object": "file", "bytes": len(data), "created_at": created,
+            "expires_at": created + int(seconds) if seconds else None,
+            "filename": upload.filename, "purpose": form.get("purpose", "user_data"), "status": "processed",
+        }
+        stats["files_uploaded"] += 1
+        return JSONResponse(files[file_id])
+
+    @app.get("/v1/files")
+    async def list_files():
+        return JSONResponse({"object": "list", "data": list(files.values()), "has_more": False})
+
+    @app.get("/v1/files/{file_id}")
+    async def get_file(file_id: str):
+        if file_id not in files:
+            return JSONResponse(_error_body(f"No such File object: {file_id}", "invalid_request_error",
+                                            "file_not_found"), status_code=404)
+        return JSONResponse(files[file_id])
+
+    @app.delete("/v1/files/{file_id}")
+    async def delete_file(file_id: str):
+        """파일 삭제 (만료 전에 업스트림에서 사라진 경우를 흉내 낼 때 사용)"""
+        if files.pop(file_id, None) is None:
+            return JSONResponse(_error_body(f"No such File object: {file_id}", "invalid_request_error",
+                                            "file_not_found"), status_code=404)
+        return JSONResponse({"id": file_id, "object": "file", "deleted": True})
+
+    @app.get("/mock/images/{name}")
+    async def image_file(name: str, size: str = "1024x1024"):
+        return Response(_render_image(image_cache, size), media_type="image/png")
+
+    @app.get("/mock/stats")
+    async def mock_stats():
+        """지금까지 받은 요청과 주입한 오류 수"""
+        return stats
+
+    @app.post("/mock/reset")
+    async def mock_reset():
+        for key in stats:
+            if key != "in_flight":
+                stats[key] = 0
+        stats["max_in_flight"] = stats["in_flight"]
+        buckets.clear()
+        return stats
+
+    return app
+
+
+def _render_image(cache, size):
+    """size 크기의 단색 PNG (크기별로 한 번만 만듦)"""
+    if size not in cache:
+        from PIL import Image
+        try:
+            width, height = (int(v) for v in size.split("x"))
+        except ValueError:
+            width = height = 1024
+        buffer = io.BytesIO()
+        Image.new("RGB", (width, height), (90, 120, 200)).save(buffer, format="PNG")
+        cache[size] = buffer.getvalue()
+    return cache[size]
+
+
+def add_arguments(parser):
+    """대역 서버 동작 옵션 추가"""
+    parser.add_argument("--latency-dist", choices=["fixed", "uniform", "lognormal"], default=MOCK_LATENCY_DIST,
+                        help="첫 토큰/이미지 지연 분포 (기본 lognormal)")
+    parser.add_argument("--ttft-ms", type=float, default=MOCK_TTFT_MS, help="첫 토큰까지 평균 지연 (밀리초)")
+    parser.add_argument("--token-ms", type=float, default=MOCK_TOKEN_MS, help="토큰 사이 간격 (밀리초)")
+    parser.add_argument("--output-tokens", type=int, default=MOCK_OUTPUT_TOKENS, help="평균 출력 토큰 수")
+    parser.add_argument("--image-ms", type=float, default=MOCK_IMAGE_MS, help="이미지 생성 평균 지연 (밀리초)")
+    parser.add_argument("--error-rate", type=float, default=MOCK_ERROR_RATE, help="500 오류 주입 비율 (0~1)")
+    parser.add_argument("--rate-limit-rate", type=float, default=MOCK_RATE_LIMIT_RATE,
+                        help="429 오류 주입 비율 (0~1)")
+    parser.add_argument("--stream-error-rate", type=float, default=MOCK_STREAM_ERROR_RATE,
+                        help="응답 도중 오류 주입 비율 (0~1)")
+    parser.add_argument("--rpm-limit", type=int, default=MOCK_RPM_LIMIT,
+                        help="모델별 분당 요청 한도 (0이면 한도와 x-ratelimit 헤더 없음)")
+    parser.add_argument("--tpm-limit", type=int, default=MOCK_TPM_LIMIT, help="모델별 분당 토큰 한도 (0이면 없음)")
+    parser.add_argument("--seed", type=int, help="난수 시드 (같은 값이면 같은 지연/오류 순서)")
+
+
+def config_from_args(args):
+    return MockConfig(
+        latency_dist=args.latency_dist, ttft_ms=args.ttft_ms, token_ms=args.token_ms,
+        output_tokens=args.output_tokens, image_ms=args.image_ms, error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate, stream_error_rate=args.stream_error_rate,
+        rpm_limit=args.rpm_limit, tpm_limit=args.tpm_limit, seed=args.seed,
+    )
+
+
+def main():
+    import uvicorn
+    parser = argparse.ArgumentParser(description="로컬 OpenAI API 대역 서버")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    add_arguments(parser)
+    args = parser.parse_args()
+    print(f"OPENAI_BASE_URL=http://{args.host}:{args.port}/v1", flush=True)
+    uvicorn.run(create_app(config_from_args(args)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
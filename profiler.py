@@ -0,0 +1,265 @@
+import asyncio
+import contextvars
+import functools
+import hmac
+import os
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+
+# 디버그 엔드포인트와 요청별 프로파일 헤더에 필요한 토큰 (비워 두면 둘 다 비활성화)
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN", "")
+
+# 샘플링 간격 (밀리초), 한 번에 캡처할 수 있는 최대 시간 (초)
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+
+# 이벤트 루프가 이 시간(밀리초) 이상 다른 작업을 처리하지 못하면 멈춤(stall)으로 기록
+PROFILE_STALL_MS = float(os.getenv("PROFILE_STALL_MS", "100"))
+
+# 조회용으로 보관할 요청별 프로파일 수
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "20"))
+
+# 이벤트 루프 하트비트 간격 (초)
+_HEARTBEAT = 0.01
+
+# 스택 최대 깊이
+_MAX_DEPTH = 128
+
+# 맨 위 프레임이 이 함수이면 기다리는 중인 스레드로 보고 기본적으로 제외
+_IDLE_FRAMES = {
+    ("selectors", "select"),
+    ("threading", "wait"),
+    ("threading", "_wait_for_tstate_lock"),
+    ("queue", "get"),
+    ("concurrent.futures.thread", "_worker"),
+    ("asyncio.runners", "run"),
+}
+
+# 요청별 프로파일 중인 요청의 컨텍스트 표시
+_request_profile = contextvars.ContextVar("request_profile", default=None)
+
+
+def check_debug_token(token):
+    """디버그 토큰 확인 (DEBUG_TOKEN이 비어 있으면 항상 거부)"""
+    # str끼리 비교하면 ASCII가 아닌 문자가 있을 때 TypeError가 나므로 바이트로 비교
+    return bool(DEBUG_TOKEN) and token is not None and hmac.compare_digest(token.encode(), DEBUG_TOKEN.encode())
+
+
+def _frame_name(frame):
+    return f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_qualname}"
+
+
+def _is_idle(frame):
+    return (frame.f_globals.get("__name__"), frame.f_code.co_name) in _IDLE_FRAMES
+
+
+def _executor_context(frame):
+    """스레드 풀 작업 프레임이면 asyncio.to_thread가 넘긴 contextvars.Context 반환"""
+    while frame is not None:
+        if frame.f_code.co_name == "run" and frame.f_globals.get("__name__") == "concurrent.futures.thread":
+            fn = getattr(frame.f_locals.get("self"), "fn", None)
+            if isinstance(fn, functools.partial):
+                context = getattr(fn.func, "__self__", None)
+                if isinstance(context, contextvars.Context):
+                    return context
+            return None
+        frame = frame.f_back
+    return None
+
+
+class Profile:
+    """스택 샘플링 프로파일 (collapsed stack 형식으로 출력, 이벤트 루프 멈춤 감지 포함)
+
+    start()로 별도 스레드에서 interval마다 모든 스레드의 스택을 수집하고, 이벤트 루프에는
+    하트비트 콜백을 걸어 루프가 stall_ms 이상 늦어지면 그동안의 루프 스레드 스택과 함께 기록합니다.
+    request가 지정되면 그 요청의 태스크가 실행 중이거나 그 요청이 스레드 풀에 넘긴 작업만 수집합니다.
+    """
+
+    def __init__(self, loop, interval_ms=PROFILE_INTERVAL_MS, stall_ms=PROFILE_STALL_MS,
+                 include_idle=False, request=False):
+        self.loop = loop
+        self.interval = max(interval_ms, 1) / 1000
+        self.stall = stall_ms / 1000
+        self.include_idle = include_idle
+        self.tasks = set() if request else None
+        self.stacks = Counter()
+        self.samples = 0
+        self.idle_samples = 0
+        self.stalls = []
+        self.max_loop_lag = 0.0
+        self._loop_thread = threading.get_ident()
+        self._stall_stacks = Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_beat = None
+        self.started = None
+        self.elapsed = 0.0
+
+    def start(self):
+        """샘플링 시작 (이벤트 루프 스레드에서 호출)"""
+        self.started = time.monotonic()
+        self._last_beat = self.started
+        self.loop.call_later(_HEARTBEAT, self._beat, self.started + _HEARTBEAT)
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.elapsed = time.monotonic() - self.started
+
+    def _beat(self, expected):
+        # 예정보다 늦게 불렸으면 그만큼 루프가 다른 작업에 막혀 있던 것
+        now = time.monotonic()
+        lag = now - expected
+        with self._lock:
+            self._last_beat = now
+            self.max_loop_lag = max(self.max_loop_lag, lag)
+            if lag >= self.stall:
+                stack = self._stall_stacks.most_common(1)
+                self.stalls.append({
+                    "at_ms": round((expected - self.started) * 1000, 1),
+                    "duration_ms": round(lag * 1000, 1),
+                    "stack": stack[0][0] if stack else None,
+                })
+            self._stall_stacks.clear()
+        if not self._stop.is_set():
+            self.loop.call_later(_HEARTBEAT, self._beat, now + _HEARTBEAT)
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            now = time.monotonic()
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    self._sample(ident, names.get(ident, str(ident)), frame, now)
+
+    def _belongs(self, ident, frame):
+        if ident == self._loop_thread:
+            return asyncio.current_task(self.loop) in self.tasks
+        context = _executor_context(frame)
+        return context is not None and context.get(_request_profile) is self
+
+    def _sample(self, ident, thread_name, frame, now):
+        if self.tasks is not None and not self._belongs(ident, frame):
+            return
+        if not self.include_idle and _is_idle(frame):
+            self.idle_samples += 1
+            return
+        frames = []
+        while frame is not None and len(frames) < _MAX_DEPTH:
+            frames.append(_frame_name(frame))
+            frame = frame.f_back
+        frames.reverse()
+        root = thread_name
+        with self._lock:
+            if ident == self._loop_thread:
+                root = "event-loop"
+                if now - self._last_beat >= _HEARTBEAT + self.stall:
+                    root = "event-loop [stalled]"
+                    self._stall_stacks[";".join(frames)] += 1
+            self.stacks[(root, *frames)] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        """flamegraph.pl/speedscope에서 읽을 수 있는 collapsed stack 텍스트"""
+        with self._lock:
+            items = sorted(self.stacks.items())
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in items)
+
+    def summary(self):
+        with self._lock:
+            return {
+                "seconds": round(self.elapsed, 3),
+                "interval_ms": self.interval * 1000,
+                "samples": self.samples,
+                "idle_samples": self.idle_samples,
+                "max_loop_lag_ms": round(self.max_loop_lag * 1000, 1),
+                "stalls": list(self.stalls),
+            }
+
+
+_capture_lock = asyncio.Lock()
+
+
+async def capture(seconds, interval_ms=PROFILE_INTERVAL_MS, include_idle=False):
+    """현재 프로세스를 seconds초 동안 프로파일 (동시에 하나만 실행, 이미 실행 중이면 None)"""
+    if _capture_lock.locked():
+        return None
+    async with _capture_lock:
+        profile = Profile(asyncio.get_running_loop(), interval_ms, include_idle=include_idle)
+        profile.start()
+        try:
+            await asyncio.sleep(min(seconds, PROFILE_MAX_SECONDS))
+        finally:
+            profile.stop()
+        return profile
+
+
+def _task_factory(loop, coro, **kwargs):
+    # 프로파일 중인 요청이 만든 태스크도 그 요청의 것으로 표시 (스트리밍 응답, 일괄 요청 항목 등)
+    task = asyncio.Task(coro, loop=loop, **kwargs)
+    context = kwargs.get("context")
+    profile = context.get(_request_profile) if context is not None else _request_profile.get()
+    if profile is not None:
+        profile.tasks.add(task)
+    return task
+
+
+_request_profiles = OrderedDict()
+
+
+def get_request_profile(request_id):
+    """보관 중인 요청별 프로파일 (없으면 None)"""
+    return _request_profiles.get(request_id)
+
+
+class ProfileMiddleware:
+    """X-Profile 헤더와 올바른 X-Debug-Token이 있는 요청만 처음부터 끝까지 프로파일하는 ASGI 미들웨어
+
+    결과는 request_id(scope)로 보관하고 응답의 X-Profile-Id 헤더로 알려줍니다.
+    """
+
+    def __init__(self, app, request_id):
+        self.app = app
+        self.request_id = request_id
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not DEBUG_TOKEN:
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        if headers.get(b"x-profile", b"0") in (b"", b"0", b"false") or not check_debug_token(
+            headers.get(b"x-debug-token", b"").decode("latin-1")
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        loop = asyncio.get_running_loop()
+        if loop.get_task_factory() is None:
+            loop.set_task_factory(_task_factory)
+        profile_id = self.request_id(scope)
+        profile = Profile(loop, request=True)
+        profile.tasks.add(asyncio.current_task())
+        token = _request_profile.set(profile)
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-profile-id", profile_id.encode("latin-1"))
+                ]
+            await send(message)
+
+        profile.start()
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            profile.stop()
+            _request_profile.reset(token)
+            _request_profiles[profile_id] = profile
+            while len(_request_profiles) > PROFILE_KEEP:
+                _request_profiles.popitem(last=False)
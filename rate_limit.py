@@ -0,0 +1,244 @@
+import asyncio
+import contextvars
+import json
+import os
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from context_window import estimate_message_tokens, estimate_tokens
+
+# 기본 설정 (환경 변수로 변경 가능)
+RATE_LIMIT_PACING = os.getenv("RATE_LIMIT_PACING", "1") != "0"
+RATE_LIMIT_HEADROOM = float(os.getenv("RATE_LIMIT_HEADROOM", "0.9"))
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "60"))
+RATE_LIMIT_DEFAULT_OUTPUT_TOKENS = int(os.getenv("RATE_LIMIT_DEFAULT_OUTPUT_TOKENS", "1000"))
+
+# 토큰 비용을 추정해 속도를 조절할 엔드포인트
+_PACED_PATHS = ("/chat/completions", "/responses")
+
+# 한도를 모르는 모델은 첫 요청의 응답 헤더를 이 시간(초)까지 기다린 뒤 보냄
+# (그때까지 응답이 없으면 연결 실패 등으로 보고 헤더를 받을 때까지 제한 없이 보냄)
+_PROBE_TIMEOUT = 5.0
+_PROBE_POLL = 0.05
+
+
+# 호출 측이 이미 계산한 (모델, 예상 비용) (있으면 reserve가 요청 본문을 다시 해석하지 않음)
+_request_cost = contextvars.ContextVar("rate_limit_request_cost", default=None)
+
+
+@contextmanager
+def request_cost(model, cost):
+    """이 블록 안에서 보내는 요청의 모델과 예상 토큰 비용을 지정
+
+    이미지 요청 본문은 수 MB의 base64를 담을 수 있으므로, 호출 측이 이미 계산한 값을 넘겨
+    이벤트 루프에서 본문을 JSON으로 다시 해석하지 않도록 합니다.
+    """
+    previous = _request_cost.get()
+    _request_cost.set((model, cost))
+    try:
+        yield
+    finally:
+        # 비동기 제너레이터 안에서도 쓸 수 있도록 토큰 대신 이전 값으로 되돌림
+        _request_cost.set(previous)
+
+
+def estimate_request_tokens(body):
+    """요청 본문의 예상 토큰 비용 (프롬프트 추정 + 최대 출력 토큰)"""
+    messages = body.get("messages") or body.get("input") or []
+    if isinstance(messages, str):
+        prompt_tokens = estimate_tokens(messages)
+    else:
+        prompt_tokens = sum(estimate_message_tokens(m) for m in messages)
+    output_tokens = (
+        body.get("max_completion_tokens")
+        or body.get("max_output_tokens")
+        or body.get("max_tokens")
+        or RATE_LIMIT_DEFAULT_OUTPUT_TOKENS
+    )
+    return prompt_tokens + output_tokens
+
+
+class _Bucket:
+    """분당 한도(요청 수 또는 토큰 수) 하나의 토큰 버킷 (한도를 알기 전에는 제한 없음)"""
+
+    def __init__(self):
+        self.limit = None
+        self.level = 0.0
+        self.updated = time.monotonic()
+
+    @property
+    def capacity(self):
+        return self.limit * RATE_LIMIT_HEADROOM
+
+    @property
+    def rate(self):
+        return self.capacity / 60
+
+    def refill(self, now):
+        if self.limit:
+            self.level = min(self.capacity, self.level + self.rate * (now - self.updated))
+        self.updated = now
+
+    def observe(self, limit, remaining, authoritative):
+        """응답 헤더의 한도/남은 양 반영 (여유분 headroom을 남김)"""
+        self.limit = limit
+        level = remaining - limit * (1 - RATE_LIMIT_HEADROOM)
+        self.level = level if authoritative else min(self.level, level)
+
+
+class _ModelLimits:
+    def __init__(self):
+        self.requests = _Bucket()
+        self.tokens = _Bucket()
+        self.last_seq = 0
+        self.probe_started = None  # 한도를 파악하기 위한 첫 요청을 보낸 시각
+        self.probed = False  # 첫 응답을 받았거나 기다리기를 포기했는지 (이후 헤더를 받기 전까지 제한 없음)
+
+
+class RateLimiter:
+    """API 키 하나의 클라이언트 측 속도 조절기
+
+    x-ratelimit-limit/remaining-* 응답 헤더로 모델별 분당 요청/토큰 한도와 남은 양을
+    파악하고, 보내기 전에 요청마다 예상 비용을 차감해 버킷이 비면 채워질 때까지
+    기다리게 합니다. 429를 받기 전에 미리 속도를 늦추는 것이 목적입니다.
+    httpx 클라이언트의 event_hooks로 연결하므로 모든 API 호출에 적용됩니다.
+    """
+
+    def __init__(self, max_wait=RATE_LIMIT_MAX_WAIT, enabled=RATE_LIMIT_PACING):
+        self.max_wait = max_wait
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._models = {}
+        self._pending = weakref.WeakKeyDictionary()  # request -> (model, seq)
+        self.stats = {"paced": 0, "paced_seconds": 0.0, "rate_limited": 0}
+
+    def reserve(self, request):
+        """요청 비용을 차감하고 보내기 전에 기다릴 시간(초)을 반환
+
+        한도를 아직 모르는 모델에 첫 요청이 진행 중이면 None을 반환하며,
+        호출 측은 잠시 뒤 다시 호출해야 합니다 (동시에 몰린 첫 요청이 한꺼번에 나가지 않도록).
+        첫 요청이 _PROBE_TIMEOUT 안에 응답을 받지 못하면 (연결 실패 등) 더 기다리지 않습니다.
+        """
+        if not self.enabled or request.method != "POST" or not request.url.path.endswith(_PACED_PATHS):
+            return 0.0
+        known = _request_cost.get()
+        if known is not None:
+            model, cost = known
+        else:
+            try:
+                body = json.loads(request.content)
+            except ValueError:
+                return 0.0
+            model = body.get("model")
+            cost = estimate_request_tokens(body)
+
+        now = time.monotonic()
+        wait = 0.0
+        with self._lock:
+            limits = self._models.setdefault(model, _ModelLimits())
+            if not limits.probed:
+                if limits.probe_started is None:
+                    limits.probe_started = now
+                elif now - limits.probe_started < _PROBE_TIMEOUT:
+                    return None
+                else:
+                    limits.probed = True
+            limits.last_seq += 1
+            self._pending[request] = (model, limits.last_seq)
+            for bucket, amount in ((limits.requests, 1), (limits.tokens, cost)):
+                if not bucket.limit:
+                    continue
+                bucket.refill(now)
+                bucket.level -= amount
+                if bucket.level < 0:
+                    wait = max(wait, -bucket.level / bucket.rate)
+            wait = min(wait, self.max_wait)
+            if wait > 0:
+                self.stats["paced"] += 1
+                self.stats["paced_seconds"] += wait
+        return wait
+
+    def update(self, response):
+        """응답 헤더로 버킷 갱신 (가장 최근에 보낸 요청의 응답이면 헤더 값을 그대로 신뢰)"""
+        with self._lock:
+            pending = self._pending.pop(response.request, None)
+            if pending is None:
+                return
+            model, seq = pending
+            limits = self._models[model]
+            limits.probed = True
+            now = time.monotonic()
+            for kind, bucket in (("requests", limits.requests), ("tokens", limits.tokens)):
+                limit = response.headers.get(f"x-ratelimit-limit-{kind}")
+                remaining = response.headers.get(f"x-ratelimit-remaining-{kind}")
+                if limit is None or remaining is None:
+                    continue
+                try:
+                    bucket.refill(now)
+                    bucket.observe(int(limit), int(remaining), authoritative=seq == limits.last_seq)
+                except ValueError:
+                    continue
+            if response.status_code == 429:
+                self.stats["rate_limited"] += 1
+                for bucket in (limits.requests, limits.tokens):
+                    bucket.level = min(bucket.level, 0.0)
+
+    def event_hooks(self):
+        """동기 httpx.Client용 event_hooks"""
+        def on_request(request):
+            started = time.monotonic()
+            while (wait := self.reserve(request)) is None:
+                time.sleep(_PROBE_POLL)
+            # 첫 응답을 기다린 시간을 포함해 max_wait까지만 기다림
+            wait = min(wait, self.max_wait - (time.monotonic() - started))
+            if wait > 0:
+                time.sleep(wait)
+
+        return {"request": [on_request], "response": [self.update]}
+
+    def async_event_hooks(self):
+        """httpx.AsyncClient용 event_hooks"""
+        async def on_request(request):
+            started = time.monotonic()
+            while (wait := self.reserve(request)) is None:
+                await asyncio.sleep(_PROBE_POLL)
+            wait = min(wait, self.max_wait - (time.monotonic() - started))
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+        async def on_response(response):
+            self.update(response)
+
+        return {"request": [on_request], "response": [on_response]}
+
+    def snapshot(self):
+        """모델별 분당 한도와 현재 버킷 잔량, 속도 조절 횟수"""
+        now = time.monotonic()
+        with self._lock:
+            models = {}
+            for model, limits in self._models.items():
+                entry = {}
+                for kind, bucket in (("requests", limits.requests), ("tokens", limits.tokens)):
+                    bucket.refill(now)
+                    entry[f"limit_{kind}"] = bucket.limit
+                    entry[f"available_{kind}"] = round(bucket.level) if bucket.limit else None
+                models[model] = entry
+            return {
+                **self.stats,
+                "paced_seconds": round(self.stats["paced_seconds"], 2),
+                "models": models,
+            }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(api_key):
+    """API 키별로 프로세스 전체에서 공유하는 속도 조절기 반환"""
+    with _limiters_lock:
+        limiter = _limiters.get(api_key)
+        if limiter is None:
+            limiter = _limiters[api_key] = RateLimiter()
+        return limiter
@@ -0,0 +1,284 @@
+import asyncio
+import os
+import random
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+import httpx
+import openai
+
+# 기본 설정 (환경 변수로 변경 가능)
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "4"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "20"))
+UPSTREAM_DEADLINE = float(os.getenv("UPSTREAM_DEADLINE", "90"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+
+# 다시 시도하면 성공할 수 있는 HTTP 상태 코드
+_RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+# 스트림 오류 이벤트의 코드 중 다시 시도할 수 있는 것
+_RETRYABLE_CODES = {"server_error", "rate_limit_exceeded", "overloaded"}
+
+# 다시 시도해도 소용없는 429 (요금/할당량 소진)
+_NON_RETRYABLE_CODES = {"insufficient_quota"}
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+class UpstreamError(RuntimeError):
+    """스트림 도중 전달된 업스트림 오류 (code로 재시도 여부 판단)"""
+
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+class CircuitOpenError(RuntimeError):
+    """업스트림 장애로 서킷이 열려 호출하지 않고 바로 실패"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"업스트림 서비스가 불안정해 잠시 요청을 중단했습니다. {retry_after:.0f}초 후 다시 시도해주세요.")
+        self.retry_after = retry_after
+
+
+def is_retryable(error):
+    """다시 시도하면 성공할 수 있는 오류인지 판단 (요청 오류, 인증 오류 등은 False)"""
+    code = getattr(error, "code", None)
+    if code in _NON_RETRYABLE_CODES:
+        return False
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in _RETRYABLE_STATUS
+    if isinstance(error, (openai.APIConnectionError, httpx.TransportError, ConnectionError, TimeoutError)):
+        return True
+    if isinstance(error, (openai.APIError, UpstreamError)):
+        return code in _RETRYABLE_CODES
+    return False
+
+
+def _parse_duration(value):
+    """x-ratelimit-reset-* 형식("1s", "6m0s", "20ms")을 초로 변환"""
+    parts = _DURATION_PART.findall(value or "")
+    if not parts:
+        return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+def retry_after(error):
+    """응답 헤더가 알려주는 재시도까지의 대기 시간(초) (없으면 None)
+
+    retry-after-ms, retry-after(초 또는 HTTP 날짜) 순으로 확인하고, 없으면
+    소진된 x-ratelimit-remaining-* 항목의 x-ratelimit-reset-* 값을 사용합니다.
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if value:
+            try:
+                return float(value)
+            except ValueError:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        pass
+    resets = [
+        _parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+        for kind in ("requests", "tokens")
+        if headers.get(f"x-ratelimit-remaining-{kind}") == "0"
+    ]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+
+class CircuitBreaker:
+    """연속 실패가 쌓이면 일정 시간 업스트림 호출을 막는 서킷 브레이커
+
+    closed: 정상 / open: reset_timeout 동안 바로 실패 / half_open: 시험 호출 하나만 허용.
+    시험 호출이 성공하면 닫히고, 실패하면 다시 열립니다.
+    """
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probe_started_at = None
+        self.stats = {"opened": 0, "rejected": 0}
+
+    def before_call(self):
+        """호출해도 되는지 확인 (막혀 있으면 CircuitOpenError)"""
+        with self._lock:
+            if self.state == "closed":
+                return
+            now = time.monotonic()
+            if self.state == "open":
+                remaining = self._opened_at + self.reset_timeout - now
+                if remaining > 0:
+                    self.stats["rejected"] += 1
+                    raise CircuitOpenError(remaining)
+                self.state = "half_open"
+                self._probe_started_at = None
+            # 시험 호출이 끝나지 않은 채 버려졌으면 reset_timeout 후 다시 허용
+            if self._probe_started_at is not None and now - self._probe_started_at < self.reset_timeout:
+                self.stats["rejected"] += 1
+                raise CircuitOpenError(self.reset_timeout - (now - self._probe_started_at))
+            self._probe_started_at = now
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._probe_started_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.stats["opened"] += 1
+                self.state = "open"
+                self._opened_at = time.monotonic()
+                self._probe_started_at = None
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.stats, "state": self.state, "failures": self.failures}
+
+
+class RetryState:
+    """호출 하나의 재시도 진행 상황 (RetryPolicy.begin()으로 생성)
+
+    사용법:
+        state = policy.begin()
+        while True:
+            try:
+                result = call(timeout=state.timeout())
+                state.succeeded()
+                break
+            except Exception as e:
+                time.sleep(state.failed(e))  # 재시도할 수 없으면 e를 다시 발생
+    """
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.attempt = 1
+        self.deadline = time.monotonic() + policy.deadline
+        self._delay = policy.base_delay
+        policy.breaker.before_call()
+
+    def timeout(self):
+        """이번 시도에 쓸 수 있는 남은 시간 (요청 timeout으로 전달)"""
+        return max(0.1, self.deadline - time.monotonic())
+
+    def succeeded(self):
+        self.policy.breaker.record_success()
+
+    def failed(self, error, can_retry=True):
+        """실패를 기록하고 다음 시도까지 기다릴 시간(초)을 반환
+
+        재시도할 수 없는 오류이거나 시도 횟수/데드라인을 넘으면 error를 다시 발생시킵니다.
+        """
+        breaker = self.policy.breaker
+        if not is_retryable(error):
+            # 업스트림은 응답했으므로 서킷에는 성공으로 기록
+            breaker.record_success()
+            raise error
+        breaker.record_failure()
+        if not can_retry or self.attempt >= self.policy.max_attempts:
+            raise error
+
+        # decorrelated jitter: 이전 대기의 3배 범위 안에서 무작위로 (동시에 몰리지 않도록)
+        self._delay = min(self.policy.max_delay, random.uniform(self.policy.base_delay, self._delay * 3))
+        delay = self._delay
+        hinted = retry_after(error)
+        if hinted is not None:
+            delay = max(delay, hinted)
+        if time.monotonic() + delay >= self.deadline:
+            raise error
+        breaker.before_call()
+        self.attempt += 1
+        return delay
+
+
+class RetryPolicy:
+    """오류 분류, 지수 백오프(decorrelated jitter), Retry-After, 데드라인, 서킷 브레이커를
+    묶은 업스트림 호출 정책"""
+
+    def __init__(self, max_attempts=RETRY_MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY,
+                 max_delay=RETRY_MAX_DELAY, deadline=UPSTREAM_DEADLINE, breaker=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.breaker = breaker or get_circuit_breaker()
+
+    def begin(self):
+        """호출 하나의 재시도 상태 시작 (서킷이 열려 있으면 CircuitOpenError)"""
+        return RetryState(self)
+
+    def call(self, create, **params):
+        """동기 API 호출을 정책에 따라 재시도"""
+        state = self.begin()
+        while True:
+            try:
+                result = create(**params, timeout=state.timeout())
+                state.succeeded()
+                return result
+            except Exception as e:
+                time.sleep(state.failed(e))
+
+    async def call_async(self, create, **params):
+        """비동기 API 호출을 정책에 따라 재시도"""
+        state = self.begin()
+        while True:
+            try:
+                result = await create(**params, timeout=state.timeout())
+                state.succeeded()
+                return result
+            except Exception as e:
+                await asyncio.sleep(state.failed(e))
+
+    async def stream_async(self, create, **params):
+        """비동기 스트림의 청크를 yield
+
+        첫 청크를 받기 전의 실패만 재시도합니다. 이미 전달한 내용은 되돌릴 수 없으므로
+        그 이후의 실패는 서킷에 기록한 뒤 그대로 발생시킵니다.
+        """
+        state = self.begin()
+        while True:
+            started = False
+            try:
+                stream = await create(**params, timeout=state.timeout())
+                try:
+                    async for chunk in stream:
+                        started = True
+                        yield chunk
+                finally:
+                    await stream.close()
+                state.succeeded()
+                return
+            except Exception as e:
+                await asyncio.sleep(state.failed(e, can_retry=not started))
+
+
+_breaker = None
+_breaker_lock = threading.Lock()
+
+
+def get_circuit_breaker():
+    """프로세스 전체에서 공유하는 업스트림 서킷 브레이커 반환"""
+    global _breaker
+    if _breaker is None:
+        with _breaker_lock:
+            if _breaker is None:
+                _breaker = CircuitBreaker()
+    return _breaker
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# 캐시 키 형식이 바뀌면 올려서 이전 항목을 무효화
+CACHE_KEY_VERSION = 1
+
+# 캐시 키에서 제외할 파라미터 (응답 내용에 영향이 없음)
+_TRANSPORT_PARAMS = {"stream", "stream_options"}
+
+# 기본 설정 (환경 변수로 변경 가능)
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "1") != "0"
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", ".cache/responses.sqlite3")
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", str(24 * 3600)))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+RESPONSE_CACHE_DISK_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_DISK_MAX_ENTRIES", "100000"))
+
+
+def make_cache_key(api_params):
+    """모델, 시스템 프롬프트, 메시지, 생성 파라미터의 정규화된 SHA-256 해시"""
+    params = {k: v for k, v in api_params.items() if k not in _TRANSPORT_PARAMS}
+    canonical = json.dumps(
+        [CACHE_KEY_VERSION, params],
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def has_image(messages):
+    """메시지 목록에 이미지 파트가 포함되어 있는지 확인"""
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            for part in content:
+                if part.get("type") in ("image_url", "input_image"):
+                    return True
+    return False
+
+
+def is_cacheable(api_params, messages, opt_in=False):
+    """캐시 사용 여부 판단
+
+    이미지가 포함된 요청은 캐시하지 않습니다. temperature가 0이 아닌
+    (또는 지정되지 않아 모델 기본 샘플링을 쓰는) 요청은 결과가 매번 달라지므로
+    opt_in=True로 명시한 경우에만 캐시합니다.
+    """
+    if not RESPONSE_CACHE_ENABLED or has_image(messages):
+        return False
+    if opt_in:
+        return True
+    return api_params.get("temperature") == 0
+
+
+class ResponseCache:
+    """메모리 LRU + SQLite 2단계 응답 캐시
+
+    메모리 계층은 항목 수와 바이트 크기로 제한되는 LRU이고,
+    디스크 계층은 재시작 후에도 유지됩니다. 두 계층 모두 TTL이 지나면 만료됩니다.
+    """
+
+    def __init__(self, path=None, ttl=RESPONSE_CACHE_TTL,
+                 max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+                 max_bytes=RESPONSE_CACHE_MAX_BYTES,
+                 disk_max_entries=RESPONSE_CACHE_DISK_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_max_entries = disk_max_entries
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # key -> (expires_at, value, size)
+        self._memory_bytes = 0
+        self._writes_since_prune = 0
+        self.stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "expired": 0,
+        }
+        self._db = None
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS responses_expires_at ON responses (expires_at)"
+            )
+
+    def get(self, key):
+        """캐시된 응답 반환 (없거나 만료되면 None)"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return entry[1]
+                self._evict_memory(key)
+                self.stats["expired"] += 1
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, expires_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    value, expires_at = row
+                    if expires_at > now:
+                        # 디스크 적중은 메모리 계층으로 승격
+                        self._store_memory(key, value, expires_at)
+                        self.stats["disk_hits"] += 1
+                        return value
+                    self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self.stats["expired"] += 1
+
+            self.stats["misses"] += 1
+            return None
+
+    def set(self, key, value):
+        """응답을 두 계층 모두에 저장"""
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._store_memory(key, value, expires_at)
+            self.stats["stores"] += 1
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, value, expires_at),
+                )
+                self._writes_since_prune += 1
+                if self._writes_since_prune >= 256:
+                    self._prune_disk()
+
+    def clear(self):
+        """모든 항목 삭제"""
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+
+    def snapshot(self):
+        """적중/미스 카운터와 현재 크기"""
+        with self._lock:
+            hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+            lookups = hits + self.stats["misses"]
+            return {
+                **self.stats,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+            }
+
+    def _store_memory(self, key, value, expires_at):
+        if key in self._memory:
+            self._evict_memory(key)
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        self._memory[key] = (expires_at, value, size)
+        self._memory_bytes += size
+        while len(self._memory) > self.max_entries or self._memory_bytes > self.max_bytes:
+            oldest = next(iter(self._memory))
+            self._evict_memory(oldest)
+            self.stats["evictions"] += 1
+
+    def _evict_memory(self, key):
+        _, _, size = self._memory.pop(key)
+        self._memory_bytes -= size
+
+    def _prune_disk(self):
+        """만료된 항목과 용량을 넘는 오래된 항목을 디스크에서 삭제"""
+        self._writes_since_prune = 0
+        self._db.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+        self._db.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "SELECT key FROM responses ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.disk_max_entries,),
+        )
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """프로세스 전체에서 공유하는 응답 캐시 반환"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache(path=RESPONSE_CACHE_PATH)
+    return _cache
@@ -0,0 +1,91 @@
+import asyncio
+
+
+class Flight:
+    """진행 중인 업스트림 호출 하나
+
+    업스트림 delta를 별도 태스크에서 받아 보관하므로, 중간에 합류한
+    구독자도 처음부터 다시 재생받은 뒤 이어지는 delta를 실시간으로 받습니다.
+    구독자가 모두 떠나면 업스트림 호출을 취소합니다.
+    """
+
+    def __init__(self, source, on_done=None):
+        self.deltas = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self._wake = asyncio.Event()
+        self._on_done = on_done
+        self.task = asyncio.create_task(self._run(source))
+
+    async def _run(self, source):
+        try:
+            async for delta in source:
+                self.deltas.append(delta)
+                self._notify()
+        except BaseException as e:
+            self.error = e
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            self.done = True
+            self._notify()
+            if self._on_done:
+                self._on_done(self)
+
+    def _notify(self):
+        wake, self._wake = self._wake, asyncio.Event()
+        wake.set()
+
+    async def subscribe(self):
+        """지금까지의 delta를 재생한 뒤 새 delta를 이어서 yield"""
+        self.subscribers += 1
+        try:
+            index = 0
+            while True:
+                while index < len(self.deltas):
+                    yield self.deltas[index]
+                    index += 1
+                if self.done:
+                    if self.error is not None:
+                        if isinstance(self.error, asyncio.CancelledError):
+                            raise RuntimeError("업스트림 요청이 취소되었습니다.")
+                        raise self.error
+                    return
+                await self._wake.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                self.task.cancel()
+
+
+class SingleFlight:
+    """동일한 요청 키의 동시 업스트림 호출을 하나로 합침"""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._flights = {}
+        self.stats = {"upstream_calls": 0, "coalesced": 0}
+
+    def subscribe(self, key, source_factory):
+        """키에 해당하는 호출에 합류 (없으면 source_factory()로 새로 시작)
+
+        source_factory는 업스트림 delta를 yield하는 async iterator를 반환해야 합니다.
+        """
+        flight = self._flights.get(key) if self.enabled else None
+        if flight is None or flight.done:
+            flight = Flight(source_factory(), on_done=lambda f: self._finish(key, f))
+            if self.enabled:
+                self._flights[key] = flight
+            self.stats["upstream_calls"] += 1
+        else:
+            self.stats["coalesced"] += 1
+        return flight.subscribe()
+
+    def _finish(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def snapshot(self):
+        """업스트림 호출 수, 절약한 호출 수, 진행 중인 호출 수"""
+        return {**self.stats, "in_flight": len(self._flights)}
@@ -1,14 +1,23 @@
 import streamlit as st
 import streamlit.components.v1 as components
 import os
-import re
 import requests
 import time
-import base64
-from io import BytesIO
-from PIL import Image
-from openai import OpenAI
+from openai import DefaultHttpxClient, OpenAI
 from dotenv import load_dotenv
+from text_format import IncrementalCleaner, IncrementalHtmlFormatter
+from response_cache import get_response_cache, is_cacheable, make_cache_key
+from context_window import ContextWindow
+from summarizer import RollingSummary, Summarizer
+from resilience import RetryPolicy, UpstreamError
+from rate_limit import get_rate_limiter
+from metrics import Stopwatch, get_chat_metrics, start_metrics_server
+from tracing import NOOP_SPAN, start_trace, use_span
+from image_pipeline import describe, make_thumbnail, prepare_image
+from image_store import (
+    IMAGE_REF_TYPE, get_image_store, image_ref_part, iter_image_refs, materialize_content
+)
+from image_files import IMAGE_FILE_REFS, file_ref_fallback, reference_content, responses_content
 
 # 환경 변수 로드
 load_dotenv(override=False)
@@ -257,15 +266,73 @@ SYSTEM_PROMPT = """당신은 친절하고 도움이 되는 AI 어시스턴트입
 
 웹 인터페이스에서 바로 표시될 수 있도록 깔끔하고 간결한 형식으로 답변해주세요."""
 
-def call_openai_with_retry(client, api_params, max_retries=3, wait_sec=2):
-    last_error = None
-    for attempt in range(1, max_retries + 1):
-        try:
-            return client.responses.create(**api_params)
-        except Exception as e:
-            last_error = e
-            time.sleep(wait_sec)
-    raise last_error
+# 스트리밍 응답 화면 갱신 최소 간격 (초)
+STREAM_RENDER_INTERVAL = 0.05
+
+# 업스트림 호출 재시도/서킷 브레이커 정책 (세 프론트엔드 공용)
+retry_policy = RetryPolicy()
+
+# 스트림이 중간에 끊겨 처음부터 다시 받기 시작할 때 yield되는 표식
+STREAM_RESTART = object()
+
+# 요청 수/단계별 지연 시간/토큰 수 메트릭 (METRICS_PORT가 설정되면 그 포트의 /metrics로 노출)
+chat_metrics = get_chat_metrics("streamlit")
+start_metrics_server()
+
+def stream_openai_with_retry(client, api_params, policy=retry_policy, trace=NOOP_SPAN, fallback=None):
+    """Responses API 스트림의 텍스트 delta를 yield (일시적인 오류로 끊기면 재시도)
+
+    재시도 전에는 STREAM_RESTART를 yield하므로, 호출 측은 그때까지
+    표시한 내용을 버리고 새 스트림을 처음부터 다시 그려야 합니다.
+    fallback(error, api_params)이 바꿀 파라미터를 돌려주면 그 파라미터로 한 번 바로 다시 호출합니다.
+    첫 토큰/전체 호출 시간과 토큰 사용량은 메트릭과 trace에 기록하고,
+    요청 ID는 업스트림 호출 헤더로 전달합니다.
+    """
+    state = policy.begin()
+    started = time.perf_counter()
+    first_token = True
+    with trace.child("upstream", **{"gen_ai.request.model": api_params["model"], "stream": True}) as span:
+        while True:
+            try:
+                with client.responses.create(
+                    **api_params, stream=True, timeout=state.timeout(), extra_headers=span.headers()
+                ) as stream:
+                    for event in stream:
+                        if event.type == "response.output_text.delta":
+                            if first_token:
+                                chat_metrics.observe_since("ttft", started)
+                                span.add_event("first_token")
+                                first_token = False
+                            yield event.delta
+                        elif event.type == "response.completed":
+                            chat_metrics.record_usage(api_params["model"], event.response.usage)
+                            span.set_usage(event.response.usage)
+                            span.set_attribute("gen_ai.response.id", event.response.id)
+                        elif event.type == "response.failed":
+                            error = event.response.error
+                            if error:
+                                raise UpstreamError(error.message, error.code)
+                            raise UpstreamError("응답 생성에 실패했습니다.")
+                        elif event.type == "error":
+                            raise UpstreamError(event.message, event.code)
+                state.succeeded()
+                chat_metrics.observe_since("upstream", started)
+                return
+            except Exception as e:
+                span.add_event("retry", error=f"{type(e).__name__}: {e}")
+                with use_span(span):
+                    replacement = fallback(e, api_params) if fallback else None
+                if replacement is not None:
+                    api_params, fallback = {**api_params, **replacement}, None
+                else:
+                    time.sleep(state.failed(e))
+                yield STREAM_RESTART
+
+# 입력 토큰 예산 안에서 최근 대화만 보내는 컨텍스트 관리자
+context_window = ContextWindow()
+
+# 오래된 대화를 응답 후 백그라운드에서 요약하는 요약기
+summarizer = Summarizer(retry_policy=retry_policy, frontend="streamlit")
 
 # OpenAI 클라이언트 초기화
 @st.cache_resource
@@ -273,7 +340,13 @@ def get_openai_client():
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         return None
-    return OpenAI(api_key=api_key)
+    # 재시도는 retry_policy가 담당하므로 클라이언트 자체 재시도는 끔
+    # x-ratelimit 헤더로 한도를 파악해 보내기 전에 속도 조절 (같은 키의 모든 세션이 공유)
+    return OpenAI(
+        api_key=api_key,
+        max_retries=0,
+        http_client=DefaultHttpxClient(event_hooks=get_rate_limiter(api_key).event_hooks()),
+    )
 
 # 세션 상태 초기화
 if "messages" not in st.session_state:
@@ -281,24 +354,30 @@ if "messages" not in st.session_state:
         {"role": "assistant", "content": "안녕하세요! 무엇을 도와드릴까요?"}
     ]
 
+if "rolling_summary" not in st.session_state:
+    st.session_state.rolling_summary = RollingSummary()
+
 if "generated_images" not in st.session_state:
     st.session_state.generated_images = []
 
-# 이미지를 base64로 인코딩하는 함수
-def encode_image(image_file):
-    """이미지 파일을 base64로 인코딩"""
-    image = Image.open(image_file)
-    # 이미지 크기 조정 (너무 크면 API 제한에 걸릴 수 있음)
-    max_size = 2048
-    if max(image.size) > max_size:
-        image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
-    
-    buffered = BytesIO()
-    # PNG 형식으로 저장
-    image.save(buffered, format="PNG")
-    img_bytes = buffered.getvalue()
-    img_base64 = base64.b64encode(img_bytes).decode('utf-8')
-    return img_base64
+# 첨부 이미지(pasted_image/uploaded_image) 교체: 이전 이미지의 참조 해제
+def set_attached_image(key, ref):
+    old_ref = st.session_state.get(key)
+    st.session_state[key] = ref
+    if old_ref is not None:
+        get_image_store().release(old_ref)
+
+# 화면 표시용 썸네일 (이미지와 표시 너비별로 한 번만 만들어 모든 rerun/세션에서 재사용)
+@st.cache_resource(max_entries=512, show_spinner=False)
+def get_thumbnail(ref, width):
+    return make_thumbnail(get_image_store().get(ref), width)
+
+# 메시지들이 참조하던 이미지의 참조 해제
+def release_message_images(messages):
+    image_store = get_image_store()
+    for message in messages:
+        for ref in iter_image_refs(message["content"]):
+            image_store.release(ref)
 
 # 헤더
 st.markdown("""
@@ -353,10 +432,53 @@ with st.sidebar:
     
     st.markdown("<br>", unsafe_allow_html=True)
     
+    st.markdown("### ⚡ 응답 캐시")
+    use_response_cache = st.checkbox(
+        "동일한 질문에는 저장된 응답 사용",
+        value=False,
+        help="이미지가 없는 같은 대화에 대해 이전 응답을 재사용합니다. 답변이 매번 달라지지 않게 됩니다."
+    )
+    cache_stats = get_response_cache().snapshot()
+    st.caption(
+        f"적중 {cache_stats['memory_hits'] + cache_stats['disk_hits']}회 · "
+        f"미스 {cache_stats['misses']}회 · 적중률 {cache_stats['hit_rate']:.0%}"
+    )
+    
+    context_report = st.session_state.get("last_context_report")
+    if context_report is not None:
+        st.markdown("### 📏 컨텍스트")
+        st.caption(
+            f"마지막 요청: 약 {context_report.tokens_after:,} 토큰 전송 "
+            f"(예산 {context_window.max_input_tokens:,}) · "
+            f"{context_report.tokens_saved:,} 토큰 절약 · "
+            f"오래된 메시지 {context_report.dropped_messages}개 제외 · "
+            f"이미지 {context_report.images_replaced}개 텍스트로 대체"
+        )
+    
+    use_summary = st.checkbox(
+        "오래된 대화 요약 (백그라운드)",
+        value=False,
+        help=f"대화가 길어지면 응답이 끝난 뒤 오래된 대화를 {summarizer.model}로 요약해 이후 요청에 요약만 보냅니다."
+    )
+    summary_report = st.session_state.rolling_summary.last_report
+    if use_summary and summary_report is not None:
+        if "error" in summary_report:
+            st.caption(f"마지막 요약 실패: {summary_report['error']}")
+        else:
+            st.caption(
+                f"마지막 요약: 메시지 {summary_report['folded_messages']}개 · "
+                f"약 {summary_report['tokens_before']:,} → {summary_report['tokens_after']:,} 토큰 · "
+                f"{summary_report['latency_ms']:,.0f}ms"
+            )
+    
+    st.markdown("<br>", unsafe_allow_html=True)
+    
     if st.button("🗑️ 대화 기록 지우기", width="stretch"):
+        release_message_images(st.session_state.messages)
         st.session_state.messages = [
             {"role": "assistant", "content": "안녕하세요! 무엇을 도와드릴까요?"}
         ]
+        st.session_state.rolling_summary = RollingSummary()
         st.rerun()
     
     st.markdown("---")
@@ -382,17 +504,13 @@ with tab1:
                 for content_item in message["content"]:
                     if content_item.get("type") == "text":
                         st.write(content_item["text"])
-                    elif content_item.get("type") == "image_url":
-                        # 이미지 URL이 base64인 경우
-                        image_url = content_item["image_url"]["url"]
-                        if image_url.startswith("data:image"):
-                            try:
-                                header, encoded = image_url.split(",", 1)
-                                img_data = base64.b64decode(encoded)
-                                img = Image.open(BytesIO(img_data))
-                                st.image(img, caption="📷 첨부된 이미지", width=300)
-                            except:
-                                pass
+                    elif content_item.get("type") == IMAGE_REF_TYPE:
+                        # 이미지 저장소에 보관된 이미지
+                        try:
+                            thumbnail = get_thumbnail(content_item[IMAGE_REF_TYPE], 300)
+                            st.image(thumbnail, caption="📷 첨부된 이미지", width=300)
+                        except:
+                            pass
             else:
                 # 일반 텍스트 메시지 (어시스턴트 응답은 텍스트만)
                 if isinstance(message["content"], list):
@@ -469,12 +587,16 @@ with tab1:
         </script>
     """, unsafe_allow_html=True)
     
-    # 업로드된 파일이 있으면 session_state에 저장
-    if uploaded_file is not None:
+    # 새로 업로드된 파일이 있으면 이미지 저장소에 넣고 참조만 session_state에 저장
+    # (같은 파일은 rerun마다 다시 인코딩하지 않음)
+    if uploaded_file is not None and st.session_state.get("uploaded_file_id") != uploaded_file.file_id:
+        st.session_state.uploaded_file_id = uploaded_file.file_id
         try:
-            img_base64 = encode_image(uploaded_file)
-            img_data_url = f"data:image/png;base64,{img_base64}"
-            st.session_state.uploaded_image = img_data_url
+            # 규격에 맞으면 원본 그대로, 아니면 타일 크기로 축소 후
+            # 사진은 JPEG/WebP, 선화/스크린샷은 PNG로 인코딩
+            processed = prepare_image(uploaded_file.getvalue())
+            set_attached_image("uploaded_image", get_image_store().put(processed.data, processed.mime))
+            st.session_state.uploaded_image_report = describe(processed)
         except Exception as e:
             st.error(f"이미지 처리 중 오류: {str(e)}")
     
@@ -491,23 +613,20 @@ with tab1:
     
     if current_image is not None:
         try:
-            img_data = base64.b64decode(current_image.split(',')[1])
-            img = Image.open(BytesIO(img_data))
+            thumbnail = get_thumbnail(current_image, 200)
             col1, col2, col3 = st.columns([1, 2, 1])
             with col2:
-                st.image(img, caption=f"📷 {image_source} 이미지", width=200)
+                st.image(thumbnail, caption=f"📷 {image_source} 이미지", width=200)
+                if image_source == "업로드된" and st.session_state.get("uploaded_image_report"):
+                    st.caption(st.session_state.uploaded_image_report)
                 if st.button("❌ 이미지 제거", key="remove_image"):
-                    if 'pasted_image' in st.session_state:
-                        st.session_state.pasted_image = None
-                    if 'uploaded_image' in st.session_state:
-                        st.session_state.uploaded_image = None
+                    set_attached_image("pasted_image", None)
+                    set_attached_image("uploaded_image", None)
                     st.rerun()
         except Exception as e:
             # 이미지 파싱 오류 시 초기화
-            if 'pasted_image' in st.session_state:
-                st.session_state.pasted_image = None
-            if 'uploaded_image' in st.session_state:
-                st.session_state.uploaded_image = None
+            set_attached_image("pasted_image", None)
+            set_attached_image("uploaded_image", None)
 
     # 사용자 입력
     if prompt := st.chat_input("💬 메시지를 입력하세요..."):
@@ -523,8 +642,8 @@ with tab1:
         
         if current_image is not None:
             try:
-                # base64 이미지 데이터 사용
-                img_data_url = current_image
+                # 메시지에는 이미지 참조만 저장 (메시지가 참조를 하나 보유)
+                get_image_store().retain(current_image)
                 
                 # 멀티모달 메시지 형식으로 구성
                 user_message_content = [
@@ -532,12 +651,7 @@ with tab1:
                         "type": "text",
                         "text": prompt if prompt else "이 이미지를 분석해주세요."
                     },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": img_data_url
-                        }
-                    }
+                    image_ref_part(current_image)
                 ]
             except Exception as e:
                 st.error(f"이미지 처리 중 오류: {str(e)}")
@@ -552,16 +666,12 @@ with tab1:
                 for item in user_message_content:
                     if item.get("type") == "text":
                         st.write(item["text"])
-                    elif item.get("type") == "image_url":
-                        img_url = item["image_url"]["url"]
-                        if img_url.startswith("data:image"):
-                            try:
-                                header, encoded = img_url.split(",", 1)
-                                img_data = base64.b64decode(encoded)
-                                img = Image.open(BytesIO(img_data))
-                                st.image(img, caption="📷 첨부된 이미지", width=300)
-                            except:
-                                pass
+                    elif item.get("type") == IMAGE_REF_TYPE:
+                        try:
+                            thumbnail = get_thumbnail(item[IMAGE_REF_TYPE], 300)
+                            st.image(thumbnail, caption="📷 첨부된 이미지", width=300)
+                        except:
+                            pass
             else:
                 st.write(user_message_content)
         
@@ -575,24 +685,59 @@ with tab1:
             # 어시스턴트 응답 생성
             with st.chat_message("assistant"):
                 with st.spinner("응답을 생성하는 중..."):
+                    request_timer = chat_metrics.start_request("chat")
+                    trace = start_trace("streamlit.chat", frontend="streamlit")
                     try:
                         # Vision API를 사용하기 위해 모델을 gpt-4o로 변경 (더 나은 vision 지원)
                         # 이미지가 포함된 경우 vision 지원 모델 사용
                         model_name = "gpt-4o" if isinstance(user_message_content, list) else "gpt-5-mini"
                         
+                        # 요약된 오래된 대화는 요약문으로 대체
+                        system_prompt = SYSTEM_PROMPT
+                        source_messages = st.session_state.messages
+                        if use_summary:
+                            system_prompt, source_messages = st.session_state.rolling_summary.apply(
+                                SYSTEM_PROMPT, source_messages
+                            )
+                        
+                        # 입력 토큰 예산에 맞게 최근 대화만 남기고 오래된 이미지는 자리표시자로 교체
+                        context_messages, context_report = context_window.fit(
+                            system_prompt, source_messages
+                        )
+                        st.session_state.last_context_report = context_report
+                        
                         # 메시지 변환 (이전 메시지들도 올바른 형식으로)
-                        formatted_messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-                        for msg in st.session_state.messages:
-                            if msg["role"] == "user":
-                                formatted_messages.append({
-                                    "role": "user",
-                                    "content": msg["content"]
-                                })
-                            else:
-                                formatted_messages.append({
-                                    "role": msg["role"],
-                                    "content": msg["content"]
-                                })
+                        # 이미지 참조는 요청을 만드는 이 시점에 변환: 처음 보내는 이미지만 업스트림에
+                        # 파일로 올리고 이후 턴에서는 file_id로 참조 (끄면 매번 base64 data URL)
+                        image_timer = Stopwatch()
+                        
+                        def format_messages(file_refs=IMAGE_FILE_REFS):
+                            formatted = [{"role": "system", "content": system_prompt}]
+                            for msg in context_messages:
+                                if msg["role"] == "user":
+                                    with image_timer, use_span(trace):
+                                        if file_refs:
+                                            content = reference_content(msg["content"], get_image_store(), client)
+                                        else:
+                                            content = responses_content(
+                                                materialize_content(msg["content"], get_image_store())
+                                            )
+                                    formatted.append({
+                                        "role": "user",
+                                        "content": content
+                                    })
+                                else:
+                                    formatted.append({
+                                        "role": msg["role"],
+                                        "content": msg["content"]
+                                    })
+                            return formatted
+                        
+                        formatted_messages = format_messages()
+                        
+                        if model_name == "gpt-4o":
+                            chat_metrics.observe("image", image_timer.elapsed)
+                            trace.record("image", image_timer.elapsed)
                         
                         # gpt-5-mini는 temperature를 지원하지 않으므로 파라미터에서 제외
                         api_params = {
@@ -604,36 +749,83 @@ with tab1:
                         # 다른 모델을 사용할 경우를 대비해 주석 처리
                         # api_params["temperature"] = temperature
                         
-                        response = call_openai_with_retry(
-                            client,
-                            api_params,
-                            max_retries=3,
-                            wait_sec=2
-                        )
+                        # 응답을 스트리밍으로 받아 말풍선에 점진적으로 표시
+                        response_placeholder = st.empty()
+                        render_timer = Stopwatch()
                         
-                        response_text = response.output_text
+                        def render_response(html_text):
+                            with render_timer:
+                                response_placeholder.markdown(f"""
+                                    <div style="line-height: 1.8; font-size: 1rem;">
+                                        {html_text}
+                                    </div>
+                                """, unsafe_allow_html=True)
                         
-                        # 연속된 줄바꿈을 최대 2개로 제한하고, 불필요한 공백 제거
-                        # 연속된 3개 이상의 줄바꿈을 2개로 줄임
-                        response_text = re.sub(r'\n{3,}', '\n\n', response_text)
-                        # 문단 시작/끝의 불필요한 줄바꿈 제거
-                        response_text = response_text.strip()
-                        # 줄바꿈을 HTML로 변환 (연속된 줄바꿈은 문단 구분, 단일 줄바꿈은 공백)
-                        html_text = response_text.replace('\n\n', '</p><p>').replace('\n', ' ')
-                        html_text = f'<p>{html_text}</p>'
+                        # 줄바꿈 정리와 HTML 변환은 도착한 청크에만 점진적으로 적용
+                        cleaner = IncrementalCleaner()
+                        formatter = IncrementalHtmlFormatter()
+                        postprocess = Stopwatch()
+                        text_parts = []
+                        html_parts = []
+                        last_render = 0.0
                         
-                        st.markdown(f"""
-                            <div style="line-height: 1.8; font-size: 1rem;">
-                                {html_text}
-                            </div>
-                        """, unsafe_allow_html=True)
+                        # 동일한 대화의 캐시된 응답이 있으면 업스트림 호출 없이 사용
+                        cache_key = None
+                        cached_text = None
+                        if is_cacheable(api_params, formatted_messages, opt_in=use_response_cache):
+                            cache_key = make_cache_key(api_params)
+                            cached_text = get_response_cache().get(cache_key)
+                        
+                        if cached_text is not None:
+                            deltas = [cached_text]
+                        else:
+                            # 업스트림에서 파일이 사라졌으면 이번 요청은 data URL로 다시 보냄 (다음 턴에 다시 올림)
+                            deltas = stream_openai_with_retry(
+                                client, api_params, trace=trace,
+                                fallback=file_ref_fallback("input", lambda: format_messages(file_refs=False))
+                            )
+                        
+                        for delta in deltas:
+                            if delta is STREAM_RESTART:
+                                # 스트림이 끊겨 재시도: 지금까지 받은 내용 폐기
+                                cleaner = IncrementalCleaner()
+                                formatter = IncrementalHtmlFormatter()
+                                text_parts = []
+                                html_parts = []
+                                render_response("")
+                                continue
+                            with postprocess:
+                                text_parts.append(cleaner.feed(delta))
+                                html_parts.append(formatter.feed(delta))
+                            # 화면 갱신은 일정 간격으로만 (청크마다 다시 그리지 않음)
+                            now = time.monotonic()
+                            if now - last_render >= STREAM_RENDER_INTERVAL:
+                                render_response("".join(html_parts))
+                                last_render = now
+                        
+                        with postprocess:
+                            text_parts.append(cleaner.finish())
+                            html_parts.append(formatter.finish())
+                        chat_metrics.observe("postprocess", postprocess.elapsed)
+                        trace.record("postprocess", postprocess.elapsed)
+                        response_text = "".join(text_parts)
+                        render_response("".join(html_parts))
+                        trace.record("render", render_timer.elapsed, renders=render_timer.laps)
+                        if cache_key and cached_text is None:
+                            get_response_cache().set(cache_key, response_text)
                         st.session_state.messages.append({"role": "assistant", "content": response_text})
+                        request_timer.finish()
+                        trace.end()
                         
                         # 이미지 처리 완료 후 초기화
-                        if 'pasted_image' in st.session_state:
-                            st.session_state.pasted_image = None
-                        if 'uploaded_image' in st.session_state:
-                            st.session_state.uploaded_image = None
+                        set_attached_image("pasted_image", None)
+                        set_attached_image("uploaded_image", None)
+                        
+                        # 응답 전달 후 필요하면 오래된 대화를 백그라운드에서 요약
+                        if use_summary:
+                            summarizer.start_background(
+                                client, st.session_state.rolling_summary, st.session_state.messages
+                            )
                         
                         # 스크롤을 맨 아래로 이동 (더 강력한 방법)
                         st.markdown("""
@@ -669,9 +861,17 @@ with tab1:
                         """, unsafe_allow_html=True)
                         
                     except Exception as e:
+                        request_timer.finish("error")
+                        trace.end(f"{type(e).__name__}: {e}")
                         error_message = f"오류가 발생했습니다: {str(e)}"
                         st.error(error_message)
                         st.session_state.messages.append({"role": "assistant", "content": error_message})
+                    except BaseException:
+                        # 사용자가 다시 입력해 스크립트 실행이 중단된 경우
+                        request_timer.finish("cancelled")
+                        trace.set_attribute("cancelled", True)
+                        trace.end()
+                        raise
 
 # 이미지 생성 탭
 with tab2:
@@ -725,7 +925,8 @@ with tab2:
                     try:
                         # OpenAI 이미지 생성 API 호출
                         if image_model == "dall-e-3":
-                            response = client.images.generate(
+                            response = retry_policy.call(
+                                client.images.generate,
                                 model=image_model,
                                 prompt=image_prompt,
                                 size=image_size,
@@ -733,7 +934,8 @@ with tab2:
                                 n=1
                             )
                         else:
-                            response = client.images.generate(
+                            response = retry_policy.call(
+                                client.images.generate,
                                 model=image_model,
                                 prompt=image_prompt,
                                 size=image_size,
@@ -0,0 +1,189 @@
+import os
+import threading
+import time
+from context_window import IMAGE_PLACEHOLDER, estimate_message_tokens, estimate_tokens
+from metrics import get_chat_metrics
+from resilience import RetryPolicy
+
+# 기본 설정 (환경 변수로 변경 가능)
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-4o-mini")
+SUMMARY_TRIGGER_TOKENS = int(os.getenv("SUMMARY_TRIGGER_TOKENS", "6000"))
+SUMMARY_KEEP_RECENT_MESSAGES = int(os.getenv("SUMMARY_KEEP_RECENT_MESSAGES", "6"))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "800"))
+
+SUMMARY_PROMPT = """다음은 사용자와 AI 어시스턴트의 이전 대화입니다.
+이후 대화를 이어가는 데 필요한 사실, 사용자의 질문과 요청, 선호, 이미 답한 내용의 핵심을 빠짐없이 요약하세요.
+마크다운 없이 간결한 일반 텍스트로 작성하세요."""
+
+_ROLE_LABELS = {"user": "사용자", "assistant": "어시스턴트"}
+
+
+def message_text(message):
+    """메시지의 텍스트만 추출 (이미지는 자리표시자)"""
+    content = message.get("content")
+    if not isinstance(content, list):
+        return content or ""
+    texts = []
+    for part in content:
+        if part.get("type") == "text":
+            texts.append(part.get("text", ""))
+        else:
+            texts.append(IMAGE_PLACEHOLDER)
+    return " ".join(texts)
+
+
+class RollingSummary:
+    """대화 하나의 누적 요약 상태
+
+    앞쪽 summarized_count개의 메시지는 summary로 대체되어 전송됩니다.
+    요약은 백그라운드에서 갱신되므로 모든 변경은 잠금 안에서 이루어집니다.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.summary = ""
+        self.summarized_count = 0
+        self.running = False
+        self.last_report = None
+
+    def apply(self, system_prompt, messages):
+        """요약을 시스템 프롬프트에 붙이고, 요약되지 않은 메시지만 반환"""
+        with self._lock:
+            summary, count = self.summary, self.summarized_count
+        if not summary:
+            return system_prompt, messages
+        return f"{system_prompt}\n\n이전 대화 요약:\n{summary}", messages[count:]
+
+    def shift(self, dropped):
+        """앞쪽 메시지 dropped개가 삭제될 때 요약 범위를 맞춤 (요약 중이면 False)"""
+        with self._lock:
+            if self.running:
+                return False
+            self.summarized_count = max(0, self.summarized_count - dropped)
+            return True
+
+    def to_dict(self):
+        with self._lock:
+            return {"summary": self.summary, "summarized_count": self.summarized_count}
+
+    @classmethod
+    def from_dict(cls, data):
+        state = cls()
+        state.summary = data.get("summary", "")
+        state.summarized_count = data.get("summarized_count", 0)
+        return state
+
+
+class Summarizer:
+    """오래된 대화를 저렴한 모델로 요약해 RollingSummary를 갱신
+
+    요약 호출도 채팅 호출과 같은 재시도/서킷 브레이커 정책(retry_policy)을 거치며,
+    걸린 시간은 frontend의 summary 단계, 토큰 수는 요약 모델의 사용량으로 기록합니다.
+    """
+
+    def __init__(self, model=SUMMARY_MODEL, trigger_tokens=SUMMARY_TRIGGER_TOKENS,
+                 keep_recent_messages=SUMMARY_KEEP_RECENT_MESSAGES,
+                 max_tokens=SUMMARY_MAX_TOKENS, retry_policy=None, frontend=None):
+        self.model = model
+        self.trigger_tokens = trigger_tokens
+        self.keep_recent_messages = keep_recent_messages
+        self.max_tokens = max_tokens
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.metrics = get_chat_metrics(frontend) if frontend else None
+
+    def _claim(self, state, messages):
+        """요약할 메시지 범위를 정하고 상태를 실행 중으로 표시 (요약이 필요 없으면 None)"""
+        upto = len(messages) - self.keep_recent_messages
+        with state._lock:
+            if state.running or upto <= state.summarized_count:
+                return None
+            pending = messages[state.summarized_count:upto]
+            if sum(estimate_message_tokens(m) for m in pending) < self.trigger_tokens:
+                return None
+            state.running = True
+            return state.summary, pending, upto
+
+    def _build_request(self, previous_summary, pending):
+        lines = []
+        if previous_summary:
+            lines.append(f"기존 요약:\n{previous_summary}\n")
+        for message in pending:
+            label = _ROLE_LABELS.get(message["role"], message["role"])
+            lines.append(f"{label}: {message_text(message)}")
+        return {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": "\n".join(lines)}
+            ],
+            "max_completion_tokens": self.max_tokens
+        }
+
+    def _finish(self, state, claim, response, started):
+        previous_summary, pending, upto = claim
+        summary = (response.choices[0].message.content or "").strip()
+        usage = getattr(response, "usage", None)
+        if self.metrics is not None:
+            self.metrics.observe_since("summary", started)
+            self.metrics.record_usage(self.model, usage)
+        report = {
+            "folded_messages": len(pending),
+            "tokens_before": estimate_tokens(previous_summary)
+            + sum(estimate_message_tokens(m) for m in pending),
+            "tokens_after": estimate_tokens(summary),
+            "latency_ms": round((time.perf_counter() - started) * 1000, 1),
+            "prompt_tokens": getattr(usage, "prompt_tokens", None),
+            "completion_tokens": getattr(usage, "completion_tokens", None),
+        }
+        with state._lock:
+            if summary:
+                state.summary = summary
+                state.summarized_count = upto
+            state.running = False
+            state.last_report = report
+        return report
+
+    def _abort(self, state, error):
+        with state._lock:
+            state.running = False
+            state.last_report = {"error": str(error)}
+
+    def _run(self, client, state, claim):
+        started = time.perf_counter()
+        try:
+            response = self.retry_policy.call(client.chat.completions.create, **self._build_request(*claim[:2]))
+        except Exception as e:
+            self._abort(state, e)
+            return None
+        return self._finish(state, claim, response, started)
+
+    def summarize(self, client, state, messages):
+        """동기 클라이언트로 요약 (필요 없으면 None 반환)"""
+        claim = self._claim(state, messages)
+        if claim is None:
+            return None
+        return self._run(client, state, claim)
+
+    async def summarize_async(self, client, state, messages):
+        """비동기 클라이언트로 요약 (필요 없으면 None 반환)"""
+        claim = self._claim(state, messages)
+        if claim is None:
+            return None
+        started = time.perf_counter()
+        try:
+            response = await self.retry_policy.call_async(
+                client.chat.completions.create, **self._build_request(*claim[:2])
+            )
+        except Exception as e:
+            self._abort(state, e)
+            return None
+        return self._finish(state, claim, response, started)
+
+    def start_background(self, client, state, messages):
+        """요약이 필요하면 별도 스레드에서 시작 (동기 클라이언트용, 응답 전달 후 호출)"""
+        claim = self._claim(state, list(messages))
+        if claim is None:
+            return None
+        thread = threading.Thread(target=self._run, args=(client, state, claim), daemon=True)
+        thread.start()
+        return thread
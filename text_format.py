@@ -0,0 +1,81 @@
+import re
+
+# 연속된 3개 이상의 줄바꿈 (문단 구분은 최대 2개로 제한)
+_EXCESS_NEWLINES = re.compile(r'\n{3,}')
+
+
+def clean_text(text):
+    """연속된 줄바꿈을 최대 2개로 제한하고, 앞뒤 공백 제거"""
+    return _EXCESS_NEWLINES.sub('\n\n', text).strip()
+
+
+def _paragraphs(text):
+    """줄바꿈을 HTML로 변환 (연속된 줄바꿈은 문단 구분, 단일 줄바꿈은 공백)"""
+    return text.replace('\n\n', '</p><p>').replace('\n', ' ')
+
+
+def to_html(text):
+    """응답 텍스트를 정리한 뒤 <p> 문단 HTML로 변환"""
+    return f'<p>{_paragraphs(clean_text(text))}</p>'
+
+
+class IncrementalCleaner:
+    """스트리밍 청크에 clean_text()를 점진적으로 적용
+
+    마지막 공백이 아닌 문자 뒤의 공백(줄바꿈 포함)만 보류하므로
+    각 청크는 한 번만 검사되고, feed()가 돌려준 조각을 모두 이어 붙이면
+    전체 텍스트에 clean_text()를 적용한 결과와 같습니다.
+    """
+
+    def __init__(self):
+        self._started = False
+        self._pending = ''
+
+    def feed(self, chunk):
+        """청크를 받아 확정된 부분만 반환"""
+        if not chunk:
+            return ''
+        body = chunk.rstrip()
+        if not body:
+            # 공백뿐인 청크: 앞쪽 공백이면 버리고, 아니면 보류
+            if self._started:
+                self._pending += chunk
+            return ''
+        segment = self._pending + body
+        self._pending = chunk[len(body):]
+        if not self._started:
+            segment = segment.lstrip()
+            self._started = True
+        # 보류된 공백과 body 사이의 줄바꿈 묶음은 이 구간 안에서 완결됨
+        return _EXCESS_NEWLINES.sub('\n\n', segment)
+
+    def finish(self):
+        """스트림 종료: 끝의 공백은 strip()과 동일하게 버림"""
+        self._pending = ''
+        return ''
+
+
+class IncrementalHtmlFormatter:
+    """스트리밍 청크를 to_html()과 동일한 HTML 조각으로 변환
+
+    첫 feed()는 여는 <p>를, finish()는 닫는 </p>를 포함하므로
+    모든 조각을 이어 붙이면 to_html(전체 텍스트)와 같습니다.
+    """
+
+    def __init__(self):
+        self._cleaner = IncrementalCleaner()
+        self._opened = False
+
+    def _open(self):
+        if self._opened:
+            return ''
+        self._opened = True
+        return '<p>'
+
+    def feed(self, chunk):
+        """청크를 받아 추가할 HTML 조각을 반환"""
+        return self._open() + _paragraphs(self._cleaner.feed(chunk))
+
+    def finish(self):
+        """남은 HTML 조각(닫는 태그)을 반환"""
+        return self._open() + _paragraphs(self._cleaner.finish()) + '</p>'
@@ -0,0 +1,307 @@
+import asyncio
+import contextvars
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from metrics import usage_tokens
+
+# 트레이스를 남길 요청 비율 (0이면 끔, 1이면 모든 요청)
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+
+# 스팬 출력 방식 (file: TRACE_FILE에 한 줄씩 추가, console: 표준 오류로 출력)
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "file")
+TRACE_FILE = os.getenv("TRACE_FILE", ".cache/traces.jsonl")
+
+# 리소스 속성의 service.name
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "gpt-text-service")
+
+# 요청 ID 헤더 (들어온 값이 있으면 이어서 사용하고 응답과 업스트림 호출에 전달)
+REQUEST_ID_HEADER = "x-request-id"
+
+# OpenAI가 요청 로그에 함께 남기는 클라이언트 요청 ID 헤더
+UPSTREAM_REQUEST_ID_HEADER = "X-Client-Request-Id"
+
+_REQUEST_ID = re.compile(r"^[A-Za-z0-9._:-]{1,128}$")
+_TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+_current = contextvars.ContextVar("current_span", default=None)
+
+
+def new_request_id(value=None):
+    """요청 ID (형식이 올바른 값이 주어지면 그대로, 아니면 새로 생성)"""
+    if value and _REQUEST_ID.match(value):
+        return value
+    return uuid.uuid4().hex
+
+
+def _iso(ns):
+    return datetime.fromtimestamp(ns / 1e9, timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+class _Exporter:
+    """끝난 트레이스의 스팬을 OpenTelemetry 콘솔 익스포터와 같은 JSON 형식으로 한 줄씩 기록"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._file = None
+
+    def _stream(self):
+        if TRACE_EXPORTER == "console":
+            return sys.stderr
+        if self._file is None:
+            directory = os.path.dirname(TRACE_FILE)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = open(TRACE_FILE, "a", encoding="utf-8")
+        return self._file
+
+    def export(self, spans):
+        lines = "".join(json.dumps(span.to_dict(), ensure_ascii=False) + "\n" for span in spans)
+        with self._lock:
+            stream = self._stream()
+            stream.write(lines)
+            stream.flush()
+
+
+_exporter = _Exporter()
+
+
+class NoopSpan:
+    """샘플링되지 않은 요청의 스팬 (요청 ID만 전달하고 나머지는 아무것도 하지 않음)"""
+    sampled = False
+
+    def __init__(self, request_id=None):
+        self.request_id = request_id
+
+    def headers(self):
+        return {UPSTREAM_REQUEST_ID_HEADER: self.request_id} if self.request_id else {}
+
+    def child(self, name, **attributes):
+        return self
+
+    def record(self, name, seconds, **attributes):
+        pass
+
+    def record_since(self, name, started, **attributes):
+        pass
+
+    def set_attribute(self, key, value):
+        pass
+
+    def add_event(self, name, **attributes):
+        pass
+
+    def set_usage(self, usage):
+        pass
+
+    def end(self, error=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Span:
+    """트레이스의 한 구간 (with 블록으로 쓰면 블록이 끝날 때 종료, 예외가 나면 ERROR 상태)"""
+    sampled = True
+
+    def __init__(self, name, trace_id, request_id, parent_id=None, root=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.request_id = request_id
+        self.root = root or self
+        self.attributes = dict(attributes or {})
+        self.events = []
+        self.status = "UNSET"
+        self.description = None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        if root is None:
+            self._finished = []
+            self._lock = threading.Lock()
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def headers(self):
+        """업스트림 호출에 붙일 헤더 (요청 ID와 W3C traceparent)"""
+        return {UPSTREAM_REQUEST_ID_HEADER: self.request_id, "traceparent": self.traceparent}
+
+    def child(self, name, **attributes):
+        return Span(name, self.trace_id, self.request_id, self.span_id, self.root, attributes)
+
+    def record(self, name, seconds, **attributes):
+        """지금 끝난 seconds초 길이의 하위 구간 기록 (여러 번에 나눠 잰 시간 등)"""
+        span = self.child(name, **attributes)
+        span.end_ns = time.time_ns()
+        span.start_ns = span.end_ns - int(seconds * 1e9)
+        self.root._collect(span)
+
+    def record_since(self, name, started, **attributes):
+        """perf_counter 시각 started부터 지금까지를 하위 구간으로 기록"""
+        if started is not None:
+            self.record(name, time.perf_counter() - started, **attributes)
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def add_event(self, name, **attributes):
+        self.events.append({"name": name, "timestamp": _iso(time.time_ns()), "attributes": attributes})
+
+    def set_usage(self, usage):
+        """업스트림 usage를 OpenTelemetry GenAI 속성으로 기록"""
+        if usage is None:
+            return
+        prompt, completion, cached = usage_tokens(usage)
+        self.attributes["gen_ai.usage.input_tokens"] = prompt
+        self.attributes["gen_ai.usage.output_tokens"] = completion
+        self.attributes["gen_ai.usage.cached_tokens"] = cached
+
+    def end(self, error=None):
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        if error is not None:
+            self.status = "ERROR"
+            self.description = error
+        self.root._collect(self)
+
+    def _collect(self, span):
+        # 루트가 끝날 때 트레이스 전체를 한 번에 기록 (루트가 먼저 끝났으면 바로 기록)
+        with self._lock:
+            if self.end_ns is None or span is self:
+                self._finished.append(span)
+                if span is not self:
+                    return
+                spans, self._finished = self._finished, []
+            else:
+                spans = [span]
+        _exporter.export(spans)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.end()
+        elif issubclass(exc_type, (GeneratorExit, asyncio.CancelledError)):
+            self.set_attribute("cancelled", True)
+            self.end()
+        else:
+            self.end(f"{exc_type.__name__}: {exc}")
+        return False
+
+    def to_dict(self):
+        status = {"status_code": self.status}
+        if self.description:
+            status["description"] = self.description
+        return {
+            "name": self.name,
+            "context": {"trace_id": f"0x{self.trace_id}", "span_id": f"0x{self.span_id}"},
+            "parent_id": f"0x{self.parent_id}" if self.parent_id else None,
+            "start_time": _iso(self.start_ns),
+            "end_time": _iso(self.end_ns),
+            "status": status,
+            "attributes": self.attributes,
+            "events": self.events,
+            "resource": {"attributes": {"service.name": TRACE_SERVICE_NAME}},
+        }
+
+
+def start_trace(name, request_id=None, traceparent=None, **attributes):
+    """요청 하나의 루트 스팬 시작
+
+    traceparent 헤더가 있으면 같은 트레이스를 이어서 쓰고 그쪽의 샘플링 결정을 따릅니다.
+    샘플링되지 않으면 요청 ID만 가진 NoopSpan을 반환하므로 꺼져 있을 때의 비용은 거의 없습니다.
+    """
+    request_id = new_request_id(request_id)
+    if TRACE_SAMPLE_RATE <= 0:
+        return NoopSpan(request_id)
+    match = _TRACEPARENT.match(traceparent or "")
+    if match:
+        trace_id, parent_id, flags = match.groups()
+        sampled = bool(int(flags, 16) & 1)
+    else:
+        trace_id, parent_id = f"{random.getrandbits(128):032x}", None
+        sampled = random.random() < TRACE_SAMPLE_RATE
+    if not sampled:
+        return NoopSpan(request_id)
+    attributes["request.id"] = request_id
+    return Span(name, trace_id, request_id, parent_id, attributes=attributes)
+
+
+def current_span():
+    """지금 처리 중인 요청의 스팬 (없으면 NOOP_SPAN)"""
+    return _current.get() or NOOP_SPAN
+
+
+@contextmanager
+def use_span(span):
+    """with 블록 안에서 current_span()이 span을 반환하도록 설정"""
+    token = _current.set(span)
+    try:
+        yield span
+    finally:
+        _current.reset(token)
+
+
+class TracingMiddleware:
+    """route_label(scope)가 이름을 돌려주는 요청마다 루트 스팬을 만들고 X-Request-ID를 응답에 붙이는 ASGI 미들웨어
+
+    핸들러와 그 안에서 만든 작업은 current_span()으로 이 스팬을 가져와 하위 구간을 기록합니다.
+    """
+
+    def __init__(self, app, route_label, frontend):
+        self.app = app
+        self.route_label = route_label
+        self.frontend = frontend
+
+    async def __call__(self, scope, receive, send):
+        route = self.route_label(scope) if scope["type"] == "http" else None
+        if route is None:
+            await self.app(scope, receive, send)
+            return
+
+        headers = {}
+        for key, value in scope["headers"]:
+            if key in (b"x-request-id", b"traceparent"):
+                headers[key.decode("latin-1")] = value.decode("latin-1")
+        span = start_trace(
+            f"{scope['method']} {route}",
+            request_id=headers.get(REQUEST_ID_HEADER),
+            traceparent=headers.get("traceparent"),
+            frontend=self.frontend,
+        )
+        status = 500
+
+        async def send_with_request_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [
+                    (REQUEST_ID_HEADER.encode("latin-1"), span.request_id.encode("latin-1"))
+                ]
+            await send(message)
+
+        with use_span(span):
+            try:
+                await self.app(scope, receive, send_with_request_id)
+            finally:
+                span.set_attribute("http.status_code", status)
+                span.end(f"HTTP {status}" if status >= 500 else None)